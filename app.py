@@ -1,16 +1,69 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
-import database as db
+import logging
 import os
-from werkzeug.utils import secure_filename
+import secrets
+from contextlib import contextmanager
 
-app = Flask(__name__)
-app.secret_key = 'your-secret-key-here'  # Required for flash messages
+from flask import Flask, current_app, render_template, request, redirect, url_for, flash, abort
+import database as db
+from cache import page_cache, conditional, post_namespace, LISTING
+from config import Config
+from uploads import StreamingRequest, stage_upload
+from instrumentation import instrumentation
+import thumbnails
+import jobs
+import media
+import template_cache
+from markupsafe import Markup, escape
+from werkzeug.utils import secure_filename
 
 # File upload configuration
-UPLOAD_FOLDER = os.path.join('static', 'uploads')
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'webm', 'mov'}
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+
+
+def create_app(config=None):
+    """Build the blog's Flask app
+    Args:
+        config: Dict of settings to use instead of the defaults in config.py
+    Returns:
+        The app, ready to run or hand to a WSGI server
+    """
+    app = Flask(__name__)
+    app.request_class = StreamingRequest  # Stream uploads straight to UPLOAD_FOLDER
+    app.config.from_object(Config)
+    app.config.update(config or {})
+    if not app.config['SECRET_KEY']:  # Required for flash messages
+        logging.getLogger(__name__).warning(
+            'BLOG_SECRET_KEY is not set; using a random key for this process')
+        app.config['SECRET_KEY'] = secrets.token_hex()
+
+    db.init_app(app)  # Reuse one pooled database connection per request
+    page_cache.init_app(app)  # Cache rendered pages; see cache.py for settings
+    jobs.init_app(app)  # Background workers for file cleanup and image resizing
+    instrumentation.init_app(app)  # Server-Timing headers and /_metrics
+    media.init_app(app)  # How uploaded files are sent; see media.py
+    template_cache.init_app(app)  # Cached post fragments and compiled templates
+
+    # Basic routes
+    app.add_url_rule('/', 'home', home)
+    app.add_url_rule('/post/<int:post_id>', 'view_post', view_post)
+    app.add_url_rule('/search', 'search', search)
+    app.add_url_rule('/media/<path:filename>', 'media', media_file)
+    app.add_template_global(media_url)
+    app.add_template_global(srcset)
+    app.add_template_filter(highlight_filter, 'highlight')
+
+    # Post and media management routes
+    app.add_url_rule('/create', 'create', create, methods=['GET', 'POST'])
+    app.add_url_rule('/edit/<int:post_id>', 'edit', edit, methods=['GET', 'POST'])
+    app.add_url_rule('/delete/<int:post_id>', 'delete', delete)
+    app.add_url_rule('/delete-media/<int:media_id>', 'delete_media', delete_media)
+
+    if app.config['ASYNC_VIEWS']:
+        # Imported only here because it needs asgiref, which is optional
+        import async_views
+        async_views.register(app)
+    return app
 
 
 def allowed_file(filename, allowed_extensions):
@@ -18,41 +71,88 @@ def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
 
-def handle_media_upload(files, post_id):
-    """Process uploaded media files for a post
+@contextmanager
+def staged_media(files):
+    """Get a request's uploaded files ready to attach, before the transaction
+
+    Moving files into storage is slow with S3 (an upload), so it must happen
+    before the write lock is taken. Use it together with db.transaction(), in this order:
+
+        with staged_media(request.files) as uploads, db.transaction():
+            post_id = db.create_post(title, content)
+            handle_media_upload(uploads, post_id)
+
+    If the transaction fails, the files are cleaned up again.
     Args:
         files: The files from request.files
+    Yields:
+        The uploads, for handle_media_upload()
+    """
+    uploads = []
+    try:
+        for file in files.getlist('media') if files else []:
+            if file.filename == '':
+                continue
+
+            if file and (allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS) or
+                         allowed_file(file.filename, ALLOWED_VIDEO_EXTENSIONS)):
+                # Files are stored by content, so only the extension is kept
+                filename = secure_filename(file.filename)
+                extension = os.path.splitext(filename)[1]
+                media_type = 'video' if allowed_file(filename, ALLOWED_VIDEO_EXTENSIONS) else 'image'
+
+                temp_path, size, sha256 = stage_upload(file, current_app.config['UPLOAD_FOLDER'])
+                uploads.append((temp_path, sha256, size, extension, media_type))
+        db.stage_media(uploads)
+        yield uploads
+    except BaseException:
+        db.discard_staged_media(uploads)
+        raise
+
+
+def handle_media_upload(uploads, post_id):
+    """Record a post's uploaded files and queue their resized copies
+    Args:
+        uploads: The uploads from staged_media()
         post_id: The ID of the post to attach media to
     """
-    if not files:
-        return
+    # Record every file with one batch of inserts
+    stored_filenames = db.add_media_many(post_id, uploads)
 
-    for file in files.getlist('media'):
-        if file.filename == '':
-            continue
+    # Resized copies are made in the background; the page works without them
+    for stored_filename, upload in zip(stored_filenames, uploads):
+        if upload[4] == 'image':
+            thumbnails.generate_variants_async(stored_filename)
 
-        if file and (allowed_file(file.filename, ALLOWED_IMAGE_EXTENSIONS) or
-                     allowed_file(file.filename, ALLOWED_VIDEO_EXTENSIONS)):
-            # Secure filename and add post_id to prevent naming conflicts
-            filename = secure_filename(file.filename)
-            base, ext = os.path.splitext(filename)
-            filename = f"{base}_{post_id}{ext}"
 
-            # Save file and record in database
-            file.save(os.path.join(UPLOAD_FOLDER, filename))
-            media_type = 'video' if allowed_file(filename, ALLOWED_VIDEO_EXTENSIONS) else 'image'
-            db.add_media(post_id, filename, media_type)
+def post_freshness(post_id):
+    """Version and time of a post's last change, for conditional GETs"""
+    updated_at = db.get_post_updated_at(post_id)
+    return None if updated_at is None else (updated_at, updated_at)
 
 
 # Basic Routes
-@app.route('/')
+@conditional(db.get_blog_state)
+@page_cache.cached(lambda: LISTING)
 def home():
-    """Homepage - shows all posts"""
-    posts = db.get_all_posts()
-    return render_template('home.html', posts=posts)
+    """Homepage - shows one page of posts
+    Query args:
+        before: Show the posts older than this cursor (next page)
+        after: Show the posts newer than this cursor (previous page)
+    """
+    try:
+        posts, prev_cursor, next_cursor = db.get_posts_page(
+            before=request.args.get('before'),
+            after=request.args.get('after'),
+            limit=current_app.config['POSTS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    return render_template('home.html', posts=posts,
+                           prev_cursor=prev_cursor, next_cursor=next_cursor)
 
 
-@app.route('/post/<int:post_id>')
+@conditional(post_freshness)
+@page_cache.cached(post_namespace)
 def view_post(post_id):
     """View a single post
     Args:
@@ -64,8 +164,47 @@ def view_post(post_id):
     return render_template('post.html', post=post)
 
 
+def search():
+    """Search posts by title and content
+    Query args:
+        q: The words to search for
+        page: Which page of results to show, starting at 1
+    """
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_more = db.search_posts(query, page, current_app.config['POSTS_PER_PAGE'])
+    return render_template('search.html', query=query, results=results,
+                           page=page, has_more=has_more)
+
+
+def media_url(filename):
+    """URL of an uploaded file, wherever the storage backend keeps it"""
+    return db.settings().STORAGE.url(filename)
+
+
+def srcset(media, image_format):
+    """Build a srcset value listing a media item's resized copies in one format"""
+    return ', '.join(
+        f"{media_url(variant['filename'])} {variant['width']}w"
+        for variant in media['variants'] if variant['format'] == image_format)
+
+
+def media_file(filename):
+    """Serve an uploaded file, with Range support and long-lived caching
+    Args:
+        filename: The file's name in storage
+    """
+    return media.send_media(filename)
+
+
+def highlight_filter(text):
+    """Escape search result text, then turn the match markers into <mark> tags"""
+    return (escape(text)
+            .replace(db.HIGHLIGHT_START, Markup('<mark>'))
+            .replace(db.HIGHLIGHT_END, Markup('</mark>')))
+
+
 # Post Management Routes
-@app.route('/create', methods=['GET', 'POST'])
 def create():
     """Create a new post
     GET: Show the create form
@@ -76,15 +215,16 @@ def create():
         title = request.form['title']
         content = request.form['content']
 
-        # Create post and handle any uploaded files
-        post_id = db.create_post(title, content)
-        handle_media_upload(request.files, post_id)
+        # Create post and handle any uploaded files, all in one commit
+        with staged_media(request.files) as uploads, db.transaction():
+            post_id = db.create_post(title, content)
+            handle_media_upload(uploads, post_id)
+        page_cache.invalidate(LISTING)
 
         return redirect(url_for('home'))
     return render_template('create.html')
 
 
-@app.route('/edit/<int:post_id>', methods=['GET', 'POST'])
 def edit(post_id):
     """Edit an existing post
     Args:
@@ -97,43 +237,41 @@ def edit(post_id):
         return "Post not found", 404
 
     if request.method == 'POST':
-        # Update post content
+        # Update post content and handle any new uploaded files in one commit
         title = request.form['title']
         content = request.form['content']
-        db.update_post(post_id, title, content)
-
-        # Handle any new uploaded files
-        handle_media_upload(request.files, post_id)
+        with staged_media(request.files) as uploads, db.transaction():
+            db.update_post(post_id, title, content)
+            handle_media_upload(uploads, post_id)
+        page_cache.invalidate(post_namespace(post_id), LISTING)
         return redirect(url_for('home'))
 
     return render_template('edit.html', post=post)
 
 
-@app.route('/delete/<int:post_id>')
 def delete(post_id):
     """Delete a post and its media
     Args:
         post_id: ID of the post to delete
     """
     db.delete_post(post_id)  # This also deletes associated media
+    page_cache.invalidate(post_namespace(post_id), LISTING)
     return redirect(url_for('home'))
 
 
 # Media Management Route
-@app.route('/delete-media/<int:media_id>')
 def delete_media(media_id):
     """Delete a single media item
     Args:
         media_id: ID of the media to delete
     """
     # Get post_id for redirect before deleting media
-    conn = db.get_db_connection()
-    media = conn.execute('SELECT post_id FROM media WHERE id = ?', (media_id,)).fetchone()
-    conn.close()
+    media = db.get_media(media_id)
 
     if media:
         post_id = media['post_id']
         db.delete_media(media_id)
+        page_cache.invalidate(post_namespace(post_id), LISTING)
         flash('Media deleted successfully')
         return redirect(url_for('edit', post_id=post_id))
 
@@ -141,4 +279,5 @@ def delete_media(media_id):
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Development server only; see serve.py for running the blog for real
+    create_app().run(debug=True)
\ No newline at end of file
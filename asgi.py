@@ -0,0 +1,43 @@
+"""
+Run the blog on an ASGI server with the async views:
+
+    pip install "flask[async]" uvicorn
+    uvicorn asgi:app --workers 4
+
+The event loop receives each request body in full before the app sees it,
+so a client uploading slowly costs a few kilobytes of buffer instead of a
+whole thread. That is where the gain comes from.
+
+The app then runs on a thread pool (thread_sensitive=False below; asgiref's
+default would run every request on one shared thread, one at a time). Its
+async views run on the event loop while the request's thread waits for
+them, so each request still holds a thread until its response is built,
+and the pool's size limits how many run at once.
+
+Settings come from config.py and the BLOG_* environment variables it lists.
+"""
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import create_app
+import template_cache
+
+
+class _PooledInstance(WsgiToAsgiInstance):
+    # asgiref runs every WSGI call on one shared thread by default, which
+    # would handle requests one at a time; ours are independent
+    run_wsgi_app = sync_to_async(vars(WsgiToAsgiInstance)['run_wsgi_app'].func,
+                                 thread_sensitive=False)
+
+
+class BufferedWsgiToAsgi(WsgiToAsgi):
+    """WSGI-to-ASGI adapter that runs requests on a thread pool"""
+
+    async def __call__(self, scope, receive, send):
+        await _PooledInstance(self.wsgi_application)(scope, receive, send)
+
+
+flask_app = create_app({'ASYNC_VIEWS': True})
+template_cache.precompile(flask_app)  # Before the first request, not during it
+app = BufferedWsgiToAsgi(flask_app)
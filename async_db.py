@@ -0,0 +1,54 @@
+"""
+Async access to the database and uploaded files, for async views.
+
+SQLite and ordinary files have no real async interface, so (like
+aiosqlite) every call is handed to a pool of I/O threads and the event loop
+carries on with other requests until it finishes. The same functions from
+database.py and uploads.py do the work, so queries are never written twice.
+
+    post = await adb.get_post(post_id)
+    await run_sync(some_blocking_function, arg)
+
+The thread sees the caller's Flask request context, so database calls reuse
+the request's pooled connection. For that reason await one call at a time
+rather than gathering several at once, and put a whole transaction inside
+one function passed to run_sync(), because the write lock belongs to the
+thread that took it.
+"""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database as db
+
+IO_THREADS = 16  # Blocking calls that can be in progress at once
+
+_executor = ThreadPoolExecutor(IO_THREADS, thread_name_prefix='async-io')
+
+
+async def run_sync(func, *args, **kwargs):
+    """Run a blocking function on the I/O threads without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+class AsyncDatabase:
+    """database.py with every function turned into a coroutine function"""
+
+    def __getattr__(self, name):
+        func = getattr(db, name)
+        if not callable(func):
+            return func
+
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            return await run_sync(func, *args, **kwargs)
+        return call
+
+
+adb = AsyncDatabase()
+
@@ -0,0 +1,40 @@
+"""
+Async versions of the views in app.py, used when ASYNC_VIEWS is on.
+
+Each one awaits the plain view from app.py on the I/O threads in
+async_db.py, so pages, caching and uploads work exactly the same and are
+only written once. Under an ASGI server (see asgi.py) request bodies are
+received before a thread is involved, so slow uploaders don't tie up the
+process. The views themselves are no faster than the plain ones: the
+request's thread waits while they run, so they don't add concurrency.
+
+Needs asgiref: pip install "flask[async]"
+"""
+
+import importlib.util
+from functools import wraps
+
+from async_db import run_sync
+
+ENDPOINTS = ('home', 'view_post', 'search', 'create', 'edit', 'delete', 'delete_media')
+
+
+def register(app):
+    """Use async views for the app's routes, keeping their endpoint names"""
+    if importlib.util.find_spec('asgiref') is None:  # Flask needs it to run async views
+        raise RuntimeError('ASYNC_VIEWS needs asgiref: pip install "flask[async]"')
+
+    for endpoint in ENDPOINTS:
+        app.view_functions[endpoint] = make_async(app.view_functions[endpoint])
+
+
+def make_async(view):
+    """Turn a plain view into a coroutine that runs it on an I/O thread
+
+    The thread sees the request context (see async_db.run_sync()), so the
+    view's database calls, uploads and page cache work as usual.
+    """
+    @wraps(view)
+    async def async_view(**kwargs):
+        return await run_sync(view, **kwargs)
+    return async_view
@@ -0,0 +1,790 @@
+"""
+Benchmarks for the blog's database and routes.
+
+Each benchmark works on its own temporary database, so it never touches
+blog_database.db. Run one with:
+
+    python benchmark.py storage --workers 4 --seconds 5
+    python benchmark.py listing --posts 5000 --content-size 50000
+    python benchmark.py rows --rows 100000
+    python benchmark.py routes --posts 100000 --output before.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py serve --clients 16 --seconds 10
+    python benchmark.py serve --read-mode snapshot --writes-per-second 20
+"""
+
+import argparse
+import http.client
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.serving import make_server
+from werkzeug.test import encode_multipart
+
+import database as db
+import storage
+from uploads import HashingFile
+
+
+# Helpers
+def use_database(path, profile=None):
+    """Point the database module at a different file and storage profile"""
+    db.close_pool()
+    db.DATABASE_FILE = path
+    if profile is not None:
+        db.STORAGE_PROFILE = profile
+
+
+def use_upload_folder(folder):
+    """Point the database module (and its media storage) at a different folder"""
+    db.UPLOAD_FOLDER = folder
+    db.STORAGE = storage.LocalStorage(folder)
+
+
+def seed_posts(count, content_size=500):
+    """Insert count posts with filler content through the database API"""
+    content = 'lorem ipsum ' * (content_size // 12)
+    for i in range(count):
+        db.create_post(f'Post {i}', content)
+
+
+def sample_png(width, height, color):
+    """A solid-colour PNG image, built without needing Pillow"""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data)))
+
+    row = b'\x00' + bytes(color) * width  # Each row starts with filter type 0
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row * height)) +
+            chunk(b'IEND', b''))
+
+
+SAMPLE_IMAGES = [sample_png(640, 480, color)
+                 for color in ((200, 80, 80), (80, 200, 80), (80, 80, 200), (120, 120, 120))]
+
+
+def seed_blog(count, media_per_post=1, content_size=2000, batch_size=1000):
+    """Insert count posts, each with media_per_post images, through the database API
+
+    Posts are committed in batches. The images repeat, so the files
+    themselves are stored only a few times.
+    """
+    content = 'lorem ipsum dolor sit amet ' * (content_size // 27)
+    for start in range(0, count, batch_size):
+        batch = []
+        for i in range(start, min(start + batch_size, count)):
+            uploads = []
+            for n in range(media_per_post):
+                staged = HashingFile(db.UPLOAD_FOLDER)
+                staged.write(SAMPLE_IMAGES[(i + n) % len(SAMPLE_IMAGES)])
+                uploads.append((staged.detach(), staged.sha256, staged.size, '.png', 'image'))
+            batch.append((i, uploads))
+        # Files go into storage before the transaction, as the app does it
+        db.stage_media([upload for _, uploads in batch for upload in uploads])
+        with db.transaction():
+            for i, uploads in batch:
+                post_id = db.create_post(f'Post {i}', content)
+                db.add_media_many(post_id, uploads)
+        print(f'\rSeeded {min(start + batch_size, count)} of {count} posts',
+              end='', file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+
+
+def peak_rss_mb():
+    """Most memory this process has used so far, in megabytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def git_commit():
+    """The current commit's hash, or None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Storage Profile Benchmark
+def _storage_worker(path, profile, seconds, write_ratio, post_count, results):
+    """Run a mixed read/write loop in one process and report what it did"""
+    use_database(path, profile)
+    reads = writes = errors = 0
+    deadline = time.perf_counter() + seconds
+
+    while time.perf_counter() < deadline:
+        post_id = random.randint(1, post_count)
+        try:
+            if random.random() < write_ratio:
+                if random.random() < 0.5:
+                    db.create_post('Benchmark post', 'Some new content')
+                else:
+                    db.update_post(post_id, 'Edited title', 'Edited content')
+                writes += 1
+            else:
+                db.get_post(post_id)
+                reads += 1
+        except sqlite3.OperationalError:
+            # Mostly "database is locked"
+            errors += 1
+
+    results.put((reads, writes, errors))
+
+
+def bench_storage(args):
+    """Compare mixed read/write throughput with and without a storage profile"""
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            use_database(path, profile)
+            db.init_db()
+            seed_posts(args.posts)
+            db.close_pool()
+
+            # Separate processes, like separate gunicorn workers
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(
+                    target=_storage_worker,
+                    args=(path, profile, args.seconds, args.write_ratio,
+                          args.posts, results))
+                for _ in range(args.workers)
+            ]
+            for worker in workers:
+                worker.start()
+            totals = [sum(values) for values in
+                      zip(*(results.get() for _ in workers))]
+            for worker in workers:
+                worker.join()
+
+        reads, writes, errors = totals
+        print(f'{profile:>12}: {reads / args.seconds:10.0f} reads/s '
+              f'{writes / args.seconds:8.0f} writes/s {errors:6d} lock errors')
+
+
+# Listing Benchmark
+_OLDER_THAN = 'WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?'
+LISTING_QUERIES = {
+    # What the home page loaded before posts had a stored excerpt
+    'full rows': f'SELECT {db.POST_COLUMNS} FROM posts {_OLDER_THAN}',
+    'excerpts': f'SELECT {db.LISTING_COLUMNS} FROM posts {_OLDER_THAN}',
+}
+
+
+def _listing_page(sql, cursor, limit):
+    """Load one page of posts the way get_posts_page() does, plus the previews shown"""
+    with db.connection() as conn:
+        posts = db.attach_media(conn, db.fetch_records(conn, db.Post, sql, (*cursor, limit)))
+    return [post['content'][:200] if 'content' in post else post['excerpt']
+            for post in posts]
+
+
+def bench_listing(args):
+    """Compare loading home pages with full post rows against excerpts only"""
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, 'bench.db'))
+        use_upload_folder(tmp)
+        db.init_db()
+        seed_blog(args.posts, media_per_post=0, content_size=args.content_size)
+        print(f'Database size: {os.path.getsize(db.DATABASE_FILE) / 1024 / 1024:.1f}MB',
+              file=sys.stderr)
+
+        with db.connection() as conn:
+            cursors = [tuple(row) for row in conn.execute('SELECT created_at, id FROM posts')]
+        # Random pages, so the OS cache doesn't favour whichever query runs second
+        cursors = random.choices(cursors, k=args.pages)
+
+        for name, sql in LISTING_QUERIES.items():
+            latencies = []
+            for cursor in cursors:
+                start = time.perf_counter()
+                _listing_page(sql, cursor, args.page_size)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+
+            # Separate pass, as tracing allocations slows everything down
+            tracemalloc.start()
+            peaks = []
+            for cursor in cursors[:50]:
+                tracemalloc.reset_peak()
+                _listing_page(sql, cursor, args.page_size)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+            print(f'{name:>10}: p50 {percentile(latencies, 0.5):7.2f}ms  '
+                  f'p95 {percentile(latencies, 0.95):7.2f}ms  '
+                  f'peak memory per page {max(peaks) / 1024:9.1f}KB')
+        db.close_pool()
+
+
+# Row Representation Benchmark
+def _load_rows(conn, style):
+    """Fetch every post as a dict (the old way) or as a db.Post"""
+    sql = f'SELECT {db.LISTING_COLUMNS} FROM posts'
+    if style == 'dict(sqlite3.Row)':
+        conn.row_factory = sqlite3.Row
+        return [dict(row) for row in conn.execute(sql)]
+    return db.fetch_records(conn, db.Post, sql)
+
+
+def _read_fields(posts, style):
+    """The field reads the home page template does for each post"""
+    if style == 'dict(sqlite3.Row)':
+        for post in posts:
+            post['id'], post['title'], post['excerpt'], post['created_at'], post['updated_at']
+    else:
+        for post in posts:
+            post.id, post.title, post.excerpt, post.created_at, post.updated_at
+
+
+def bench_rows(args):
+    """Compare dicts made from rows against db.Post records: build, read and memory"""
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE posts (id INTEGER PRIMARY KEY, title TEXT, excerpt TEXT, '
+                 'created_at TIMESTAMP, updated_at TIMESTAMP)')
+    timestamp = '2024-01-01 00:00:00.000'
+    conn.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?)',
+                     [(i, f'Post {i}', 'lorem ipsum ' * 16, timestamp, timestamp)
+                      for i in range(args.rows)])
+
+    for style in ('dict(sqlite3.Row)', 'Post'):
+        # Best of several runs, so a stray garbage collection doesn't decide it
+        load_seconds = read_seconds = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            posts = _load_rows(conn, style)
+            load_seconds = min(load_seconds, time.perf_counter() - start)
+            start = time.perf_counter()
+            _read_fields(posts, style)
+            read_seconds = min(read_seconds, time.perf_counter() - start)
+            row_bytes = sys.getsizeof(posts[0])
+            del posts
+
+        # Separate pass, as tracing allocations slows everything down
+        tracemalloc.start()
+        posts = _load_rows(conn, style)
+        total_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del posts
+
+        print(f'{style:>18}: build {load_seconds / args.rows * 1e6:5.2f}us/row  '
+              f'read {read_seconds / args.rows * 1e6:5.2f}us/row  '
+              f'{row_bytes:4d} bytes/row object  '
+              f'{total_bytes / args.rows:5.0f} bytes/row with values')
+
+
+# Route Benchmark
+class TestClientDriver:
+    """Sends requests through Flask's test client, without any networking"""
+
+    name = 'test_client'
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, method, path, body=None, content_type=None):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client()
+        response = self._local.client.open(path, method=method, data=body,
+                                           content_type=content_type)
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class WSGIServerDriver:
+    """Sends real HTTP requests to the app running in a threaded WSGI server"""
+
+    name = 'wsgi_server'
+
+    def __init__(self, app):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # No access log
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def send(self, method, path, body=None, content_type=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            headers = {'Content-Type': content_type} if content_type else {}
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def form_body(fields, image=None):
+    """Encode a multipart form like the create and edit pages send
+    Returns:
+        (body, content_type)
+    """
+    values = dict(fields)
+    if image is not None:
+        values['media'] = FileStorage(io.BytesIO(image), filename='photo.png',
+                                      content_type='image/png')
+    boundary, body = encode_multipart(values)
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def route_workloads(args, targets):
+    """The requests to send to each route
+    Args:
+        targets: Dict of ID lists: 'read' posts to view or edit, 'delete'
+            posts to delete, 'media' media to delete. Each delete target is
+            used up, so the two drivers get different ones.
+    Returns:
+        (name, method, [request, ...], idempotent) tuples, where each request
+        is a (path, body, content_type) triple
+    """
+    n = args.requests
+    cursors = [db.make_cursor(db.get_post(post_id)) for post_id in targets['read'][:50]]
+    image = SAMPLE_IMAGES[0] if args.uploads else None
+
+    def edit_form(i):
+        return form_body({'title': f'Edited {i}', 'content': 'Edited content'}, image)
+
+    workloads = [
+        ('home', 'GET', [
+            ('/' if i % 2 else f'/?before={quote(random.choice(cursors))}', None, None)
+            for i in range(n)], True),
+        ('view_post', 'GET', [
+            (f'/post/{random.choice(targets["read"])}', None, None) for _ in range(n)], True),
+        ('create', 'POST', [
+            ('/create', *form_body({'title': f'New post {i}', 'content': 'Fresh content'}, image))
+            for i in range(n)], False),
+        ('edit', 'GET', [
+            (f'/edit/{random.choice(targets["read"])}', None, None) for _ in range(n)], True),
+        ('edit', 'POST', [
+            (f'/edit/{random.choice(targets["read"])}', *edit_form(i)) for i in range(n)], False),
+        ('delete_media', 'GET', [
+            (f'/delete-media/{targets["media"].pop()}', None, None)
+            for _ in range(min(n, len(targets['media'])))], False),
+        ('delete', 'GET', [
+            (f'/delete/{targets["delete"].pop()}', None, None)
+            for _ in range(min(n, len(targets['delete'])))], False),
+    ]
+    return [workload for workload in workloads if workload[2]]
+
+
+def run_workload(driver, method, requests, concurrency):
+    """Send requests from concurrency threads and time each one
+    Returns:
+        Dict of latency percentiles, throughput, error count and memory.
+        process_peak_rss_mb is the most the whole process has used so far,
+        which only ever rises; peak_rss_growth_mb is how far this workload
+        pushed it up (0 if it stayed under an earlier route's peak).
+    """
+    def timed(request):
+        path, body, content_type = request
+        started = time.perf_counter()
+        try:
+            status = driver.send(method, path, body, content_type)
+        except Exception:
+            status = None
+        return time.perf_counter() - started, status
+
+    peak_before = peak_rss_mb()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, requests))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    errors = sum(1 for _, status in results if status is None or status >= 400)
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'throughput_rps': round(len(results) / elapsed, 1),
+        'process_peak_rss_mb': round(peak_rss_mb(), 1),
+        'peak_rss_growth_mb': round(peak_rss_mb() - peak_before, 1),
+    }
+
+
+def pick_targets(args):
+    """Choose which seeded posts and media the workloads read and delete
+
+    Each driver deletes up to --requests posts, but never more than half of
+    them, so there are always posts left to read after both drivers ran.
+    """
+    with db.connection() as conn:
+        post_ids = [row['id'] for row in conn.execute('SELECT id FROM posts ORDER BY id')]
+    if len(post_ids) < 2:
+        raise SystemExit('The routes benchmark needs at least 2 posts (--posts)')
+
+    random.shuffle(post_ids)
+    delete_count = min(args.requests * 2, len(post_ids) // 2)
+    deletable, readable = post_ids[:delete_count], post_ids[delete_count:]
+    with db.connection() as conn:
+        # Media of posts that are only read, so deleting a post never takes them along
+        media_ids = [row['id'] for row in conn.execute(
+            f'SELECT id FROM media WHERE post_id NOT IN ({",".join("?" * len(deletable))}) '
+            'ORDER BY id LIMIT ?', (*deletable, args.requests * 2))]
+    return {'read': readable, 'delete': deletable, 'media': media_ids}
+
+
+def prepare_blog(args, data_dir):
+    """Point the database module at a seeded blog in data_dir
+    Returns:
+        (database path, upload folder)
+    """
+    # Absolute, as the serve benchmark's servers run in this script's directory
+    data_dir = os.path.abspath(data_dir)
+    path = os.path.join(data_dir, 'bench.db')
+    uploads = os.path.join(data_dir, 'uploads')
+    os.makedirs(uploads, exist_ok=True)
+    use_database(path)
+    use_upload_folder(uploads)
+
+    db.init_db()
+    with db.connection() as conn:
+        existing = conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0]
+    db.close_pool()
+    if existing < args.posts:
+        # In another process, so seeding doesn't count towards peak RSS
+        seeder = multiprocessing.Process(
+            target=_seed_worker,
+            args=(path, uploads, args.posts - existing, args.media_per_post))
+        seeder.start()
+        seeder.join()
+    return path, uploads
+
+
+def write_results(results, output):
+    """Save results as JSON, or print them if no output file was given"""
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def bench_routes(args):
+    """Time every route through the test client and a real WSGI server"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path, uploads = prepare_blog(args, args.data_dir or tmp)
+
+        from app import create_app
+        import jobs
+        app = create_app({'DATABASE_FILE': path, 'UPLOAD_FOLDER': uploads,
+                          'SECRET_KEY': 'benchmark',
+                          'CACHE_BACKEND': None if args.no_cache else 'memory'})
+
+        targets = pick_targets(args)
+        results = {
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'posts': args.posts,
+            'media_per_post': args.media_per_post,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'page_cache': not args.no_cache,
+            'uploads': args.uploads,
+            'drivers': {},
+        }
+
+        for driver_class in (TestClientDriver, WSGIServerDriver):
+            if args.driver not in ('both', driver_class.name):
+                continue
+            driver = driver_class(app)
+            routes = results['drivers'][driver.name] = {}
+            try:
+                for name, method, requests, idempotent in route_workloads(args, targets):
+                    if idempotent and args.warmup:
+                        run_workload(driver, method, requests[:args.warmup], args.concurrency)
+                    stats = run_workload(driver, method, requests, args.concurrency)
+                    routes[f'{name} {method}'] = stats
+                    print(f"{driver.name:>12} {name + ' ' + method:<18}"
+                          f"p50 {stats['p50_ms']:8.2f}ms  p95 {stats['p95_ms']:8.2f}ms  "
+                          f"p99 {stats['p99_ms']:8.2f}ms  {stats['throughput_rps']:8.1f} req/s  "
+                          f"{stats['errors']} errors", file=sys.stderr)
+            finally:
+                driver.close()
+            # Finish queued thumbnails now, so they don't slow the next driver
+            with app.app_context():
+                jobs.run_pending()
+
+        stop_jobs = app.extensions.get('job_workers')  # None with JOB_WORKERS = 0
+        if stop_jobs is not None:
+            stop_jobs.set()
+            for thread in threading.enumerate():
+                if thread.name.startswith('job-worker-'):
+                    thread.join()
+        with app.app_context():
+            db.close_pool()
+        db.close_pool()
+
+    write_results(results, args.output)
+
+
+def _seed_worker(path, uploads, count, media_per_post):
+    use_database(path)
+    use_upload_folder(uploads)
+    seed_blog(count, media_per_post)
+    db.close_pool()
+
+
+# Server Benchmark
+SERVERS = {
+    # Flask's development server, as 'flask run' starts it (threaded, no debugger)
+    'dev': lambda port, args: [
+        sys.executable, '-c',
+        f'from app import create_app; create_app().run(port={port}, threaded=True)'],
+    'prefork': lambda port, args: [
+        sys.executable, 'serve.py', '--bind', f'127.0.0.1:{port}',
+        '--workers', str(args.workers), '--threads', str(args.threads), '--job-workers', '0'],
+}
+
+
+def free_port():
+    """A TCP port nothing is listening on right now"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    """Wait until a server accepts connections on port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'Nothing listening on port {port} after {timeout}s')
+
+
+def _load_client(port, paths, seconds):
+    """Request random paths one after another for a while (one client process)
+    Returns:
+        (latencies in seconds, error count)
+    """
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            conn.request('GET', random.choice(paths))
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+        except OSError:
+            errors += 1
+        finally:
+            conn.close()
+        latencies.append(time.perf_counter() - started)
+    return latencies, errors
+
+
+def _writer(path, post_ids, rate, seconds):
+    """Edit posts at a steady rate, like authors working while readers browse"""
+    use_database(path)
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        db.update_post(random.choice(post_ids), 'Edited during the benchmark', 'New content')
+        time.sleep(1 / rate)
+    db.close_pool()
+
+
+def bench_serve(args):
+    """Compare the development server with serve.py under concurrent load"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        path, uploads = prepare_blog(args, args.data_dir or tmp)
+        with db.connection() as conn:
+            post_ids = [row['id'] for row in conn.execute('SELECT id FROM posts LIMIT 10000')]
+        db.close_pool()
+        paths = ['/'] + [f'/post/{post_id}' for post_id in post_ids]
+
+        env = dict(os.environ, BLOG_DATABASE_FILE=path, BLOG_UPLOAD_FOLDER=uploads,
+                   BLOG_SECRET_KEY='benchmark', BLOG_JOB_WORKERS='0',
+                   BLOG_DATABASE_READ_MODE=args.read_mode or '')
+        results = {
+            'commit': git_commit(),
+            'python': sys.version.split()[0],
+            'posts': args.posts,
+            'clients': args.clients,
+            'seconds': args.seconds,
+            'workers': args.workers,
+            'threads': args.threads,
+            'read_mode': args.read_mode,
+            'writes_per_second': args.writes_per_second,
+            'servers': {},
+        }
+
+        for name in args.servers:
+            port = free_port()
+            server = subprocess.Popen(SERVERS[name](port, args), cwd=here, env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_port(port)
+                writer = None
+                if args.writes_per_second:
+                    writer = multiprocessing.Process(
+                        target=_writer,
+                        args=(path, post_ids, args.writes_per_second, args.seconds))
+                    writer.start()
+                with multiprocessing.Pool(args.clients) as pool:
+                    outcomes = pool.starmap(_load_client,
+                                            [(port, paths, args.seconds)] * args.clients)
+                if writer is not None:
+                    writer.join()
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+
+            latencies = sorted(latency * 1000 for found, _ in outcomes for latency in found)
+            stats = results['servers'][name] = {
+                'requests': len(latencies),
+                'errors': sum(errors for _, errors in outcomes),
+                'p50_ms': round(percentile(latencies, 0.50), 3),
+                'p95_ms': round(percentile(latencies, 0.95), 3),
+                'p99_ms': round(percentile(latencies, 0.99), 3),
+                'throughput_rps': round(len(latencies) / args.seconds, 1),
+            }
+            print(f"{name:>8}: {stats['throughput_rps']:8.1f} req/s  "
+                  f"p50 {stats['p50_ms']:7.2f}ms  p95 {stats['p95_ms']:7.2f}ms  "
+                  f"p99 {stats['p99_ms']:7.2f}ms  {stats['errors']} errors", file=sys.stderr)
+
+    write_results(results, args.output)
+
+
+def bench_compare(args):
+    """Show how each route's latency changed between two result files"""
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    for driver, routes in after['drivers'].items():
+        for route, stats in routes.items():
+            old = before['drivers'].get(driver, {}).get(route)
+            if old is None:
+                continue
+            changes = '  '.join(
+                f"{key[:-3]} {old[key]:8.2f} -> {stats[key]:8.2f}ms "
+                f"({(stats[key] - old[key]) / old[key] * 100 if old[key] else 0:+6.1f}%)"
+                for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+            print(f'{driver:>12} {route:<18}{changes}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    storage_bench = commands.add_parser('storage',
+                                        help='Mixed read/write throughput per storage profile')
+    storage_bench.add_argument('--profiles', nargs='+', default=['default', 'concurrent'],
+                               choices=sorted(db.STORAGE_PROFILES))
+    storage_bench.add_argument('--workers', type=int, default=4, help='Worker processes')
+    storage_bench.add_argument('--seconds', type=float, default=5.0)
+    storage_bench.add_argument('--posts', type=int, default=1000, help='Posts to seed')
+    storage_bench.add_argument('--write-ratio', type=float, default=0.2)
+    storage_bench.set_defaults(func=bench_storage)
+
+    listing = commands.add_parser('listing', help='Home page loads with full posts vs excerpts')
+    listing.add_argument('--posts', type=int, default=5000, help='Posts to seed')
+    listing.add_argument('--content-size', type=int, default=50000,
+                         help='Characters in each post')
+    listing.add_argument('--page-size', type=int, default=db.POSTS_PER_PAGE)
+    listing.add_argument('--pages', type=int, default=500, help='Pages loaded per query')
+    listing.set_defaults(func=bench_listing)
+
+    rows = commands.add_parser('rows', help='dict(sqlite3.Row) vs db.Post records')
+    rows.add_argument('--rows', type=int, default=100000)
+    rows.add_argument('--repeat', type=int, default=5)
+    rows.set_defaults(func=bench_rows)
+
+    routes = commands.add_parser('routes', help='Latency, throughput and memory of every route')
+    routes.add_argument('--posts', type=int, default=1000,
+                        help='Posts to seed, e.g. 1000, 100000 or 1000000')
+    routes.add_argument('--media-per-post', type=int, default=1)
+    routes.add_argument('--requests', type=int, default=200, help='Requests per route')
+    routes.add_argument('--concurrency', type=int, default=4, help='Client threads')
+    routes.add_argument('--warmup', type=int, default=20,
+                        help='Untimed requests sent first to the read-only routes')
+    routes.add_argument('--driver', choices=['both', 'test_client', 'wsgi_server'],
+                        default='both')
+    routes.add_argument('--uploads', action='store_true',
+                        help='Attach an image to every create and edit')
+    routes.add_argument('--no-cache', action='store_true', help='Turn off the page cache')
+    routes.add_argument('--data-dir',
+                        help='Keep the seeded database here and reuse it on the next run')
+    routes.add_argument('--output', help='Write the JSON results here instead of stdout')
+    routes.set_defaults(func=bench_routes)
+
+    serve = commands.add_parser('serve', help='Development server vs serve.py under load')
+    serve.add_argument('--servers', nargs='+', default=list(SERVERS), choices=list(SERVERS))
+    serve.add_argument('--posts', type=int, default=1000, help='Posts to seed')
+    serve.add_argument('--media-per-post', type=int, default=1)
+    serve.add_argument('--clients', type=int, default=16, help='Client processes')
+    serve.add_argument('--seconds', type=float, default=10.0)
+    serve.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                       help='serve.py worker processes')
+    serve.add_argument('--threads', type=int, default=8, help='serve.py threads per worker')
+    serve.add_argument('--read-mode', choices=['readonly', 'snapshot'],
+                       help="Where the servers' pages read from (default: the database)")
+    serve.add_argument('--writes-per-second', type=float, default=0,
+                       help='Edit posts at this rate from another process during the run')
+    serve.add_argument('--data-dir',
+                       help='Keep the seeded database here and reuse it on the next run')
+    serve.add_argument('--output', help='Write the JSON results here instead of stdout')
+    serve.set_defaults(func=bench_serve)
+
+    compare = commands.add_parser('compare', help='Compare two routes result files')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""
+Bulk import and export of posts and their media.
+
+    python database.py export archive.jsonl --media-dir archive_media
+    python database.py import archive.jsonl --media-dir archive_media
+
+Each line of a JSON Lines file is one post:
+
+    {"id": 1, "title": "...", "content": "...", "created_at": "...",
+     "updated_at": "...", "media": [{"filename": "...", "media_type": "image"}]}
+
+CSV files have the same columns, with media as a JSON list. Only id, title
+and content are needed; id may be left out too. Both directions stream, so
+memory use doesn't grow with the size of the archive.
+"""
+
+import csv
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import islice
+
+import database as db
+from uploads import HashingFile
+
+CSV_FIELDS = ['id', 'title', 'content', 'created_at', 'updated_at', 'media']
+
+
+# Reading and Writing Files
+def detect_format(path, file_format):
+    """Pick the format from the argument, else the extension, else jsonl"""
+    if file_format:
+        return file_format
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+@contextmanager
+def open_file(path, mode):
+    """Open a file, or standard input/output for '-'"""
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+        return
+    with open(path, mode, encoding='utf-8', newline='') as f:
+        yield f
+
+
+def read_records(f, file_format):
+    """Yield one post dict per line of the file"""
+    if file_format == 'csv':
+        csv.field_size_limit(sys.maxsize)  # Posts can be long
+        for row in csv.DictReader(f):
+            row = {key: value for key, value in row.items() if value != ''}
+            row['media'] = json.loads(row.get('media', '[]'))
+            yield row
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class RecordWriter:
+    """Writes post dicts to a file, one per line"""
+
+    def __init__(self, f, file_format):
+        self.f = f
+        self.file_format = file_format
+        if file_format == 'csv':
+            self.csv = csv.DictWriter(f, CSV_FIELDS)
+            self.csv.writeheader()
+
+    def write(self, record):
+        if self.file_format == 'csv':
+            self.csv.writerow(dict(record, media=json.dumps(record['media'])))
+        else:
+            self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def batches(records, size):
+    """Split an iterable into lists of at most size items, lazily"""
+    records = iter(records)
+    while batch := list(islice(records, size)):
+        yield batch
+
+
+def report(count, started, done=False):
+    """Show progress on standard error"""
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f'\r{count} posts, {count / elapsed:.0f} rows/s',
+          end='\n' if done else '', file=sys.stderr, flush=True)
+
+
+# Import
+def import_posts(path, file_format=None, media_dir=None, batch_size=5000, workers=8):
+    """Load posts (and optionally their media files) from a file
+    Args:
+        path: File to read, or '-' for standard input
+        file_format: 'jsonl' or 'csv'; guessed from path if None
+        media_dir: Folder holding the media files named in the records. If
+            None, media filenames are recorded as-is and must already be in
+            storage.
+        batch_size: Posts per transaction
+        workers: Threads hashing and copying media files
+    Returns:
+        How many posts were imported
+    """
+    file_format = detect_format(path, file_format)
+    count = 0
+    started = time.perf_counter()
+
+    # Indexes, search and reference counts are rebuilt once at the end
+    # instead of once per row
+    with db.write() as conn:
+        db.defer_schema(conn, ('posts', 'media'))
+    try:
+        with open_file(path, 'r') as f, ThreadPoolExecutor(workers) as pool:
+            for batch in batches(read_records(f, file_format), batch_size):
+                _import_batch(batch, media_dir, pool)
+                count += len(batch)
+                report(count, started)
+    finally:
+        db.restore_deferred_schema()
+
+    report(count, started, done=True)
+    return count
+
+
+def _import_batch(records, media_dir, pool):
+    """Insert one batch of posts and their media in a single transaction"""
+    # Copy media files in parallel and put them in storage before taking
+    # the write lock
+    media = [(record_index, item) for record_index, record in enumerate(records)
+             for item in record.get('media', [])]
+    upload_folder = db.settings().UPLOAD_FOLDER
+    copies = [pool.submit(_stage_media, media_dir, item, upload_folder)
+              for _, item in media] if media_dir else []
+    wait(copies)  # Every copy has finished, so a failure can clean up all of them
+    uploads = [copy.result() for copy in copies
+               if copy.exception() is None and copy.result() is not None]
+    try:
+        staged = [copy.result() for copy in copies] if media_dir else [None] * len(media)
+        db.stage_media(uploads, pool)
+        _insert_batch(records, media, staged, media_dir)
+    except BaseException:
+        # e.g. an ID that is already taken; the batch's files mustn't linger
+        db.discard_staged_media(uploads)
+        raise
+
+
+def _insert_batch(records, media, staged, media_dir):
+    """Insert the posts and media rows of one batch, once its files are stored"""
+    now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    with db.write() as conn:
+        # Give posts without an ID the next free ones, so executemany works
+        next_id = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM posts').fetchone()[0]
+        post_ids = []
+        for record in records:
+            if record.get('id') is None:
+                post_ids.append(next_id)
+                next_id += 1
+            else:
+                post_ids.append(int(record['id']))
+                next_id = max(next_id, post_ids[-1] + 1)
+
+        conn.executemany(
+            'INSERT INTO posts (id, title, content, excerpt, created_at, updated_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            [(post_id, record['title'], record['content'], db.make_excerpt(record['content']),
+              record.get('created_at') or now,
+              record.get('updated_at') or record.get('created_at') or now)
+             for post_id, record in zip(post_ids, records)])
+
+        uploads = [upload for upload in staged if upload is not None]
+        stored_filenames = iter(db.record_staged_blobs(conn, uploads))
+        media_rows = []
+        for (record_index, item), upload in zip(media, staged):
+            filename, blob_sha256 = item['filename'], None
+            if upload is not None:
+                filename, blob_sha256 = next(stored_filenames), upload[1]
+            elif media_dir:
+                continue  # The file was missing; _stage_media said so
+            media_rows.append((post_ids[record_index], filename, item['media_type'],
+                               db.guess_mime_type(filename, item['media_type']),
+                               item.get('created_at') or now, blob_sha256))
+
+        conn.executemany('''
+            INSERT INTO media (post_id, filename, media_type, mime_type, created_at, blob_sha256)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', media_rows)
+
+
+def _stage_media(media_dir, item, upload_folder):
+    """Copy one media file into UPLOAD_FOLDER while hashing it
+    Args:
+        media_dir: The folder the archive's media files are in
+        item: The media's dict from the archive
+        upload_folder: UPLOAD_FOLDER, looked up before the worker threads
+            start since they have no app context
+    Returns:
+        The (temp_path, sha256, size, extension, media_type) tuple that
+        db.stage_media() takes, or None if the file doesn't exist
+    """
+    filename = item['filename']
+    try:
+        source = open(os.path.join(media_dir, filename), 'rb')
+    except FileNotFoundError:
+        print(f'\nMissing media file skipped: {filename}', file=sys.stderr)
+        return None
+
+    staged = HashingFile(upload_folder)
+    with source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            staged.write(chunk)
+    return (staged.detach(), staged.sha256, staged.size, os.path.splitext(filename)[1],
+            item['media_type'])
+
+
+# Export
+def export_posts(path, file_format=None, media_dir=None, batch_size=5000, workers=8):
+    """Write every post (and optionally its media files) to a file
+    Args:
+        path: File to write, or '-' for standard output
+        file_format: 'jsonl' or 'csv'; guessed from path if None
+        media_dir: Folder to copy the media files into, keeping their names
+        batch_size: Posts fetched from the database at a time
+        workers: Threads copying media files
+    Returns:
+        How many posts were exported
+    """
+    file_format = detect_format(path, file_format)
+    count = 0
+    started = time.perf_counter()
+    media_storage = db.settings().STORAGE  # The worker threads have no app context
+
+    with open_file(path, 'w') as f, ThreadPoolExecutor(workers) as pool, \
+            db.connection() as conn:
+        writer = RecordWriter(f, file_format)
+        cursor = conn.execute(f'''
+            SELECT {db.WHOLE_TABLE} id, title, content, created_at, updated_at FROM posts ORDER BY id
+        ''')
+        while rows := cursor.fetchmany(batch_size):
+            posts = [dict(row, media=[]) for row in rows]
+            by_id = {post['id']: post for post in posts}
+
+            # Keep each IN list to the usual media batch size
+            for post_ids in batches(by_id, db.MEDIA_BATCH_SIZE):
+                placeholders = ', '.join('?' * len(post_ids))
+                for media in conn.execute(f'''
+                    SELECT post_id, filename, media_type, created_at FROM media
+                    WHERE post_id IN ({placeholders})
+                    ORDER BY created_at
+                ''', post_ids):
+                    by_id[media['post_id']]['media'].append(
+                        {key: media[key] for key in ('filename', 'media_type', 'created_at')})
+
+            copies = []
+            if media_dir:
+                # A shared file is copied once; two threads writing the same
+                # target at the same time could leave it half-written
+                filenames = dict.fromkeys(media['filename']
+                                          for post in posts for media in post['media'])
+                copies = [pool.submit(_copy_media, media_storage, filename, media_dir)
+                          for filename in filenames]
+            for post in posts:
+                writer.write(post)
+            for copy in copies:
+                copy.result()  # Finish this batch's files before the next one
+
+            count += len(posts)
+            report(count, started)
+
+    report(count, started, done=True)
+    return count
+
+
+def _copy_media(media_storage, filename, media_dir):
+    """Copy one media file out of storage, keeping its relative path"""
+    target = os.path.join(media_dir, filename)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        with media_storage.open(filename) as source, open(target, 'wb') as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+    except FileNotFoundError:
+        print(f'\nMissing media file skipped: {filename}', file=sys.stderr)
@@ -0,0 +1,406 @@
+"""
+Rendered-page cache for the blog.
+
+Pages are stored under a namespace, such as 'post-5' for one post's page or
+'listing' for every home page. When a post changes, dropping its namespace
+and the listing namespace throws away exactly the pages that show it.
+"""
+
+import asyncio
+import hashlib
+import heapq
+import inspect
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import abort, current_app, g, has_app_context, jsonify, make_response, request
+from werkzeug.http import is_resource_modified
+
+
+# Cache Backends
+class MemoryCache:
+    """Least-recently-used cache kept in this process's memory"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (namespace, key) -> value
+        self._namespaces = {}  # namespace -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        """Get a cached value, or None if it isn't cached"""
+        with self._lock:
+            value = self._entries.get((namespace, key))
+            if value is not None:
+                self._entries.move_to_end((namespace, key))
+            return value
+
+    def set(self, namespace, key, value):
+        """Store a value, evicting the least recently used one if full"""
+        with self._lock:
+            self._entries[(namespace, key)] = value
+            self._entries.move_to_end((namespace, key))
+            self._namespaces.setdefault(namespace, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                (old_namespace, old_key), _ = self._entries.popitem(last=False)
+                self._namespaces[old_namespace].discard(old_key)
+
+    def delete_namespace(self, namespace):
+        """Drop every value stored under a namespace"""
+        with self._lock:
+            for key in self._namespaces.pop(namespace, ()):
+                self._entries.pop((namespace, key), None)
+
+    def clear(self):
+        """Drop everything"""
+        with self._lock:
+            self._entries.clear()
+            self._namespaces.clear()
+
+
+class FileSystemCache:
+    """Cache stored as files, so every worker process on the machine shares it
+
+    Each namespace is a directory, which makes dropping one a single rename;
+    its files are deleted afterwards on a background thread. Every so often
+    a background thread also prunes the oldest pages, so the cache holds
+    about max_entries at most.
+    """
+
+    def __init__(self, directory, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._sets = 0  # Pages stored by this process since the last prune
+        self._sets_lock = threading.Lock()
+        self._prune_lock = threading.Lock()  # Held while a prune runs
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, namespace, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, namespace, name)
+
+    def get(self, namespace, key):
+        """Get a cached value, or None if it isn't cached"""
+        try:
+            with open(self._path(namespace, key), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, namespace, key, value):
+        """Store a value, pruning the oldest ones now and then"""
+        path = self._path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see half a page.
+        # Its name starts with a dot so _prune() leaves it alone.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        # Counting the files is slow, so only check once in a while
+        with self._sets_lock:
+            self._sets += 1
+            due = self._sets >= max(1, self.max_entries // 10)
+            if due:
+                self._sets = 0
+        if due and self._prune_lock.acquire(blocking=False):
+            threading.Thread(target=self._prune, name='page-cache-prune', daemon=True).start()
+
+    def _prune(self):
+        """Delete the oldest pages until at most max_entries are left, and
+        anything delete_namespace() didn't get to finish"""
+        try:
+            pages = []
+            with os.scandir(self.directory) as namespaces:
+                for namespace in namespaces:
+                    if namespace.name.startswith('.deleted-'):
+                        shutil.rmtree(namespace.path, ignore_errors=True)
+                    elif namespace.is_dir() and not namespace.name.startswith('.'):
+                        pages += self._pages_in(namespace.path)
+            for _, path in heapq.nsmallest(len(pages) - self.max_entries, pages):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # Replaced or dropped meanwhile
+        finally:
+            self._prune_lock.release()
+
+    def _pages_in(self, directory):
+        """(last modified, path) for each page in a namespace's directory"""
+        pages = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue  # Still being written
+                    try:
+                        pages.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass  # The namespace was dropped meanwhile
+        return pages
+
+    def delete_namespace(self, namespace):
+        """Drop every value stored under a namespace"""
+        path = os.path.join(self.directory, namespace)
+        # Move it out of the way first so new pages can be cached straight away
+        doomed = os.path.join(self.directory, f'.deleted-{uuid.uuid4().hex}')
+        try:
+            os.rename(path, doomed)
+        except FileNotFoundError:
+            return
+        # A big namespace takes a while to delete; the request needn't wait
+        threading.Thread(target=shutil.rmtree, args=(doomed,), kwargs={'ignore_errors': True},
+                         name='page-cache-delete', daemon=True).start()
+
+    def clear(self):
+        """Drop everything"""
+        for name in os.listdir(self.directory):
+            if not name.startswith('.'):
+                self.delete_namespace(name)
+
+
+# Response Cache
+class CacheState:
+    """One app's cache backend and hit and miss counts"""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+
+class ResponseCache:
+    """Caches the HTML returned by view functions and counts hits and misses
+
+    Set up with init_app(), which reads these config values:
+        CACHE_BACKEND: 'memory' (default), 'filesystem' or None to turn it off
+        CACHE_MAX_ENTRIES: Most pages either backend keeps
+        CACHE_DIR: Where the filesystem cache keeps its files
+
+    Each app keeps its own backend in app.extensions['page_cache'], so one
+    ResponseCache serves any number of apps. Outside an app caching is off.
+    """
+
+    def __init__(self, app=None):
+        self._no_app = CacheState()
+        self._stats_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    @property
+    def state(self):
+        """The current app's CacheState"""
+        if has_app_context():
+            return current_app.extensions.get('page_cache', self._no_app)
+        return self._no_app
+
+    @property
+    def backend(self):
+        return self.state.backend
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'memory')
+        app.config.setdefault('CACHE_MAX_ENTRIES', 1000)
+        app.config.setdefault('CACHE_DIR', os.path.join(app.instance_path, 'page_cache'))
+        app.config.setdefault('STATS_ALLOWED_IPS', ())
+
+        backend = app.config['CACHE_BACKEND']
+        if backend == 'memory':
+            app.extensions['page_cache'] = CacheState(MemoryCache(app.config['CACHE_MAX_ENTRIES']))
+        elif backend == 'filesystem':
+            app.extensions['page_cache'] = CacheState(
+                FileSystemCache(app.config['CACHE_DIR'], app.config['CACHE_MAX_ENTRIES']))
+        elif backend is None:
+            app.extensions['page_cache'] = CacheState()
+        else:
+            raise ValueError(f'Unknown CACHE_BACKEND: {backend!r}')
+
+        app.add_url_rule('/_cache/stats', 'cache_stats', self.stats_view)
+
+    def cached(self, namespace):
+        """Decorator that caches a view's page, keyed by path and query string
+
+        Use it below conditional(), which adds the data's version to the key.
+        Works on both plain and async views.
+        Args:
+            namespace: Function called with the view's arguments that returns
+                the namespace to store the page under
+        """
+        def decorator(view):
+            if inspect.iscoroutinefunction(view):
+                @wraps(view)
+                async def async_wrapper(**kwargs):
+                    if self.backend is None:
+                        return await view(**kwargs)
+                    # The filesystem backend reads and writes files
+                    name, key, page = await asyncio.to_thread(self._lookup, namespace, kwargs)
+                    if page is not None:
+                        return page
+                    return await asyncio.to_thread(self._store, name, key, await view(**kwargs))
+                return async_wrapper
+
+            @wraps(view)
+            def wrapper(**kwargs):
+                if self.backend is None:
+                    return view(**kwargs)
+                name, key, page = self._lookup(namespace, kwargs)
+                if page is not None:
+                    return page
+                return self._store(name, key, view(**kwargs))
+            return wrapper
+        return decorator
+
+    def _lookup(self, namespace, kwargs):
+        """Find the cached page for this request
+        Returns:
+            (namespace, key, page), where page is None on a miss
+        """
+        name = namespace(**kwargs)
+        key = request.full_path
+        # Set by conditional(): pages from an older version of the data
+        # never match, even if another process changed it
+        if 'page_version' in g:
+            key = f'{key}@{g.page_version}'
+        page = self.backend.get(name, key)
+        self._count(hit=page is not None)
+        return name, key, page
+
+    def _store(self, name, key, rv):
+        # Only plain rendered pages; errors and redirects are tuples or
+        # response objects
+        if isinstance(rv, str):
+            self.backend.set(name, key, rv)
+        return rv
+
+    def invalidate(self, *namespaces):
+        """Throw away every cached page in the given namespaces"""
+        if self.backend is None:
+            return
+        for name in namespaces:
+            self.backend.delete_namespace(name)
+
+    def _count(self, hit):
+        state = self.state
+        with self._stats_lock:
+            if hit:
+                state.hits += 1
+            else:
+                state.misses += 1
+
+    def stats(self):
+        """The current app's hit and miss counts in this process"""
+        state = self.state
+        with self._stats_lock:
+            hits, misses = state.hits, state.misses
+        total = hits + misses
+        return {
+            'backend': type(state.backend).__name__ if state.backend else None,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
+
+    def stats_view(self):
+        """JSON endpoint with the cache counters"""
+        if not stats_allowed():
+            abort(404)
+        return jsonify(self.stats())
+
+
+page_cache = ResponseCache()
+
+
+def stats_allowed():
+    """Whether this request may see internal numbers such as /_cache/stats
+
+    Always in debug mode; otherwise only from an address in STATS_ALLOWED_IPS.
+    """
+    return (current_app.debug
+            or request.remote_addr in current_app.config.get('STATS_ALLOWED_IPS', ()))
+
+
+# Conditional GET
+def conditional(freshness):
+    """Decorator that answers 304 Not Modified when the client's copy is current
+
+    The check runs before the view, so an unchanged page costs one cheap
+    lookup instead of a render. Works on both plain and async views.
+    Args:
+        freshness: Function called with the view's arguments that returns a
+            (version, updated_at) pair describing the page's data, or None if
+            there is nothing to check (the view then handles it, e.g. 404)
+    """
+    def decorator(view):
+        if inspect.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(**kwargs):
+                validators = await asyncio.to_thread(_validators, freshness, kwargs)
+                if validators is None:
+                    return await view(**kwargs)
+                if _not_modified(*validators):
+                    return _revalidated(make_response('', 304), *validators)
+                return _revalidated(make_response(await view(**kwargs)), *validators)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(**kwargs):
+            validators = _validators(freshness, kwargs)
+            if validators is None:
+                return view(**kwargs)
+            if _not_modified(*validators):
+                return _revalidated(make_response('', 304), *validators)
+            return _revalidated(make_response(view(**kwargs)), *validators)
+        return wrapper
+    return decorator
+
+
+def _validators(freshness, kwargs):
+    """The (etag, last_modified) of the page about to be built, or None"""
+    state = freshness(**kwargs)
+    if state is None:
+        return None
+    version, updated_at = state
+    g.page_version = version
+    etag = hashlib.sha1(f'{request.full_path}:{version}'.encode('utf-8')).hexdigest()
+    return etag, parse_timestamp(updated_at)
+
+
+def _not_modified(etag, last_modified):
+    """Whether the client's conditional headers say its copy is current"""
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+
+def _revalidated(response, etag, last_modified):
+    """Add the validators and caching rules to a successful response"""
+    if response.status_code not in (200, 304):
+        return response
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Let browsers and CDNs keep a copy, but ask us before reusing it
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def parse_timestamp(value):
+    """Turn an SQLite UTC timestamp string into an aware datetime"""
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def post_namespace(post_id):
+    """Namespace for the pages that show a single post"""
+    return f'post-{post_id}'
+
+
+LISTING = 'listing'  # Namespace for the home page listings
@@ -0,0 +1,55 @@
+"""
+Settings for the blog.
+
+create_app() starts from Config and then applies whatever you pass it:
+
+    app = create_app({'POSTS_PER_PAGE': 20})
+
+The settings that differ between computers can also come from environment
+variables, so the same code runs on your laptop and on a server:
+
+    BLOG_SECRET_KEY      Signs session cookies (flash messages). Set this in
+                         production; otherwise a random key is used and
+                         sessions end whenever the app restarts.
+    BLOG_DATABASE_FILE   SQLite database file
+    BLOG_UPLOAD_FOLDER   Where uploaded files are stored (or arrive first,
+                         with S3 storage)
+    BLOG_JOB_WORKERS     Background job threads per process
+    BLOG_DATABASE_READ_MODE
+                         Where pages read from: unset for the database
+                         itself, 'readonly' or 'snapshot' (see database.py)
+    BLOG_MEDIA_STORAGE   'local' or 's3' (see storage.py)
+    BLOG_S3_BUCKET, BLOG_S3_ENDPOINT_URL, BLOG_S3_PUBLIC_URL
+                         The bucket, a non-AWS server such as MinIO, and
+                         where browsers can fetch files without signing
+"""
+
+import os
+
+
+class Config:
+    SECRET_KEY = os.environ.get('BLOG_SECRET_KEY')
+    DATABASE_FILE = os.environ.get('BLOG_DATABASE_FILE', 'blog_database.db')
+    UPLOAD_FOLDER = os.environ.get('BLOG_UPLOAD_FOLDER', os.path.join('static', 'uploads'))
+    # Uploads are streamed to disk, so a bigger limit doesn't cost more memory
+    MAX_CONTENT_LENGTH = 256 * 1024 * 1024  # 256MB max upload size
+    POSTS_PER_PAGE = 10  # Posts shown on each home page
+    JOB_WORKERS = int(os.environ.get('BLOG_JOB_WORKERS', 2))
+    # Read-only connections, or a periodically refreshed copy, for the
+    # pages; writes always go to DATABASE_FILE
+    DATABASE_READ_MODE = os.environ.get('BLOG_DATABASE_READ_MODE') or None
+    DATABASE_SNAPSHOT_INTERVAL = 5.0  # Seconds a 'snapshot' copy is used for
+    # Where media files live: 'local' (UPLOAD_FOLDER) or 's3'
+    MEDIA_STORAGE = os.environ.get('BLOG_MEDIA_STORAGE', 'local')
+    S3_BUCKET = os.environ.get('BLOG_S3_BUCKET')
+    S3_PREFIX = ''  # Put every key under e.g. 'blog/'
+    S3_ENDPOINT_URL = os.environ.get('BLOG_S3_ENDPOINT_URL')  # e.g. http://localhost:9000
+    S3_REGION = None
+    S3_PUBLIC_URL = os.environ.get('BLOG_S3_PUBLIC_URL')  # Public bucket or CDN URL
+    S3_URL_EXPIRES = 3600  # Seconds a presigned URL works for
+    S3_PART_SIZE = 8 * 1024 * 1024  # Multipart upload piece size
+    S3_UPLOAD_CONCURRENCY = 8  # Pieces uploaded at once
+    ASYNC_VIEWS = False  # Use async_views.py; asgi.py turns this on
+    # Addresses that may read /_metrics and /_cache/stats, e.g. ('127.0.0.1',)
+    # for a Prometheus on the same machine; debug mode always may
+    STATS_ALLOWED_IPS = ()
@@ -1,40 +1,544 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import pathlib
+import shutil
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 import os
+from flask import Flask, current_app, g, has_app_context, has_request_context, request
+from config import Config
+import storage
 # Muchas gracias Felipe
-# Configuration
-DATABASE_FILE = 'blog_database.db'
-UPLOAD_FOLDER = os.path.join('static', 'uploads')
+# Configuration (an app's own settings replace these; see init_app())
+DATABASE_FILE = Config.DATABASE_FILE
+UPLOAD_FOLDER = Config.UPLOAD_FOLDER
+MEDIA_BATCH_SIZE = 500  # Posts per media query in attach_media()
+POSTS_PER_PAGE = 10  # Default page size for get_posts_page()
+EXCERPT_LENGTH = 200  # Longest post preview on the home page, in characters
+POOL_SIZE = 8  # Idle connections kept open for reuse
+
+# Storage profiles: PRAGMA settings applied to every new connection.
+# 'concurrent' lets readers keep going while a write is in progress (WAL)
+# and makes writers wait their turn instead of failing with
+# "database is locked".
+STORAGE_PROFILES = {
+    'default': {},
+    'concurrent': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # Safe with WAL, one fsync per checkpoint
+        'cache_size': -16000,  # Negative means KiB, so about 16MB
+        'mmap_size': 128 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,  # Milliseconds to wait for a lock
+    },
+}
+STORAGE_PROFILE = 'concurrent'
+SINGLE_WRITER = True  # Serialize writes from this process through one lock
+TRACE_CALLBACK = None  # Called with every SQL statement new connections run
+CONNECTION_FACTORY = sqlite3.Connection  # Class of new connections; see instrumentation.py
+READ_MODE = None  # Where requests read from: None (DATABASE_FILE), 'readonly' or 'snapshot'
+SNAPSHOT_FILE = None  # The copy read in 'snapshot' mode; defaults to DATABASE_FILE + '.snapshot'
+SNAPSHOT_INTERVAL = 5.0  # Seconds before the snapshot is refreshed
+STORAGE = storage.from_config(vars(Config))  # Where media files live; see storage.py
+
+# SQL for the current UTC time with milliseconds, so two edits in the same
+# second still get different updated_at values
+NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+# Put in a statement that reads a whole table on purpose (exports, bulk
+# bookkeeping), so check_query_plans() doesn't report it
+WHOLE_TABLE = '/* whole table */'
+# Put in a statement that walks an index in order and stops at its LIMIT,
+# e.g. the first page of posts; check_query_plans() still checks that it
+# has a LIMIT and uses an index
+FIRST_ROWS = '/* first rows */'
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 
+# Per-app Settings
+class AppDatabase:
+    """One app's database settings and connection pools
+
+    init_app() keeps one in app.extensions['database'], so several apps in
+    one process (e.g. tests) each keep their own database and files. It has
+    the same names as the module-level settings above; settings() picks
+    which to use.
+    """
+
+    def __init__(self, config):
+        self.DATABASE_FILE = config['DATABASE_FILE']
+        self.UPLOAD_FOLDER = config['UPLOAD_FOLDER']
+        self.READ_MODE = config['DATABASE_READ_MODE']
+        self.SNAPSHOT_FILE = config['DATABASE_SNAPSHOT_FILE']
+        self.SNAPSHOT_INTERVAL = config['DATABASE_SNAPSHOT_INTERVAL']
+        self.STORAGE = storage.from_config(config)
+        self.CONNECTION_FACTORY = CONNECTION_FACTORY
+        self.TRACE_CALLBACK = TRACE_CALLBACK
+        self._pool = []
+        self._read_pool = []
+        self._snapshot_lock = threading.Lock()
+        _app_databases.add(self)
+
+
+_app_databases = weakref.WeakSet()  # Every AppDatabase, so a fork can reset them
+
+
+def settings():
+    """The settings in use: the current app's AppDatabase, or this module's
+    own settings outside an app (scripts, jobs.py run on its own)"""
+    if has_app_context():
+        app_database = current_app.extensions.get('database')
+        if app_database is not None:
+            return app_database
+    return sys.modules[__name__]
+
+
 # Database Connection
 def get_db_connection():
     """Create a database connection that allows accessing columns by name"""
-    conn = sqlite3.connect(DATABASE_FILE)
+    config = settings()
+    # Pooled connections may be handed to a different worker thread later
+    conn = sqlite3.connect(config.DATABASE_FILE, check_same_thread=False,
+                           factory=config.CONNECTION_FACTORY)
     conn.row_factory = sqlite3.Row
+    # SQLite ignores ON DELETE CASCADE unless this is on for the connection
+    conn.execute('PRAGMA foreign_keys = ON')
+    apply_storage_profile(conn, STORAGE_PROFILE)
+    if config.TRACE_CALLBACK is not None:
+        conn.set_trace_callback(config.TRACE_CALLBACK)
     return conn
 
 
+def get_read_connection():
+    """Create a read-only connection for READ_MODE, set up like get_db_connection()"""
+    config = settings()
+    if config.READ_MODE == 'snapshot':
+        # The snapshot is replaced, never changed in place, so SQLite can
+        # skip locking it altogether
+        uri = pathlib.Path(snapshot_file()).resolve().as_uri() + '?mode=ro&immutable=1'
+    else:
+        uri = pathlib.Path(config.DATABASE_FILE).resolve().as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                           factory=config.CONNECTION_FACTORY)
+    conn.row_factory = sqlite3.Row
+    # Belt and braces on top of mode=ro: even a temp table can't be written
+    conn.execute('PRAGMA query_only = ON')
+    apply_storage_profile(conn, STORAGE_PROFILE, read_only=True)
+    if config.TRACE_CALLBACK is not None:
+        conn.set_trace_callback(config.TRACE_CALLBACK)
+    return conn
+
+
+def apply_storage_profile(conn, profile, read_only=False):
+    """Run the PRAGMA statements for a storage profile on a connection
+    Args:
+        conn: The connection to configure
+        profile: A key of STORAGE_PROFILES, or None for SQLite's defaults
+        read_only: Skip the settings only a writer can change
+    """
+    for pragma, value in STORAGE_PROFILES.get(profile or 'default', {}).items():
+        if read_only and pragma in ('journal_mode', 'synchronous'):
+            continue
+        conn.execute(f'PRAGMA {pragma} = {value}')
+
+
+# Connection Pool
+# Each app's pools are on its AppDatabase; these are used outside any app
+_pool = []
+_pool_lock = threading.Lock()
+_local = threading.local()  # The connection in use by this thread outside requests
+
+
+def _checkout():
+    """Take an idle connection from the pool, or open a new one"""
+    pool = settings()._pool
+    with _pool_lock:
+        if pool:
+            return pool.pop()
+    return get_db_connection()
+
+
+def _checkin(conn):
+    """Return a connection to the pool, closing it if the pool is full"""
+    # Never hand out a connection with half-finished work on it
+    conn.rollback()
+    pool = settings()._pool
+    with _pool_lock:
+        if len(pool) < POOL_SIZE:
+            pool.append(conn)
+            return
+    conn.close()
+
+
+def close_pool():
+    """Close every idle pooled connection (e.g. after changing DATABASE_FILE)"""
+    config = settings()
+    with _pool_lock:
+        while config._pool:
+            config._pool.pop().close()
+        while config._read_pool:
+            config._read_pool.pop()[1].close()
+
+
+def warm_pool(count=POOL_SIZE):
+    """Open connections ahead of time so the first requests don't wait for them"""
+    conns = [_checkout() for _ in range(count)]
+    for conn in conns:
+        _checkin(conn)
+
+
+def _forget_pool():
+    # A forked child must not use (or even close) its parent's SQLite
+    # connections, so it starts with an empty pool
+    global _pool_lock, _write_lock
+    for config in [sys.modules[__name__], *_app_databases]:
+        config._pool.clear()
+        config._read_pool.clear()
+        config._snapshot_lock = threading.Lock()
+    _local.__dict__.clear()
+    _pool_lock = threading.Lock()
+    _write_lock = threading.RLock()
+
+
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+@contextmanager
+def connection():
+    """Borrow a database connection for a block of work
+
+    Inside a Flask request the same connection is reused by every database
+    call and goes back to the pool when the app context ends. Outside a
+    request (scripts, worker threads) nested calls on one thread share a
+    connection, which goes back when the outermost with-block finishes.
+
+    With READ_MODE set, a request reads from a read-only connection until
+    it writes; see Read Connections below.
+    """
+    if settings().READ_MODE is not None and has_request_context() and 'db' not in g:
+        if 'read_db' not in g:
+            g.read_db = _checkout_reader()
+        if g.read_db is not None:
+            yield g.read_db[1]
+            return
+
+    with _primary() as conn:
+        yield conn
+
+
+@contextmanager
+def _primary():
+    """Borrow a connection to DATABASE_FILE itself, as connection() describes"""
+    if has_app_context():
+        if 'db' not in g:
+            g.db = _checkout()
+        yield g.db
+        return
+
+    if getattr(_local, 'conn', None) is not None:
+        yield _local.conn
+        return
+
+    _local.conn = _checkout()
+    try:
+        yield _local.conn
+    finally:
+        conn, _local.conn = _local.conn, None
+        _checkin(conn)
+
+
+_write_lock = threading.RLock()
+
+
+@contextmanager
+def write():
+    """Borrow a connection for a block of changes and commit them together
+
+    BEGIN IMMEDIATE takes SQLite's write lock up front, so two writers never
+    deadlock halfway through a transaction. With SINGLE_WRITER the threads of
+    this process also queue on a lock, leaving SQLite's busy_timeout to sort
+    out only the other processes. Nested write() blocks join the outer one.
+    """
+    with _primary() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+
+        with _write_lock if SINGLE_WRITER else nullcontext():
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            if has_request_context():
+                g.db_wrote = True  # Read-your-writes; see Read Connections
+
+
+def transaction():
+    """Group several database calls into one transaction and one commit
+
+    Usage:
+        with db.transaction():
+            post_id = db.create_post(title, content)
+            db.add_media_many(post_id, uploads)
+
+    Either everything inside the block is saved or, if it raises, nothing is.
+    """
+    return write()
+
+
+# Read Connections
+# Every database function that only reads uses connection(), and every one
+# that changes something uses write(). So with READ_MODE set, requests can
+# send their reads elsewhere and leave DATABASE_FILE to the writers:
+#   'readonly'  mode=ro connections to DATABASE_FILE. They see each commit
+#               straight away but can never take the write lock.
+#   'snapshot'  Connections to a copy of the database, refreshed with
+#               SQLite's backup API once it is SNAPSHOT_INTERVAL seconds old.
+#               Readers share no locks with the primary at all, but pages
+#               can be a few seconds behind.
+# Once a request has written, the rest of it uses the primary. In snapshot
+# mode so does that browser, until the snapshot includes its changes.
+PRIMARY_COOKIE = 'blog_wrote_at'  # When this browser last changed something
+
+_read_pool = []  # (snapshot generation, connection) pairs
+_snapshot_lock = threading.Lock()  # Held while this process refreshes the snapshot
+
+
+def snapshot_file(config=None):
+    """The path of the snapshot copy used by READ_MODE 'snapshot'
+    Args:
+        config: The settings to use (default: settings())
+    """
+    config = config or settings()
+    return config.SNAPSHOT_FILE or config.DATABASE_FILE + '.snapshot'
+
+
+def refresh_snapshot(config=None):
+    """Copy DATABASE_FILE to the snapshot file with SQLite's backup API
+
+    The copy is made next to the snapshot and renamed over it, so readers
+    that have the old one open keep a consistent view until they finish.
+    Args:
+        config: The settings to use (default: settings())
+    """
+    config = config or settings()
+    target = os.path.abspath(snapshot_file(config))
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+    os.close(fd)
+    try:
+        started = time.time()
+        source = sqlite3.connect(config.DATABASE_FILE)
+        copy = sqlite3.connect(temp_path)
+        try:
+            source.backup(copy)  # All pages in one step, so the copy is consistent
+            # Only ever read, and read-only WAL databases need extra files
+            copy.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            copy.close()
+            source.close()
+        # The file's time says which commits it includes; see _checkout_reader()
+        os.utime(temp_path, (started, started))
+        os.replace(temp_path, target)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _snapshot_generation():
+    """Identify the current snapshot, making it first or refreshing it if due
+    Returns:
+        (inode, modification time), which change whenever any process
+        replaces the snapshot
+    """
+    config = settings()
+    try:
+        stat = os.stat(snapshot_file(config))
+    except FileNotFoundError:
+        with config._snapshot_lock:  # Everyone waits for the very first copy
+            if not os.path.exists(snapshot_file(config)):
+                refresh_snapshot(config)
+        stat = os.stat(snapshot_file(config))
+    else:
+        # Refreshed in the background; until then requests use the old copy
+        if (time.time() - stat.st_mtime > config.SNAPSHOT_INTERVAL
+                and config._snapshot_lock.acquire(blocking=False)):
+            # The thread has no app context, so it gets the settings to use
+            threading.Thread(target=_refresh_snapshot_in_background, args=(config,),
+                             name='snapshot-refresh', daemon=True).start()
+    return stat.st_ino, stat.st_mtime
+
+
+def _refresh_snapshot_in_background(config):
+    try:
+        # Another worker process may have refreshed it already
+        if time.time() - os.stat(snapshot_file(config)).st_mtime > config.SNAPSHOT_INTERVAL:
+            refresh_snapshot(config)
+    except Exception:
+        logging.getLogger(__name__).exception('Refreshing the database snapshot failed')
+    finally:
+        config._snapshot_lock.release()
+
+
+def _checkout_reader():
+    """Take an idle read connection, or open a new one
+    Returns:
+        A (generation, connection) pair, or None if this request must read
+        from the primary to see its own changes
+    """
+    config = settings()
+    generation = None
+    if config.READ_MODE == 'snapshot':
+        generation = _snapshot_generation()
+        try:
+            wrote_at = float(request.cookies.get(PRIMARY_COOKIE, 0))
+        except ValueError:
+            wrote_at = 0
+        if wrote_at >= generation[1]:
+            return None
+
+    stale = []
+    with _pool_lock:
+        while config._read_pool:
+            pooled_generation, conn = config._read_pool.pop()
+            if pooled_generation == generation:
+                break
+            stale.append(conn)  # Still reading a snapshot that has been replaced
+        else:
+            conn = None
+    for old in stale:
+        old.close()
+    return generation, conn or get_read_connection()
+
+
+def _checkin_reader(reader):
+    """Return a (generation, connection) pair to the read pool"""
+    reader[1].rollback()
+    read_pool = settings()._read_pool
+    with _pool_lock:
+        if len(read_pool) < POOL_SIZE:
+            read_pool.append(reader)
+            return
+    reader[1].close()
+
+
+def _remember_write(response):
+    """Send this browser's reads to the primary until the snapshot has caught up"""
+    if settings().READ_MODE == 'snapshot' and g.get('db_wrote'):
+        response.set_cookie(PRIMARY_COOKIE, repr(time.time()), max_age=3600,
+                            httponly=True, samesite='Lax')
+    return response
+
+
+def close_db(exception=None):
+    """Give the request's connections back to their pools"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        _checkin(conn)
+    reader = g.pop('read_db', None)
+    if reader is not None:
+        _checkin_reader(reader)
+
+
+def init_app(app):
+    """Use the app's DATABASE_FILE, UPLOAD_FOLDER and MEDIA_STORAGE and hook
+    the per-request connection into it
+
+    The settings are kept on the app (see AppDatabase), not in this module,
+    so creating a second app never changes what the first one uses.
+    """
+    app.config.setdefault('DATABASE_FILE', DATABASE_FILE)
+    app.config.setdefault('UPLOAD_FOLDER', UPLOAD_FOLDER)
+    app.config.setdefault('DATABASE_READ_MODE', READ_MODE)
+    app.config.setdefault('DATABASE_SNAPSHOT_FILE', SNAPSHOT_FILE)
+    app.config.setdefault('DATABASE_SNAPSHOT_INTERVAL', SNAPSHOT_INTERVAL)
+    if app.config['DATABASE_READ_MODE'] not in (None, 'readonly', 'snapshot'):
+        raise ValueError(f"Unknown DATABASE_READ_MODE: {app.config['DATABASE_READ_MODE']!r}")
+
+    app.extensions['database'] = AppDatabase(app.config)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)  # Uploads arrive here first
+    app.after_request(_remember_write)
+    app.teardown_appcontext(close_db)
+
+
 # Database Setup
-def init_db():
-    """Create the database tables if they don't exist"""
-    conn = get_db_connection()
+def guess_mime_type(filename, media_type):
+    """Content-Type for an uploaded file, worked out once when it is stored"""
+    mime_type, _ = mimetypes.guess_type(filename)
+    if mime_type is None:
+        extension = os.path.splitext(filename)[1].lstrip('.').lower()
+        mime_type = f'{media_type}/{extension}' if extension else 'application/octet-stream'
+    return mime_type
+
+
+def _backfill_mime_types(conn):
+    cursor = conn.execute('SELECT id, filename, media_type FROM media')
+    while rows := cursor.fetchmany(MEDIA_BATCH_SIZE):
+        conn.executemany('UPDATE media SET mime_type = ? WHERE id = ?',
+                         [(guess_mime_type(row['filename'], row['media_type']), row['id'])
+                          for row in rows])
+
 
-    # Posts table: stores blog post content
-    conn.execute('''
+def make_excerpt(content, length=EXCERPT_LENGTH):
+    """The start of a post's content for listings, cut at a word boundary
+    Args:
+        content: The post's full content
+        length: Longest excerpt to return, not counting the trailing '...'
+    Returns:
+        The content itself if it is short enough, otherwise its first words
+        followed by '...'
+    """
+    content = ' '.join(content.split())
+    if len(content) <= length:
+        return content
+    cut = content.rfind(' ', 0, length + 1)
+    if cut <= 0:
+        cut = length  # One very long word; cut it rather than show nothing
+    return content[:cut].rstrip(' .,;:!?') + '...'
+
+
+def _backfill_excerpts(conn):
+    cursor = conn.execute('SELECT id, content FROM posts')
+    while rows := cursor.fetchmany(MEDIA_BATCH_SIZE):
+        conn.executemany('UPDATE posts SET excerpt = ? WHERE id = ?',
+                         [(make_excerpt(row['content']), row['id']) for row in rows])
+
+
+# Schema migrations, applied in order. Each entry is (description, steps),
+# where a step is an SQL statement or a function that takes the connection.
+# The schema_version table remembers how many have run, so only ever add
+# new migrations to the end of this list.
+MIGRATIONS = [
+    ('Create the posts and media tables', [
+        # Posts table: stores blog post content
+        '''
         CREATE TABLE IF NOT EXISTS posts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL,
             content TEXT NOT NULL,
             created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-
-    # Media table: tracks files associated with posts
-    conn.execute('''
+        ''',
+        # Media table: tracks files associated with posts
+        '''
         CREATE TABLE IF NOT EXISTS media (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             post_id INTEGER NOT NULL,
@@ -43,16 +547,258 @@ def init_db():
             created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE
         )
-    ''')
+        ''',
+    ]),
+    ('Index media by post and posts by date', [
+        'CREATE INDEX IF NOT EXISTS idx_media_post ON media (post_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_posts_created ON posts (created_at DESC, id DESC)',
+    ]),
+    ('Add full-text search over post titles and content', [
+        # External content table: the text lives in posts, FTS5 keeps the index
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts
+        USING fts5(title, content, content='posts', content_rowid='id')
+        ''',
+        # Triggers keep the index in step with every insert, update and delete
+        '''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+            INSERT INTO posts_fts (rowid, title, content)
+            VALUES (new.id, new.title, new.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, content)
+            VALUES ('delete', old.id, old.title, old.content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, content ON posts BEGIN
+            INSERT INTO posts_fts (posts_fts, rowid, title, content)
+            VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO posts_fts (rowid, title, content)
+            VALUES (new.id, new.title, new.content);
+        END
+        ''',
+        # Index the posts that existed before this migration
+        "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+    ]),
+    ('Track when posts and the blog as a whole last changed', [
+        # ALTER TABLE can't default to the current time, so fill it in here
+        'ALTER TABLE posts ADD COLUMN updated_at TIMESTAMP',
+        'UPDATE posts SET updated_at = created_at',
+        # A single row that changes whenever any post or media changes, so
+        # "has the listing changed?" is one primary key lookup
+        '''
+        CREATE TABLE IF NOT EXISTS blog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+        ''',
+        f'INSERT OR IGNORE INTO blog_state (id, version, updated_at) VALUES (1, 1, {NOW})',
+        *[
+            f'''
+            CREATE TRIGGER IF NOT EXISTS blog_state_{table}_{event} AFTER {event} ON {table} BEGIN
+                UPDATE blog_state SET version = version + 1, updated_at = {NOW} WHERE id = 1;
+            END
+            '''
+            for table in ('posts', 'media')
+            for event in ('INSERT', 'UPDATE', 'DELETE')
+        ],
+    ]),
+    ('Store media content once, named by its SHA-256', [
+        # One row per distinct file; filename is its path under UPLOAD_FOLDER
+        '''
+        CREATE TABLE IF NOT EXISTS media_blobs (
+            sha256 TEXT PRIMARY KEY,
+            filename TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Older media rows keep blob_sha256 NULL and own their file outright
+        'ALTER TABLE media ADD COLUMN blob_sha256 TEXT REFERENCES media_blobs (sha256)',
+        'CREATE INDEX IF NOT EXISTS idx_media_blob ON media (blob_sha256)',
+        'CREATE INDEX IF NOT EXISTS idx_media_blobs_unused ON media_blobs (ref_count) WHERE ref_count <= 0',
+        # Triggers count references, including deletes cascaded from posts
+        '''
+        CREATE TRIGGER IF NOT EXISTS media_blobs_ref AFTER INSERT ON media
+        WHEN new.blob_sha256 IS NOT NULL BEGIN
+            UPDATE media_blobs SET ref_count = ref_count + 1 WHERE sha256 = new.blob_sha256;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS media_blobs_unref AFTER DELETE ON media
+        WHEN old.blob_sha256 IS NOT NULL BEGIN
+            UPDATE media_blobs SET ref_count = ref_count - 1 WHERE sha256 = old.blob_sha256;
+        END
+        ''',
+    ]),
+    ('Record resized copies of uploaded images', [
+        # source is the original's filename, so posts sharing a file share
+        # its variants too
+        '''
+        CREATE TABLE IF NOT EXISTS media_variants (
+            source TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            format TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            PRIMARY KEY (source, format, width)
+        )
+        ''',
+        # Lets add_media_variant() check that an original is still in use
+        'CREATE INDEX IF NOT EXISTS idx_media_filename ON media (filename)',
+    ]),
+    ('Add a job queue for work done after the request', [
+        # run_at is a Unix timestamp. Claiming a job pushes it into the
+        # future, so a job whose worker died is picked up again later.
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_run_at ON jobs (run_at)',
+        # Jobs that kept failing end up here for someone to look at
+        '''
+        CREATE TABLE IF NOT EXISTS dead_jobs (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL,
+            failed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    ('Remember indexes and triggers dropped during a bulk import', [
+        '''
+        CREATE TABLE IF NOT EXISTS deferred_schema (
+            name TEXT PRIMARY KEY,
+            sql TEXT NOT NULL
+        )
+        ''',
+    ]),
+    ('Store each media file\'s Content-Type', [
+        'ALTER TABLE media ADD COLUMN mime_type TEXT',
+        _backfill_mime_types,
+    ]),
+    ('Precompute post excerpts for the listings', [
+        "ALTER TABLE posts ADD COLUMN excerpt TEXT NOT NULL DEFAULT ''",
+        _backfill_excerpts,
+        # Covers the listing query, so a page of posts is read from the index
+        # alone and their full content is never loaded
+        '''
+        CREATE INDEX IF NOT EXISTS idx_posts_listing
+        ON posts (created_at DESC, id DESC, title, excerpt, updated_at)
+        ''',
+        'DROP INDEX IF EXISTS idx_posts_created',
+    ]),
+    ('Index resized copies by filename for the storage garbage collector', [
+        'CREATE INDEX IF NOT EXISTS idx_media_variants_filename ON media_variants (filename)',
+    ]),
+    ('Track files being stored or deleted outside the write lock', [
+        # upload is the temporary file being stored as filename, or NULL
+        # while filename is being deleted. claimed_at is a Unix timestamp.
+        '''
+        CREATE TABLE IF NOT EXISTS storage_claims (
+            filename TEXT NOT NULL,
+            upload TEXT,
+            claimed_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_storage_claims_filename ON storage_claims (filename)',
+        'CREATE INDEX IF NOT EXISTS idx_storage_claims_upload ON storage_claims (upload)',
+    ]),
+]
 
-    conn.commit()
-    conn.close()
+
+def init_db():
+    """Create the database tables if they don't exist, then migrate them"""
+    with write() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    # One transaction per migration, so a failure leaves earlier ones applied
+    for version, (description, steps) in enumerate(MIGRATIONS, start=1):
+        with write() as conn:
+            if version <= get_schema_version(conn):
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                         (version, description))
+
+    # Finish off a bulk import that was interrupted
+    restore_deferred_schema()
+
+
+def get_schema_version(conn):
+    """Get the number of the last migration applied to the database"""
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def defer_schema(conn, tables):
+    """Drop the secondary indexes and triggers on some tables until later
+
+    Bulk loads run much faster without them. What was dropped is saved in
+    deferred_schema in the same transaction, so restore_deferred_schema()
+    can put it back even after a crash.
+    """
+    placeholders = ', '.join('?' * len(tables))
+    deferred = conn.execute(f'''
+        SELECT {WHOLE_TABLE} type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+          AND tbl_name IN ({placeholders})
+    ''', list(tables)).fetchall()
+
+    for item in deferred:
+        conn.execute('INSERT INTO deferred_schema (name, sql) VALUES (?, ?)',
+                     (item['name'], item['sql']))
+        conn.execute(f"DROP {item['type'].upper()} {item['name']}")
+
+
+def restore_deferred_schema():
+    """Recreate everything defer_schema() dropped and catch up on what it missed"""
+    with write() as conn:
+        deferred = conn.execute(f'SELECT {WHOLE_TABLE} name, sql FROM deferred_schema').fetchall()
+        if not deferred:
+            return
+        for item in deferred:
+            conn.execute(item['sql'])
+        conn.execute('DELETE FROM deferred_schema')
+
+        # Work the dropped triggers would have done row by row
+        conn.execute(f'''
+            UPDATE {WHOLE_TABLE} media_blobs SET ref_count = (
+                SELECT COUNT(*) FROM media WHERE media.blob_sha256 = media_blobs.sha256
+            )
+        ''')
+        unused_files = drop_unused_blobs(conn)  # Deleted while the import ran
+        if unused_files:
+            enqueue_job('remove_media_files', {'filenames': unused_files})
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+        conn.execute(f'UPDATE blog_state SET version = version + 1, updated_at = {NOW} WHERE id = 1')
 
 
 def seed_sample_data():
     """Add example blog posts to get started"""
-    conn = get_db_connection()
-
     sample_posts = [
         (
             "My First Blog Post",
@@ -71,130 +817,1158 @@ def seed_sample_data():
         )
     ]
 
-    conn.executemany(
-        'INSERT INTO posts (title, content, created_at) VALUES (?, ?, ?)',
-        sample_posts
-    )
-    conn.commit()
-    conn.close()
+    with write() as conn:
+        conn.executemany(
+            'INSERT INTO posts (title, content, excerpt, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            [(title, content, make_excerpt(content), created_at, created_at)
+             for title, content, created_at in sample_posts]
+        )
+
+
+# Models
+class Record:
+    """A row stored in __slots__ rather than a dict, which takes far less memory
+
+    Fields can be read as record.title or record['title'] and set either way,
+    so templates and code written for dicts keep working. Columns that the
+    query didn't select are missing, like keys missing from a dict. Queries
+    name their columns (see POST_COLUMNS), so a column added to a table
+    later doesn't need a slot until something selects it.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def row_factory(cls, cursor):
+        """A row_factory that turns the rows of cursor's query into records
+        Raises:
+            ValueError: If the query selects a column the class has no slot for
+        """
+        # Looked up once per query rather than once per row
+        names = [column[0] for column in cursor.description]
+        unknown = [name for name in names if name not in cls.__slots__]
+        if unknown:
+            raise ValueError(f"{cls.__name__} has no slot for column(s) {', '.join(unknown)}")
+        new = cls.__new__
+
+        def make_record(cursor, row):
+            record = new(cls)
+            for name, value in zip(names, row):
+                setattr(record, name, value)
+            return record
+        return make_record
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def __repr__(self):
+        fields = ', '.join(f'{key}={self[key]!r}' for key in self.keys())
+        return f'{type(self).__name__}({fields})'
+
+
+class Post(Record):
+    """A blog post; media is filled in by attach_media()"""
+    __slots__ = ('id', 'title', 'content', 'excerpt', 'created_at', 'updated_at', 'media')
+
+
+class Media(Record):
+    """A media item; variants is filled in by attach_variants()"""
+    __slots__ = ('id', 'post_id', 'filename', 'media_type', 'mime_type', 'blob_sha256',
+                 'created_at', 'variants')
+
+
+# The columns loaded into each record, one per slot except the filled-in lists
+POST_COLUMNS = 'id, title, content, excerpt, created_at, updated_at'
+MEDIA_COLUMNS = 'id, post_id, filename, media_type, mime_type, blob_sha256, created_at'
+
+
+def fetch_records(conn, record_class, sql, parameters=()):
+    """Run a SELECT and return its rows as record_class objects"""
+    cursor = conn.execute(sql, parameters)
+    # Rows are only built when fetched, and by now the column names are known
+    cursor.row_factory = record_class.row_factory(cursor)
+    return cursor.fetchall()
 
 
 # Post Operations
+# What the listings show of each post. Full content is only loaded by
+# get_post(), so long posts don't slow down the home page.
+LISTING_COLUMNS = 'id, title, excerpt, created_at, updated_at'
+
+
 def get_all_posts():
-    """Get all posts with their media, newest first"""
-    conn = get_db_connection()
-    posts = conn.execute('SELECT * FROM posts ORDER BY created_at DESC').fetchall()
+    """Get all posts (without their full content) with their media, newest first"""
+    with connection() as conn:
+        posts = fetch_records(conn, Post, f'''
+            SELECT {WHOLE_TABLE} {LISTING_COLUMNS} FROM posts ORDER BY created_at DESC, id DESC
+        ''')
+        return attach_media(conn, posts)
 
-    # Add media to each post
-    for post in posts:
-        post = dict(post)
-        post['media'] = get_post_media(post['id'])
 
-    conn.close()
-    return posts
+def get_posts_page(before=None, after=None, limit=POSTS_PER_PAGE):
+    """Get one page of posts with their media, newest first
+
+    Pages are found by (created_at, id) instead of OFFSET, so page 1000 costs
+    the same as page 1. Posts have an excerpt instead of their full content.
+    Args:
+        before: A cursor; return the posts just older than that post
+        after: A cursor; return the posts just newer than that post
+        limit: Maximum number of posts on the page
+    Returns:
+        (posts, prev_cursor, next_cursor). A cursor is None when there is no
+        page in that direction.
+    Raises:
+        ValueError: If a cursor can't be parsed
+    """
+    with connection() as conn:
+        if after is not None:
+            # Walk forwards in time, then flip back to newest first
+            rows = fetch_records(conn, Post, f'''
+                SELECT {LISTING_COLUMNS} FROM posts
+                WHERE (created_at, id) > (?, ?)
+                ORDER BY created_at, id
+                LIMIT ?
+            ''', (*parse_cursor(after), limit + 1))
+            has_newer, has_older = len(rows) > limit, True
+            rows = rows[:limit][::-1]
+        else:
+            if before is not None:
+                rows = fetch_records(conn, Post, f'''
+                    SELECT {LISTING_COLUMNS} FROM posts
+                    WHERE (created_at, id) < (?, ?)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (*parse_cursor(before), limit + 1))
+            else:
+                rows = fetch_records(conn, Post, f'''
+                    SELECT {FIRST_ROWS} {LISTING_COLUMNS} FROM posts
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (limit + 1,))
+            has_newer, has_older = before is not None, len(rows) > limit
+            rows = rows[:limit]
+
+        posts = attach_media(conn, rows)
+
+    prev_cursor = make_cursor(posts[0]) if posts and has_newer else None
+    next_cursor = make_cursor(posts[-1]) if posts and has_older else None
+    return posts, prev_cursor, next_cursor
+
+
+def make_cursor(post):
+    """Build the page cursor that points at a post"""
+    return f"{post['created_at']}_{post['id']}"
+
+
+def parse_cursor(cursor):
+    """Split a page cursor back into (created_at, id)"""
+    created_at, _, post_id = cursor.rpartition('_')
+    if not created_at:
+        raise ValueError(f'Invalid page cursor: {cursor!r}')
+    return created_at, int(post_id)
 
 
 def get_post(post_id):
     """Get a single post and its media by ID"""
-    conn = get_db_connection()
-    post = conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+    with connection() as conn:
+        posts = attach_media(conn, fetch_records(
+            conn, Post, f'SELECT {POST_COLUMNS} FROM posts WHERE id = ?', (post_id,)))
+        return posts[0] if posts else None
 
-    if post:
-        post = dict(post)
-        post['media'] = get_post_media(post['id'])
 
-    conn.close()
-    return post
+def attach_media(conn, posts):
+    """Fill in each post's media list, loading all media at once
+    Args:
+        conn: An open database connection
+        posts: Post records from fetch_records()
+    Returns:
+        The same list of posts
+    """
+    if not posts:
+        return posts
+
+    # One query per batch of posts instead of one query per post. Batches keep
+    # us under SQLite's limit on the number of ? parameters in one statement.
+    media_by_post = {post.id: [] for post in posts}
+    post_ids = list(media_by_post)
+    for start in range(0, len(post_ids), MEDIA_BATCH_SIZE):
+        batch = post_ids[start:start + MEDIA_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+        media_rows = fetch_records(conn, Media, f'''
+            SELECT {MEDIA_COLUMNS} FROM media
+            WHERE post_id IN ({placeholders})
+            ORDER BY created_at
+        ''', batch)
+
+        for media in media_rows:
+            media.variants = []
+            media_by_post[media.post_id].append(media)
+
+    attach_variants(conn, [media for post_media in media_by_post.values()
+                           for media in post_media])
+
+    for post in posts:
+        post.media = media_by_post[post.id]
+    return posts
+
+
+def attach_variants(conn, media_list):
+    """Fill in each media item's variants list (smallest first) in one query per batch"""
+    by_source = {}
+    for media in media_list:
+        by_source.setdefault(media.filename, []).append(media)
+
+    sources = list(by_source)
+    for start in range(0, len(sources), MEDIA_BATCH_SIZE):
+        batch = sources[start:start + MEDIA_BATCH_SIZE]
+        placeholders = ', '.join('?' * len(batch))
+        for variant in conn.execute(f'''
+            SELECT * FROM media_variants
+            WHERE source IN ({placeholders})
+            ORDER BY source, format, width
+        ''', batch):
+            for media in by_source[variant['source']]:
+                media.variants.append(variant)
 
 
 def create_post(title, content):
     """Create a new post and return its ID"""
-    conn = get_db_connection()
-    cursor = conn.execute('INSERT INTO posts (title, content) VALUES (?, ?)',
-                          (title, content))
-    post_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return post_id
+    with write() as conn:
+        cursor = conn.execute(f'''
+            INSERT INTO posts (title, content, excerpt, updated_at)
+            VALUES (?, ?, ?, {NOW})
+        ''', (title, content, make_excerpt(content)))
+        return cursor.lastrowid
 
 
 def update_post(post_id, title, content):
     """Update a post's title and content"""
-    conn = get_db_connection()
-    conn.execute('UPDATE posts SET title = ?, content = ? WHERE id = ?',
-                 (title, content, post_id))
-    conn.commit()
-    conn.close()
+    with write() as conn:
+        conn.execute(f'''
+            UPDATE posts SET title = ?, content = ?, excerpt = ?, updated_at = {NOW}
+            WHERE id = ?
+        ''', (title, content, make_excerpt(content), post_id))
+
+
+def touch_post(conn, post_id):
+    """Mark a post as changed, e.g. because its media changed"""
+    conn.execute(f'UPDATE posts SET updated_at = {NOW} WHERE id = ?', (post_id,))
+
+
+def get_post_updated_at(post_id):
+    """Get when a post last changed, or None if it doesn't exist
+
+    This is a single primary key lookup, cheap enough to run before deciding
+    whether a page needs rendering at all.
+    """
+    with connection() as conn:
+        row = conn.execute('SELECT updated_at FROM posts WHERE id = ?', (post_id,)).fetchone()
+        return row['updated_at'] if row else None
+
+
+def get_blog_state():
+    """Get the (version, updated_at) pair that changes whenever any post does"""
+    with connection() as conn:
+        row = conn.execute('SELECT version, updated_at FROM blog_state WHERE id = 1').fetchone()
+        return row['version'], row['updated_at']
 
 
 def delete_post(post_id):
     """Delete a post and all its associated media"""
-    # Get media files before deleting the post
-    media_files = get_post_media(post_id)
+    with write() as conn:
+        # Get files that belong only to this post before deleting it
+        unused_files = [media['filename'] for media in conn.execute(
+            'SELECT filename FROM media WHERE post_id = ? AND blob_sha256 IS NULL',
+            (post_id,))]
 
-    # Delete post (cascades to media table)
-    conn = get_db_connection()
-    conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
-    conn.commit()
-    conn.close()
+        # Delete post (cascades to media table, which lowers blob ref counts)
+        conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+        unused_files += drop_unused_blobs(conn)
+
+        # Clean up media files from storage after the request
+        if unused_files:
+            enqueue_job('remove_media_files', {'filenames': unused_files})
+
+
+# Search
+# Markers put around matching words by search_posts(). They are control
+# characters so they can never clash with text typed into a post.
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
 
-    # Clean up media files from storage
-    for media in media_files:
-        file_path = os.path.join(UPLOAD_FOLDER, media['filename'])
-        if os.path.exists(file_path):
-            os.remove(file_path)
+
+def search_posts(query, page=1, per_page=POSTS_PER_PAGE):
+    """Full-text search over post titles and content, best matches first
+    Args:
+        query: Words to look for; a post must contain all of them
+        page: Which page of results to return, starting at 1
+        per_page: Results per page
+    Returns:
+        (results, has_more). Each result has the post's id and created_at,
+        plus title and snippet with matches wrapped in HIGHLIGHT_START and
+        HIGHLIGHT_END.
+    """
+    # Quote every word so punctuation can't be read as FTS5 query syntax
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    if not words:
+        return [], False
+
+    with connection() as conn:
+        results = conn.execute('''
+            SELECT posts.id, posts.created_at,
+                   highlight(posts_fts, 0, ?, ?) AS title,
+                   snippet(posts_fts, 1, ?, ?, '...', 32) AS snippet
+            FROM posts_fts
+            JOIN posts ON posts.id = posts_fts.rowid
+            WHERE posts_fts MATCH ?
+            ORDER BY bm25(posts_fts, 10.0, 1.0)  -- Title matches count more
+            LIMIT ? OFFSET ?
+        ''', (HIGHLIGHT_START, HIGHLIGHT_END, HIGHLIGHT_START, HIGHLIGHT_END,
+              ' '.join(words), per_page + 1, (page - 1) * per_page)).fetchall()
+
+    return results[:per_page], len(results) > per_page
+
+
+def rebuild_search_index():
+    """Rebuild the search index from the posts table and compact it"""
+    with write() as conn:
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO posts_fts (posts_fts) VALUES ('optimize')")
 
 
 # Media Operations
 def add_media(post_id, filename, media_type):
     """Add a new media record for a post"""
-    conn = get_db_connection()
-    conn.execute('''
-        INSERT INTO media (post_id, filename, media_type)
-        VALUES (?, ?, ?)
-    ''', (post_id, filename, media_type))
-    conn.commit()
-    conn.close()
+    with write() as conn:
+        conn.execute('''
+            INSERT INTO media (post_id, filename, media_type, mime_type)
+            VALUES (?, ?, ?, ?)
+        ''', (post_id, filename, media_type, guess_mime_type(filename, media_type)))
+        touch_post(conn, post_id)
+
+
+def add_media_file(post_id, temp_path, sha256, size, extension, media_type):
+    """Store an uploaded file and attach it to a post, keeping each distinct
+    file only once
+
+    Runs stage_media() and add_media_many() for one file, so it must not be
+    called inside a transaction.
+    Args:
+        post_id: The post to attach the file to
+        temp_path: Where the upload is now; it is moved or deleted
+        sha256: Hex SHA-256 of the file's content
+        size: File size in bytes
+        extension: File extension including the dot, e.g. '.png'
+        media_type: 'image' or 'video'
+    Returns:
+        The file's name in STORAGE
+    """
+    uploads = [(temp_path, sha256, size, extension, media_type)]
+    try:
+        stage_media(uploads)
+        return add_media_many(post_id, uploads)[0]
+    except BaseException:
+        discard_staged_media(uploads)
+        raise
+
+
+# Storing a file can mean a slow upload, so it happens outside the write
+# lock, and so do deletes. A row in storage_claims stops the two racing:
+# stage_media() claims each file it stores, and remove_media_files() and
+# remove_unreferenced_files() skip claimed files. They claim the files they
+# delete in turn, and stage_media() waits for those claims to go.
+STORAGE_CLAIM_SECONDS = 300  # An older claim was left by a crash and is ignored
+STORAGE_CLAIM_POLL = 0.05  # Seconds between checks while a delete finishes
+
+
+def stage_media(uploads, pool=None):
+    """Move uploaded files into storage ahead of add_media_many()
+
+    Each file is claimed first, then moved (a rename for local storage, an
+    upload for S3) with no lock held. A file whose content is stored
+    already is just deleted.
+    Args:
+        uploads: (temp_path, sha256, size, extension, media_type) tuples, as
+            described in add_media_file()
+        pool: An executor to store several files at once, e.g. for bulk.py
+    Raises:
+        RuntimeError: If called inside a transaction, where it would hold
+            the write lock for the whole upload
+    """
+    if not uploads:
+        return
+    with connection() as conn:
+        if conn.in_transaction:
+            raise RuntimeError('stage_media() must run before the transaction, not inside it')
+
+    hashes = list({upload[1] for upload in uploads})
+    while True:
+        with write() as conn:
+            # Claim the name the content is stored under, if it is already
+            known = dict(conn.execute(f'''
+                SELECT sha256, filename FROM media_blobs
+                WHERE sha256 IN ({', '.join('?' * len(hashes))})
+            ''', hashes).fetchall())
+            claims = [(known.get(sha256) or blob_filename(sha256, extension), temp_path)
+                      for temp_path, sha256, size, extension, media_type in uploads]
+            names = sorted({name for name, _ in claims})
+            placeholders = ', '.join('?' * len(names))
+            now = time.time()
+            conn.execute(f'''
+                DELETE FROM storage_claims WHERE filename IN ({placeholders}) AND claimed_at < ?
+            ''', [*names, now - STORAGE_CLAIM_SECONDS])
+            if not conn.execute(f'''
+                SELECT 1 FROM storage_claims WHERE filename IN ({placeholders}) AND upload IS NULL
+            ''', names).fetchone():
+                conn.executemany(
+                    'INSERT INTO storage_claims (filename, upload, claimed_at) VALUES (?, ?, ?)',
+                    [(name, temp_path, now) for name, temp_path in claims])
+                break
+        # The same content is being deleted right now; store it once that's done
+        time.sleep(STORAGE_CLAIM_POLL)
+
+    new_files = {}
+    for (name, temp_path), upload in zip(claims, uploads):
+        if upload[1] in known or upload[1] in new_files:
+            os.remove(temp_path)  # Stored already, for another post or earlier in this batch
+        else:
+            new_files[upload[1]] = (temp_path, name)
+    media_storage = settings().STORAGE
+    list((pool.map if pool else map)(lambda new_file: media_storage.put(*new_file),
+                                     new_files.values()))
+
+
+def discard_staged_media(uploads):
+    """Clean up after the transaction that was to record some uploads failed
+
+    Removes their temporary files, their claims and any copy stage_media()
+    put in storage, unless the database points at it (the same file may
+    have been uploaded again meanwhile). Safe to call more than once.
+    Args:
+        uploads: The tuples given to stage_media() and add_media_many()
+    """
+    if not uploads:
+        return
+    for upload in uploads:
+        try:
+            os.remove(upload[0])
+        except FileNotFoundError:
+            pass  # Moved into storage already
+    temp_paths = [upload[0] for upload in uploads]
+    names = {blob_filename(upload[1], upload[3]) for upload in uploads}
+    with write() as conn:
+        names.update(row['filename'] for row in conn.execute(f'''
+            SELECT filename FROM storage_claims WHERE upload IN ({', '.join('?' * len(temp_paths))})
+        ''', temp_paths))
+        conn.executemany('DELETE FROM storage_claims WHERE upload = ?',
+                         [(path,) for path in temp_paths])
+    remove_unreferenced_files(sorted(names))
+
+
+def add_media_many(post_id, uploads):
+    """Attach several staged files to a post with one batch of inserts
+
+    Only the database is touched: call stage_media() first, outside the
+    transaction, to put the files in storage.
+    Args:
+        post_id: The post to attach the files to
+        uploads: (temp_path, sha256, size, extension, media_type) tuples, as
+            described in add_media_file()
+    Returns:
+        Each file's name in STORAGE, in the same order
+    """
+    if not uploads:
+        return []
+
+    with write() as conn:
+        filenames = record_staged_blobs(conn, uploads)
+        conn.executemany('''
+            INSERT INTO media (post_id, filename, media_type, mime_type, blob_sha256)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(post_id, filename, upload[4], guess_mime_type(filename, upload[4]), upload[1])
+              for filename, upload in zip(filenames, uploads)])
+        touch_post(conn, post_id)
+    return filenames
+
+
+def record_staged_blobs(conn, uploads):
+    """Add a media_blobs row for each new file stage_media() stored, and drop
+    the uploads' claims now that the rows keep the files safe
+    Args:
+        conn: A connection inside write()
+        uploads: The tuples given to stage_media()
+    Returns:
+        Each upload's filename in STORAGE, in the same order. A file stored
+        meanwhile under another extension is shared, and the staged copy is
+        left for maintenance.py to collect.
+    """
+    if not uploads:
+        return []
+    hashes = list({upload[1] for upload in uploads})
+    placeholders = ', '.join('?' * len(hashes))
+    stored = dict(conn.execute(
+        f'SELECT sha256, filename FROM media_blobs WHERE sha256 IN ({placeholders})',
+        hashes).fetchall())
+
+    temp_paths = [upload[0] for upload in uploads]
+    claimed = dict(conn.execute(f'''
+        SELECT upload, filename FROM storage_claims WHERE upload IN ({', '.join('?' * len(temp_paths))})
+    ''', temp_paths).fetchall())
+
+    new_blobs = []
+    for temp_path, sha256, size, extension, media_type in uploads:
+        if sha256 not in stored:
+            # Where stage_media() stored it
+            stored[sha256] = claimed.get(temp_path) or blob_filename(sha256, extension)
+            new_blobs.append((sha256, stored[sha256], size))
+    conn.executemany('INSERT INTO media_blobs (sha256, filename, size) VALUES (?, ?, ?)',
+                     new_blobs)
+    conn.executemany('DELETE FROM storage_claims WHERE upload = ?', [(path,) for path in temp_paths])
+    return [stored[upload[1]] for upload in uploads]
+
+
+def blob_filename(sha256, extension):
+    """Name for a file's content in STORAGE, e.g. 'ab/cd/abcd...png'
+
+    Two levels of sharding keep any one directory small.
+    """
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}{extension.lower()}'
+
+
+def drop_unused_blobs(conn):
+    """Delete blob rows that no media points at any more
+    Returns:
+        The filenames of the dropped blobs, for remove_media_files()
+    """
+    # During a bulk import the ref count triggers are dropped, so the counts
+    # are wrong until restore_deferred_schema() recounts them and drops the
+    # unused blobs itself. (deferred_schema holds a few rows at most.)
+    if conn.execute(f'SELECT {WHOLE_TABLE} 1 FROM deferred_schema LIMIT 1').fetchone():
+        return []
+    unused = conn.execute('''
+        SELECT sha256, filename FROM media_blobs WHERE ref_count <= 0
+    ''').fetchall()
+    conn.executemany('DELETE FROM media_blobs WHERE sha256 = ?',
+                     [(blob['sha256'],) for blob in unused])
+    return [blob['filename'] for blob in unused]
+
+
+def remove_media_files(filenames):
+    """Delete media files from storage
+
+    Skips any file that has been uploaded again since its blob was dropped,
+    or is being uploaded now, so a concurrent upload never loses its file.
+    The files are chosen and claimed under the write lock and deleted after
+    it is released.
+    """
+    if not filenames:
+        return
+    with write() as conn:
+        doomed = []
+        for filename in filenames:
+            if conn.execute('SELECT 1 FROM media_blobs WHERE filename = ?',
+                            (filename,)).fetchone():
+                continue
+            if conn.execute('SELECT 1 FROM storage_claims WHERE filename = ? AND claimed_at >= ?',
+                            (filename, time.time() - STORAGE_CLAIM_SECONDS)).fetchone():
+                continue
+            # Resized copies go with the original
+            variants = conn.execute('SELECT filename FROM media_variants WHERE source = ?',
+                                    (filename,)).fetchall()
+            conn.execute('DELETE FROM media_variants WHERE source = ?', (filename,))
+            doomed += [filename] + [variant['filename'] for variant in variants]
+        _claim_for_delete(conn, doomed)
+    _delete_claimed(doomed)  # One request per 1000 files on S3
+
+
+def _claim_for_delete(conn, filenames):
+    """Claim files that are about to be deleted, so stage_media() waits for
+    the delete instead of storing them again underneath it"""
+    now = time.time()
+    conn.executemany('INSERT INTO storage_claims (filename, upload, claimed_at) VALUES (?, NULL, ?)',
+                     [(filename, now) for filename in filenames])
+
+
+def _delete_claimed(filenames):
+    """Delete files claimed by _claim_for_delete(), then drop their claims
+    Returns:
+        The filenames actually deleted
+    """
+    if not filenames:
+        return []
+    try:
+        return settings().STORAGE.delete(filenames)
+    finally:
+        with write() as conn:
+            conn.executemany('DELETE FROM storage_claims WHERE filename = ? AND upload IS NULL',
+                             [(filename,) for filename in filenames])
+
+
+def add_media_variant(source, width, image_format, filename):
+    """Record a resized copy of an image
+    Returns:
+        The IDs of the posts showing the original, whose pages have changed.
+        Empty if the original was deleted meanwhile, so the copy isn't needed.
+    """
+    with write() as conn:
+        post_ids = [row['post_id'] for row in conn.execute(
+            'SELECT DISTINCT post_id FROM media WHERE filename = ?', (source,))]
+        if not post_ids:
+            return []
+        conn.execute('''
+            INSERT OR REPLACE INTO media_variants (source, width, format, filename)
+            VALUES (?, ?, ?, ?)
+        ''', (source, width, image_format, filename))
+        for post_id in post_ids:
+            touch_post(conn, post_id)
+        return post_ids
+
+
+def get_media_variants(source):
+    """Get the resized copies recorded for an original file"""
+    with connection() as conn:
+        return conn.execute('''
+            SELECT * FROM media_variants WHERE source = ? ORDER BY format, width
+        ''', (source,)).fetchall()
+
+
+def get_media(media_id):
+    """Get a single media record by ID"""
+    with connection() as conn:
+        return conn.execute('SELECT * FROM media WHERE id = ?', (media_id,)).fetchone()
+
+
+def is_media_variant(filename):
+    """Whether a file in STORAGE is a recorded resized copy of an image"""
+    with connection() as conn:
+        return conn.execute('SELECT 1 FROM media_variants WHERE filename = ?',
+                            (filename,)).fetchone() is not None
+
+
+def get_media_mime_type(filename):
+    """Get the stored Content-Type of a file in STORAGE, or None if
+    no media record names it (e.g. a resized copy)"""
+    with connection() as conn:
+        row = conn.execute('SELECT mime_type FROM media WHERE filename = ? LIMIT 1',
+                           (filename,)).fetchone()
+        return row['mime_type'] if row else None
 
 
 def get_post_media(post_id):
     """Get all media associated with a post"""
-    conn = get_db_connection()
-    media = conn.execute('''
-        SELECT * FROM media
-        WHERE post_id = ?
-        ORDER BY created_at
-    ''', (post_id,)).fetchall()
-    conn.close()
-    return media
+    with connection() as conn:
+        return conn.execute('''
+            SELECT * FROM media
+            WHERE post_id = ?
+            ORDER BY created_at
+        ''', (post_id,)).fetchall()
 
 
 def delete_media(media_id):
     """Delete a single media file and its database record"""
-    conn = get_db_connection()
-
-    # Get filename before deleting record
-    media = conn.execute('SELECT filename FROM media WHERE id = ?', (media_id,)).fetchone()
+    with write() as conn:
+        # Get filename before deleting record
+        media = conn.execute('SELECT post_id, filename, blob_sha256 FROM media WHERE id = ?',
+                             (media_id,)).fetchone()
+        if media is None:
+            return
 
-    if media:
-        # Remove database record
+        # Remove database record; shared files stay until their last user goes
         conn.execute('DELETE FROM media WHERE id = ?', (media_id,))
-        conn.commit()
+        touch_post(conn, media['post_id'])
+        unused_files = drop_unused_blobs(conn)
+        if media['blob_sha256'] is None:
+            unused_files.append(media['filename'])
 
-        # Delete file from storage
-        file_path = os.path.join(UPLOAD_FOLDER, media['filename'])
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # Delete file from storage after the request
+        if unused_files:
+            enqueue_job('remove_media_files', {'filenames': unused_files})
 
-    conn.close()
 
+# Job Queue
+# The queue only stores jobs; jobs.py knows how to run each kind.
+JOB_MAX_ATTEMPTS = 5
+JOB_LEASE_SECONDS = 300  # A claimed job is retried if not finished by then
+
+_job_added = threading.Event()  # Wakes this process's workers early
+
+
+def enqueue_job(kind, payload, delay=0):
+    """Queue work to be done after the current transaction commits
+    Args:
+        kind: Name of a handler registered in jobs.py
+        payload: JSON-serializable dict of keyword arguments for the handler
+        delay: Seconds to wait before the job may run
+    """
+    with write() as conn:
+        conn.execute('INSERT INTO jobs (kind, payload, run_at) VALUES (?, ?, ?)',
+                     (kind, json.dumps(payload), time.time() + delay))
+    _job_added.set()
+
+
+def claim_job():
+    """Take the next job that is due, or None if there isn't one
+
+    The job stays in the table until finish_job() or fail_job(), so it is
+    retried if this worker dies.
+    """
+    with write() as conn:
+        now = time.time()
+        job = conn.execute('''
+            SELECT * FROM jobs WHERE run_at <= ? ORDER BY run_at LIMIT 1
+        ''', (now,)).fetchone()
+        if job is None:
+            return None
+        conn.execute('UPDATE jobs SET run_at = ?, attempts = attempts + 1 WHERE id = ?',
+                     (now + JOB_LEASE_SECONDS, job['id']))
+        return dict(job, payload=json.loads(job['payload']), attempts=job['attempts'] + 1)
+
+
+def finish_job(job_id):
+    """Remove a job that ran successfully"""
+    with write() as conn:
+        conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+
+def fail_job(job, error):
+    """Schedule a failed job for another try, or move it to dead_jobs
+    Args:
+        job: The dict returned by claim_job()
+        error: Text describing what went wrong
+    """
+    with write() as conn:
+        if job['attempts'] >= JOB_MAX_ATTEMPTS:
+            conn.execute('''
+                INSERT INTO dead_jobs (id, kind, payload, attempts, last_error, created_at)
+                SELECT id, kind, payload, attempts, ?, created_at FROM jobs WHERE id = ?
+            ''', (error, job['id']))
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+        else:
+            # Back off: 2s, 4s, 8s, ...
+            conn.execute('UPDATE jobs SET run_at = ?, last_error = ? WHERE id = ?',
+                         (time.time() + 2 ** job['attempts'], error, job['id']))
+
+
+def wait_for_jobs(timeout):
+    """Sleep until a job is queued by this process or timeout seconds pass"""
+    _job_added.wait(timeout)
+    _job_added.clear()
+
+
+def retry_dead_jobs():
+    """Put every dead job back on the queue
+    Returns:
+        How many jobs were requeued
+    """
+    with write() as conn:
+        cursor = conn.execute('''
+            INSERT INTO jobs (kind, payload, run_at, created_at)
+            SELECT kind, payload, ?, created_at FROM dead_jobs
+        ''', (time.time(),))
+        conn.execute('DELETE FROM dead_jobs')
+        return cursor.rowcount
+
+
+# Storage Maintenance
+# maintenance.py does the file system side of these, in parallel.
+def get_unsharded_media(after='', limit=MEDIA_BATCH_SIZE):
+    """Get the next batch of files uploaded before media was content-addressed
+    Args:
+        after: Only return filenames that sort after this one
+        limit: Most filenames to return
+    Returns:
+        Distinct paths under UPLOAD_FOLDER, in order
+    """
+    with connection() as conn:
+        return [row['filename'] for row in conn.execute('''
+            SELECT DISTINCT filename FROM media
+            WHERE blob_sha256 IS NULL AND filename > ?
+            ORDER BY filename
+            LIMIT ?
+        ''', (after, limit))]
+
+
+def _link_or_copy(source, target):
+    """Give a file a second name, copying it where hard links aren't supported"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass  # Named by content, so whatever is there already is the same
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def shard_media(hashed):
+    """Move old flat uploads into the content-addressed layout of blob_filename()
+
+    Each file is linked at its new path and its media and variant rows are
+    updated in one transaction. The old names are removed only after it
+    commits, so nothing ever points at a missing file. Those uploads predate
+    storage.py, so this works on UPLOAD_FOLDER directly (LocalStorage only).
+    Args:
+        hashed: (filename, sha256, size) tuples for files from get_unsharded_media()
+    Returns:
+        How many files were moved
+    """
+    upload_folder = settings().UPLOAD_FOLDER
+    moved = 0
+    old_files = []
+    with write() as conn:
+        for filename, sha256, size in hashed:
+            # Deleted since it was hashed? remove_media_files() takes the
+            # write lock too, so this can't change under us now
+            if not conn.execute('SELECT 1 FROM media WHERE filename = ? AND blob_sha256 IS NULL',
+                                (filename,)).fetchone():
+                continue
+
+            blob = conn.execute('SELECT filename FROM media_blobs WHERE sha256 = ?',
+                                (sha256,)).fetchone()
+            if blob is None:
+                new_filename = blob_filename(sha256, os.path.splitext(filename)[1])
+                if conn.execute('SELECT 1 FROM storage_claims WHERE filename = ? AND upload IS NULL',
+                                (new_filename,)).fetchone():
+                    continue  # Its last copy is being deleted; try again next time
+                _link_or_copy(os.path.join(upload_folder, filename),
+                              os.path.join(upload_folder, new_filename))
+                conn.execute('INSERT INTO media_blobs (sha256, filename, size) VALUES (?, ?, ?)',
+                             (sha256, new_filename, size))
+            else:
+                new_filename = blob['filename']  # Uploaded again since; share that copy
+
+            # Resized copies follow the original, named the way thumbnails.py names them
+            base = os.path.splitext(new_filename)[0]
+            variants = conn.execute('SELECT * FROM media_variants WHERE source = ?',
+                                    (filename,)).fetchall()
+            for variant in variants:
+                key = (variant['format'], variant['width'])
+                if conn.execute('SELECT 1 FROM media_variants WHERE source = ? AND format = ? '
+                                'AND width = ?', (new_filename, *key)).fetchone():
+                    conn.execute('DELETE FROM media_variants WHERE source = ? AND format = ? '
+                                 'AND width = ?', (filename, *key))
+                else:
+                    new_variant = f"{base}_w{variant['width']}.{variant['format']}"
+                    _link_or_copy(os.path.join(upload_folder, variant['filename']),
+                                  os.path.join(upload_folder, new_variant))
+                    conn.execute('UPDATE media_variants SET source = ?, filename = ? '
+                                 'WHERE source = ? AND format = ? AND width = ?',
+                                 (new_filename, new_variant, filename, *key))
+                old_files.append(variant['filename'])
+
+            # The ref count triggers only see inserts and deletes
+            count = conn.execute('''
+                UPDATE media SET filename = ?, blob_sha256 = ?
+                WHERE filename = ? AND blob_sha256 IS NULL
+            ''', (new_filename, sha256, filename)).rowcount
+            conn.execute('UPDATE media_blobs SET ref_count = ref_count + ? WHERE sha256 = ?',
+                         (count, sha256))
+            # Cached pages and fragments still have the old URLs
+            conn.execute(f'''
+                UPDATE posts SET updated_at = {NOW}
+                WHERE id IN (SELECT post_id FROM media WHERE filename = ?)
+            ''', (new_filename,))
+            old_files.append(filename)
+            moved += 1
+
+    for filename in old_files:
+        try:
+            os.remove(os.path.join(upload_folder, filename))
+        except FileNotFoundError:
+            pass
+    return moved
 
-# Script Initialization
-if __name__ == '__main__':
-    print("Initializing database...")
-    init_db()
 
-    print("Adding sample data...")
+def get_referenced_files(filenames):
+    """Find which of some files under UPLOAD_FOLDER the database points at
+    Args:
+        filenames: Paths under UPLOAD_FOLDER, at most MEDIA_BATCH_SIZE of them
+    Returns:
+        The set of those named by a media, blob or variant row, or claimed
+        by an upload or delete in progress
+    """
+    if not filenames:
+        return set()
+    placeholders = ', '.join('?' * len(filenames))
+    referenced = set()
+    with connection() as conn:
+        for table in ('media', 'media_blobs', 'media_variants'):
+            referenced.update(row['filename'] for row in conn.execute(
+                f'SELECT filename FROM {table} WHERE filename IN ({placeholders})',
+                list(filenames)))
+        referenced.update(row['filename'] for row in conn.execute(f'''
+            SELECT filename FROM storage_claims
+            WHERE filename IN ({placeholders}) AND claimed_at >= ?
+        ''', [*filenames, time.time() - STORAGE_CLAIM_SECONDS]))
+    return referenced
+
+
+def remove_unreferenced_files(filenames):
+    """Delete files that no row points at, checking again under the write lock
+    and deleting them once it is released
+    Returns:
+        The filenames actually deleted
+    """
+    if not filenames:
+        return []
+    with write() as conn:
+        # An upload may have claimed one of them since they were found
+        doomed = sorted(set(filenames) - get_referenced_files(filenames))
+        _claim_for_delete(conn, doomed)
+    return _delete_claimed(doomed)
+
+
+def iter_media_filenames(batch_size=MEDIA_BATCH_SIZE):
+    """Yield batches of the files that media and variant rows point at
+
+    Each batch is its own short query, so neither table is ever loaded
+    whole and writers are never held up for long.
+    Yields:
+        Lists of (post_id, filename) pairs; post_id is None for variants
+    """
+    for sql in ('SELECT id AS position, post_id, filename FROM media '
+                'WHERE id > ? ORDER BY id LIMIT ?',
+                'SELECT rowid AS position, NULL AS post_id, filename FROM media_variants '
+                'WHERE rowid > ? ORDER BY rowid LIMIT ?'):
+        position = 0
+        while True:
+            with connection() as conn:
+                rows = conn.execute(sql, (position, batch_size)).fetchall()
+            if not rows:
+                break
+            position = rows[-1]['position']
+            yield [(row['post_id'], row['filename']) for row in rows]
+
+
+# Query Plan Check
+def check_query_plans():
+    """Run the database functions on a scratch database and check their queries
+
+    Every SELECT, UPDATE and DELETE they run goes through EXPLAIN QUERY PLAN,
+    except those marked WHOLE_TABLE. The scratch database belongs to a
+    throwaway app, so this module's own settings are never touched.
+    Returns:
+        A list of (sql, plan step) pairs for queries that scan a whole table,
+        or a whole index, instead of looking rows up. An empty list means
+        every query is indexed.
+    """
+    statements = []
+    problems = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        app.config.update(DATABASE_FILE=os.path.join(tmp, 'query_plans.db'), UPLOAD_FOLDER=tmp,
+                          MEDIA_STORAGE='local')
+        init_app(app)
+        config = app.extensions['database']
+        try:
+            # Migrations may scan tables once; only check the everyday queries
+            with app.app_context():
+                init_db()
+            with app.app_context():
+                close_pool()  # So every connection the workload uses is traced
+                config.TRACE_CALLBACK = statements.append
+                _run_query_plan_workload()
+
+            # Fresh connections, so the EXPLAINs themselves aren't traced
+            config.TRACE_CALLBACK = None
+            with app.app_context():
+                close_pool()
+                with connection() as conn:
+                    for sql in dict.fromkeys(statements):
+                        if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                            continue
+                        if "'main'." in sql:
+                            continue  # FTS5's own bookkeeping on its shadow tables
+                        if WHOLE_TABLE in sql:
+                            continue
+                        first_rows = FIRST_ROWS in sql and ' LIMIT ' in ' '.join(sql.split())
+                        for step in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+                            detail = step['detail']
+                            if not detail.startswith('SCAN') or ' VIRTUAL TABLE INDEX ' in detail:
+                                continue
+                            # SCAN ... USING INDEX still reads the whole
+                            # index, unless a LIMIT stops it early
+                            if first_rows and ' USING ' in detail:
+                                continue
+                            problems.append((' '.join(sql.split()), detail))
+        finally:
+            with app.app_context():
+                close_pool()
+
+    return problems
+
+
+def _run_query_plan_workload():
+    """Run every query the app, jobs.py, bulk.py and maintenance.py make
+
+    Each public function here that runs SQL is called at least once, taking
+    the branches with different queries (e.g. a job that fails for good).
+    """
+    upload_folder = settings().UPLOAD_FOLDER
     seed_sample_data()
+    post_id = create_post('Query plan post', 'Some content')
+    update_post(post_id, 'Query plan post', 'Edited content')
+    add_media(post_id, 'example.png', 'image')
+    media = get_post_media(post_id)[0]
+    get_media(media['id'])
+    get_media_mime_type(media['filename'])
+    for copy in ('first.png', 'second.png'):
+        temp_path = os.path.join(upload_folder, copy)
+        with open(temp_path, 'wb') as f:
+            f.write(b'same content')
+        add_media_file(post_id, temp_path, hashlib.sha256(b'same content').hexdigest(),
+                       12, '.png', 'image')
+    temp_path = os.path.join(upload_folder, 'discarded.png')
+    with open(temp_path, 'wb') as f:
+        f.write(b'discarded')
+    uploads = [(temp_path, hashlib.sha256(b'discarded').hexdigest(), 9, '.png', 'image')]
+    stage_media(uploads)
+    discard_staged_media(uploads)
+
+    get_all_posts()
+    get_post(post_id)
+    get_post_updated_at(post_id)
+    get_blog_state()
+    posts, prev_cursor, next_cursor = get_posts_page(limit=2)
+    posts, prev_cursor, next_cursor = get_posts_page(before=next_cursor, limit=2)
+    get_posts_page(after=prev_cursor, limit=2)
+    search_posts('edited content')
+    add_media_variant(media['filename'], 320, 'webp', 'example_w320.webp')
+    get_media_variants(media['filename'])
+    is_media_variant('example_w320.webp')
+    enqueue_job('example', {})
+    fail_job(claim_job(), 'Example failure')
+    enqueue_job('doomed', {})
+    job = claim_job()
+    fail_job(dict(job, attempts=JOB_MAX_ATTEMPTS), 'Example failure')  # To dead_jobs
+    retry_dead_jobs()
+    rebuild_search_index()
+
+    delete_media(media['id'])
+    delete_post(post_id)
+    while True:
+        job = claim_job()
+        if job is None:
+            break
+        finish_job(job['id'])
+    remove_media_files(['example.png'])
+
+    post_id = create_post('Maintenance post', 'Some content')
+    add_media(post_id, 'legacy.png', 'image')
+    add_media_variant('legacy.png', 320, 'webp', 'legacy_w320.webp')
+    for name in ('legacy.png', 'legacy_w320.webp'):
+        with open(os.path.join(upload_folder, name), 'wb') as f:
+            f.write(b'legacy')
+    for filename in get_unsharded_media():
+        shard_media([(filename, hashlib.sha256(b'legacy').hexdigest(), 6)])
+    remove_unreferenced_files(['unknown.png'])
+    for batch in iter_media_filenames():
+        get_referenced_files([filename for _, filename in batch])
+
+    import bulk  # Imported here because bulk.py imports this module
+    archive = os.path.join(upload_folder, 'archive.jsonl')
+    with contextlib.redirect_stderr(io.StringIO()):  # No progress output
+        bulk.export_posts(archive, media_dir=os.path.join(upload_folder, 'archive_media'))
+        with open(archive) as f:
+            records = [dict(json.loads(line), id=None) for line in f]  # New IDs
+        with open(archive, 'w') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+        bulk.import_posts(archive, media_dir=os.path.join(upload_folder, 'archive_media'))
+
+
+# Script Initialization
+def main():
+    """Command line entry point: python database.py [command]"""
+    parser = argparse.ArgumentParser(description='Manage the blog database.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('init', help='Create the tables and add sample data (default)')
+    commands.add_parser('migrate', help='Apply any new schema migrations')
+    commands.add_parser('check-indexes', help='Check that every query uses an index')
+    commands.add_parser('rebuild-search', help='Rebuild the full-text search index')
+
+    for name, direction in (('import', 'from'), ('export', 'to')):
+        command = commands.add_parser(name, help=f'Copy posts {direction} a JSON Lines or CSV file')
+        command.add_argument('path', help="File name, or - for standard input/output")
+        command.add_argument('--format', choices=['jsonl', 'csv'],
+                             help='Defaults to the file extension, else jsonl')
+        command.add_argument('--media-dir', help=f'Copy media files {direction} this folder')
+        command.add_argument('--batch-size', type=int, default=5000, help='Posts per transaction')
+        command.add_argument('--workers', type=int, default=8, help='Threads copying media files')
+
+    shard = commands.add_parser('shard-media', help='Move old flat uploads into ab/cd/ folders')
+    shard.add_argument('--workers', type=int, default=8, help='Threads hashing files')
+    gc = commands.add_parser('gc-media', help='Find orphan and missing media files')
+    gc.add_argument('--delete', action='store_true', help='Delete the orphan files')
+    gc.add_argument('--min-age', type=float, default=3600,
+                    help='Seconds since a file changed before it can be an orphan')
+    gc.add_argument('--workers', type=int, default=8, help='Threads checking files')
+    args = parser.parse_args()
+
+    if args.command in (None, 'init'):
+        print("Initializing database...")
+        init_db()
+
+        print("Adding sample data...")
+        seed_sample_data()
+
+        print("Database setup complete! You can now run app.py")
+
+    elif args.command == 'migrate':
+        init_db()
+        with connection() as conn:
+            print(f"Database is at schema version {get_schema_version(conn)}")
+
+    elif args.command == 'check-indexes':
+        problems = check_query_plans()
+        for sql, detail in problems:
+            print(f"{detail}: {sql}")
+        if problems:
+            sys.exit(1)
+        print("Every query uses an index.")
+
+    elif args.command == 'rebuild-search':
+        init_db()
+        rebuild_search_index()
+        print("Search index rebuilt.")
+
+    elif args.command in ('import', 'export'):
+        import bulk  # Imported here because bulk.py imports this module
+        init_db()
+        run = bulk.import_posts if args.command == 'import' else bulk.export_posts
+        run(args.path, args.format, args.media_dir, args.batch_size, args.workers)
+
+    elif args.command == 'shard-media':
+        import maintenance  # Imported here because maintenance.py imports this module
+        if not isinstance(STORAGE, storage.LocalStorage):
+            sys.exit("shard-media only works with MEDIA_STORAGE = 'local'")
+        init_db()
+        moved, missing = maintenance.shard_uploads(args.workers)
+        print(f"Moved {moved} files into folders; {missing} were already missing.")
+
+    elif args.command == 'gc-media':
+        import maintenance
+        init_db()
+        maintenance.GarbageCollector(args.workers, args.delete, args.min_age).run()
+
+
+if __name__ == '__main__':
+    # bulk.py and maintenance.py `import database`; make that this module
+    # rather than a second copy with its own settings and connections
+    sys.modules['database'] = sys.modules[__name__]
+    main()
 
-    print("Database setup complete! You can now run app.py")
\ No newline at end of file
@@ -0,0 +1,386 @@
+"""
+Measure where each request's time goes.
+
+Every request records how many SQL statements it ran, how long they took
+(and which were slowest), how long templates took to render and how long
+uploaded files took to arrive. The counts and durations are sent back in a
+Server-Timing header, which browser developer tools show under "Timing",
+and added to process-wide totals served at /_metrics in the Prometheus
+text format.
+
+The header only names the slowest statements in debug mode, and /_metrics
+only answers in debug mode or to an address in STATS_ALLOWED_IPS, so a
+public site doesn't show visitors its SQL or traffic.
+
+With PROFILER_ENABLED on, add ?_profile=1 to any URL to sample that
+request's call stack every few milliseconds. The response is then the
+samples in "collapsed stack" format, ready for flamegraph.pl or speedscope.
+"""
+
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import Response, abort, current_app, g, has_app_context, has_request_context, request
+from jinja2 import Template
+
+from cache import stats_allowed
+
+SLOWEST_KEPT = 3  # Slowest statements reported per request
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# Collecting Timings
+class RequestStats:
+    """Timings for one request, kept in g.request_stats"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.timings = Counter()  # Name ('sql', 'template', ...) -> seconds
+        self.slowest = []  # (seconds, sql), slowest first
+
+    def add_query(self, sql, seconds):
+        self.queries += 1
+        self.timings['sql'] += seconds
+        if len(self.slowest) < SLOWEST_KEPT or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, sql))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[SLOWEST_KEPT:]
+
+
+def current_stats():
+    """The running request's RequestStats, or None outside an instrumented request"""
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in a with-block to the current request's timings"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.timings[name] += time.perf_counter() - started
+
+
+def record_query(sql, seconds):
+    """Count one SQL statement against the current request and the totals"""
+    current_metrics().observe_query(seconds)
+    stats = current_stats()
+    if stats is not None:
+        stats.add_query(sql, seconds)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times its statements, including fetching their rows"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def _fetch(self, method, *args):
+        # SQLite finds rows as they are fetched, so this is query time too
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.timings['sql'] += time.perf_counter() - started
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, size if size is not None else self.arraysize)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose statements all go through an InstrumentedCursor
+
+    database.get_db_connection() uses it for apps whose CONNECTION_FACTORY
+    init_app() has set.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class TimedTemplate(Template):
+    """Jinja template that adds its render time to the request's timings"""
+
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return super().render(*args, **kwargs)
+
+
+# Process-wide Metrics
+class Histogram:
+    """Prometheus-style histogram: cumulative bucket counts, sum and count"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Totals for every request this process has served"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()  # (endpoint, method, status) -> count
+        self.durations = {}  # endpoint -> Histogram
+        self.request_queries = Counter()  # endpoint -> SQL statements
+        self.timings = Counter()  # (endpoint, name) -> seconds
+        self.queries = 0  # Every statement, including background jobs
+        self.query_seconds = 0.0
+
+    def observe_query(self, seconds):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+
+    def observe_request(self, endpoint, method, status, stats, duration):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.durations.setdefault(endpoint, Histogram()).observe(duration)
+            self.request_queries[endpoint] += stats.queries
+            for name, seconds in stats.timings.items():
+                self.timings[(endpoint, name)] += seconds
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            lines = [
+                '# HELP blog_requests_total Requests served.',
+                '# TYPE blog_requests_total counter',
+            ]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'blog_requests_total{{endpoint="{endpoint}",'
+                             f'method="{method}",status="{status}"}} {count}')
+
+            lines += [
+                '# HELP blog_request_duration_seconds Time to build each response.',
+                '# TYPE blog_request_duration_seconds histogram',
+            ]
+            for endpoint, histogram in sorted(self.durations.items()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'blog_request_duration_seconds_bucket'
+                                 f'{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines += [
+                    f'blog_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} '
+                    f'{histogram.count}',
+                    f'blog_request_duration_seconds_sum{{endpoint="{endpoint}"}} {histogram.sum}',
+                    f'blog_request_duration_seconds_count{{endpoint="{endpoint}"}} '
+                    f'{histogram.count}',
+                ]
+
+            lines += [
+                '# HELP blog_request_sql_queries_total SQL statements run by requests.',
+                '# TYPE blog_request_sql_queries_total counter',
+            ]
+            for endpoint, count in sorted(self.request_queries.items()):
+                lines.append(f'blog_request_sql_queries_total{{endpoint="{endpoint}"}} {count}')
+
+            lines += [
+                '# HELP blog_request_phase_seconds_total Request time spent in SQL, '
+                'template rendering and upload I/O.',
+                '# TYPE blog_request_phase_seconds_total counter',
+            ]
+            for (endpoint, name), seconds in sorted(self.timings.items()):
+                lines.append(f'blog_request_phase_seconds_total'
+                             f'{{endpoint="{endpoint}",phase="{name}"}} {seconds}')
+
+            lines += [
+                '# HELP blog_sql_queries_total SQL statements run, including background jobs.',
+                '# TYPE blog_sql_queries_total counter',
+                f'blog_sql_queries_total {self.queries}',
+                '# HELP blog_sql_seconds_total Time spent executing SQL statements.',
+                '# TYPE blog_sql_seconds_total counter',
+                f'blog_sql_seconds_total {self.query_seconds}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()  # Totals for statements run outside any app
+
+
+def current_metrics():
+    """The current app's Metrics, or the module's own outside an app"""
+    if has_app_context():
+        return current_app.extensions.get('metrics', metrics)
+    return metrics
+
+
+# Sampling Profiler
+class SamplingProfiler:
+    """Records one thread's call stack every interval seconds until stopped"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()  # Tuple of frames, outermost first -> count
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='profiler')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def collapsed(self):
+        """The samples as 'outer;inner;innermost count' lines"""
+        return ''.join(f"{';'.join(stack)} {count}\n"
+                       for stack, count in self.samples.most_common())
+
+
+# Flask Integration
+class Instrumentation:
+    """Adds the timings, the Server-Timing header, /_metrics and the profiler
+
+    Set up with init_app(), which reads these config values:
+        INSTRUMENTATION: Turn everything on (default) or off
+        SERVER_TIMING: Send the Server-Timing header (default on); its
+            slowest statements' SQL is only included in debug mode
+        STATS_ALLOWED_IPS: Addresses that may read /_metrics outside
+            debug mode (default none)
+        PROFILER_ENABLED: Allow ?_profile=1 (default off; it shows code paths)
+        PROFILER_INTERVAL: Seconds between stack samples
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('INSTRUMENTATION', True)
+        app.config.setdefault('SERVER_TIMING', True)
+        app.config.setdefault('PROFILER_ENABLED', False)
+        app.config.setdefault('PROFILER_INTERVAL', 0.002)
+        app.config.setdefault('STATS_ALLOWED_IPS', ())
+        if not app.config['INSTRUMENTATION']:
+            return
+
+        # The app's connections are instrumented (see database.init_app())
+        app.extensions['database'].CONNECTION_FACTORY = InstrumentedConnection
+        app.extensions['metrics'] = Metrics()
+        app.jinja_env.template_class = TimedTemplate
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._stop_profiler)
+        app.add_url_rule('/_metrics', 'metrics', self.metrics_view)
+
+    def _before_request(self):
+        g.request_stats = RequestStats()
+        if request.args.get('_profile') and current_app.config['PROFILER_ENABLED']:
+            g.profiler = SamplingProfiler(threading.get_ident(),
+                                          current_app.config['PROFILER_INTERVAL'])
+            g.profiler.start()
+
+    def _after_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        duration = time.perf_counter() - stats.started
+        current_metrics().observe_request(request.endpoint or 'none', request.method,
+                                response.status_code, stats, duration)
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            response = Response(profiler.collapsed(), mimetype='text/plain')
+
+        if current_app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = server_timing(
+                stats, duration, include_sql=current_app.debug)
+        return response
+
+    def _stop_profiler(self, exception=None):
+        # after_request doesn't run when the view raised
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+
+    def metrics_view(self):
+        """Prometheus text-format endpoint with this process's totals"""
+        if not stats_allowed():
+            abort(404)
+        return Response(current_metrics().render(), mimetype='text/plain; version=0.0.4')
+
+
+def server_timing(stats, duration, include_sql=False):
+    """Build a Server-Timing header value from a request's timings
+    Args:
+        include_sql: Also list the slowest statements with their SQL text
+    """
+    def entry(name, seconds, description=None):
+        value = f'{name};dur={seconds * 1000:.2f}'
+        if description is not None:
+            # Header values are ASCII; quotes and backslashes need escaping
+            description = ' '.join(description.split())[:80]
+            description = description.encode('ascii', 'replace').decode('ascii')
+            description = description.replace('\\', '\\\\').replace('"', '\\"')
+            value += f';desc="{description}"'
+        return value
+
+    entries = [entry('sql', stats.timings['sql'], f'{stats.queries} queries')]
+    entries += [entry(name, seconds) for name, seconds in sorted(stats.timings.items())
+                if name != 'sql']
+    if include_sql:
+        entries += [entry(f'sql-{rank}', seconds, sql)
+                    for rank, (seconds, sql) in enumerate(stats.slowest, start=1)]
+    entries.append(entry('total', duration))
+    return ', '.join(entries)
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,147 @@
+"""
+Background jobs: work that happens after a request instead of during it.
+
+database.enqueue_job() stores a job in the jobs table, in the same
+transaction as the change that needs it. Worker threads claim due jobs,
+run the matching handler below and retry failures with a growing delay.
+A job that keeps failing is moved to the dead_jobs table.
+
+Workers run inside the web app (see init_app) or on their own:
+
+    python jobs.py              # run workers until stopped
+    python jobs.py --once       # run every due job, then exit
+    python jobs.py --retry-dead # put dead jobs back on the queue
+"""
+
+import argparse
+import logging
+import threading
+import traceback
+from contextlib import nullcontext
+
+import database as db
+import thumbnails
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0  # Seconds between checks for jobs queued by other processes
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Decorator that registers the function that runs one kind of job"""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+# Job Handlers
+@handler('remove_media_files')
+def remove_media_files(filenames):
+    db.remove_media_files(filenames)
+
+
+@handler('generate_variants')
+def generate_variants(filename):
+    thumbnails.generate_variants(filename)
+
+
+# Workers
+def run_next_job():
+    """Claim and run one due job
+    Returns:
+        False if there was nothing to do
+    """
+    job = db.claim_job()
+    if job is None:
+        return False
+
+    try:
+        func = HANDLERS.get(job['kind'])
+        if func is None:
+            raise LookupError(f"No handler for job kind {job['kind']!r}")
+        func(**job['payload'])
+    except Exception:
+        logger.exception('Job %s (%s) failed', job['id'], job['kind'])
+        db.fail_job(job, traceback.format_exc())
+    else:
+        db.finish_job(job['id'])
+    return True
+
+
+def run_pending():
+    """Run jobs until none are due
+    Returns:
+        How many jobs were run
+    """
+    count = 0
+    while run_next_job():
+        count += 1
+    return count
+
+
+def _worker_loop(stop, app):
+    while not stop.is_set():
+        try:
+            # One app context per job, so its connection goes back to the pool
+            with app.app_context() if app is not None else nullcontext():
+                found = run_next_job()
+            if not found:
+                db.wait_for_jobs(POLL_INTERVAL)
+        except Exception:
+            # e.g. the database was locked for too long; try again shortly
+            logger.exception('Job worker error')
+            stop.wait(POLL_INTERVAL)
+
+
+def start_workers(count, app=None):
+    """Start worker threads
+    Args:
+        count: How many threads
+        app: Run the jobs with this Flask app's database and storage
+            (default: database.py's own settings)
+    Returns:
+        An Event; set it to make the workers stop after their current job
+    """
+    stop = threading.Event()
+    for number in range(count):
+        threading.Thread(target=_worker_loop, args=(stop, app), daemon=True,
+                         name=f'job-worker-{number}').start()
+    return stop
+
+
+def init_app(app):
+    """Run JOB_WORKERS worker threads alongside a Flask app
+
+    Set JOB_WORKERS to 0 when the workers run as a separate process.
+    """
+    app.config.setdefault('JOB_WORKERS', 2)
+    if app.config['JOB_WORKERS'] > 0:
+        app.extensions['job_workers'] = start_workers(app.config['JOB_WORKERS'], app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run background jobs.')
+    parser.add_argument('--threads', type=int, default=2, help='Worker threads')
+    parser.add_argument('--once', action='store_true', help='Run due jobs, then exit')
+    parser.add_argument('--retry-dead', action='store_true', help='Requeue dead jobs, then exit')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db.init_db()
+    if args.retry_dead:
+        print(f"Requeued {db.retry_dead_jobs()} dead jobs.")
+    elif args.once:
+        print(f"Ran {run_pending()} jobs.")
+    else:
+        stop = start_workers(args.threads)
+        try:
+            stop.wait()
+        except KeyboardInterrupt:
+            stop.set()
+
+
+if __name__ == '__main__':
+    main()
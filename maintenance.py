@@ -0,0 +1,182 @@
+"""
+Keeping media storage tidy as it grows.
+
+    python database.py shard-media          # move old flat uploads into folders
+    python database.py gc-media             # list orphan and missing files
+    python database.py gc-media --delete    # ...and delete the orphans
+
+Uploads are stored by content as ab/cd/<sha256>.ext (see
+database.blob_filename), so no folder holds more than a few hundred files
+and looking one up stays fast. Files uploaded before that sit directly in
+UPLOAD_FOLDER; shard-media hashes them on a thread pool and moves them,
+with their resized copies, into the same layout.
+
+gc-media checks both ways: orphans are files that no row points at, and
+missing files are rows whose file is gone. With --delete it also removes
+the shard folders that end up empty. It works on any storage backend
+(see storage.py). The files and the tables are both listed in batches and
+checked on a thread pool, so memory use stays the same however many files
+there are.
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+
+import database as db
+from bulk import batches
+
+CHUNK_SIZE = 1024 * 1024  # Bytes read at a time while hashing
+
+
+def in_app_context(func):
+    """Wrap a function for the thread pool, so it uses the same app's
+    database and storage as the caller (see database.settings())"""
+    if not has_app_context():
+        return func
+    app = current_app._get_current_object()
+
+    def run(*args):
+        with app.app_context():
+            return func(*args)
+    return run
+
+
+# Sharding
+def hash_file(filename):
+    """Hash a file under UPLOAD_FOLDER
+    Returns:
+        (filename, sha256, size), or None if the file doesn't exist
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(os.path.join(db.settings().UPLOAD_FOLDER, filename), 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+    except FileNotFoundError:
+        return None
+    return filename, digest.hexdigest(), size
+
+
+def shard_uploads(workers=8, batch_size=db.MEDIA_BATCH_SIZE):
+    """Move every old flat upload into the content-addressed layout
+    Args:
+        workers: Threads hashing files
+        batch_size: Files moved per transaction
+    Returns:
+        (files moved, files that were already missing)
+    """
+    moved = missing = 0
+    after = ''
+    with ThreadPoolExecutor(workers) as pool:
+        while filenames := db.get_unsharded_media(after, batch_size):
+            after = filenames[-1]
+            hashed = [item for item in pool.map(in_app_context(hash_file), filenames)
+                      if item is not None]
+            missing += len(filenames) - len(hashed)
+            moved += db.shard_media(hashed)
+            print(f'\r{moved} files moved', end='', file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+    return moved, missing
+
+
+# Garbage Collection
+def bounded_map(pool, func, items, limit):
+    """Like pool.map(), but never takes more than limit items ahead of the results
+
+    pool.map() would read the whole iterable first, defeating streaming.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class GarbageCollector:
+    """Finds (and optionally deletes) orphan files and lists missing ones"""
+
+    def __init__(self, workers=8, delete=False, min_age=3600, batch_size=db.MEDIA_BATCH_SIZE):
+        self.workers = workers
+        self.delete = delete
+        # Uploads and resized copies are written just before their rows
+        # are committed, so only files older than this count as orphans
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self._output_lock = threading.Lock()
+
+    def _report(self, line):
+        with self._output_lock:
+            print(line, flush=True)
+
+    def _collect_folder(self, folder):
+        """Check the files in one top-level folder of storage
+        Returns:
+            (files checked, orphans found)
+        """
+        checked = orphan_count = 0
+        cutoff = time.time() - self.min_age
+        media_storage = db.settings().STORAGE
+        for batch in batches(media_storage.scan(folder), self.batch_size):
+            checked += len(batch)
+            referenced = db.get_referenced_files([filename for filename, _ in batch])
+            orphans = [filename for filename, modified in batch
+                       if filename not in referenced and modified < cutoff]
+            if self.delete:
+                orphans = db.remove_unreferenced_files(orphans)
+            for filename in orphans:
+                self._report(f"{'deleted' if self.delete else 'orphan'} {filename}")
+            orphan_count += len(orphans)
+        if self.delete:
+            media_storage.prune(folder)  # Shard folders the deletes left empty
+        return checked, orphan_count
+
+    def find_orphans(self):
+        """Check every stored file, one shard folder per task
+        Returns:
+            (files checked, orphans found)
+        """
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = list(pool.map(in_app_context(self._collect_folder),
+                                    db.settings().STORAGE.folders()))
+        return sum(checked for checked, _ in results), sum(found for _, found in results)
+
+    def _missing_in(self, batch):
+        media_storage = db.settings().STORAGE
+        return [(post_id, filename) for post_id, filename in batch
+                if media_storage.stat(filename) is None]
+
+    def find_missing(self):
+        """Check that every media and variant row's file exists
+        Returns:
+            How many are missing
+        """
+        count = 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            for missing in bounded_map(pool, in_app_context(self._missing_in),
+                                       db.iter_media_filenames(self.batch_size),
+                                       self.workers * 2):
+                for post_id, filename in missing:
+                    where = f'post {post_id}' if post_id is not None else 'resized copy'
+                    self._report(f'missing {filename} ({where})')
+                count += len(missing)
+        return count
+
+    def run(self):
+        """Look for orphan and missing files and print a summary"""
+        checked, orphans = self.find_orphans()
+        missing = self.find_missing()
+        action = 'deleted' if self.delete else 'found'
+        print(f'Checked {checked} files: {orphans} orphans {action}, '
+              f'{missing} missing files', file=sys.stderr)
+        return orphans, missing
@@ -0,0 +1,96 @@
+"""
+Serving uploaded files.
+
+Files are sent with their stored Content-Type and support HTTP Range
+requests, so a browser can jump to any point of a video without
+downloading what comes before. Content-addressed files (named by their
+SHA-256, see database.blob_filename) never change, so browsers and CDNs
+may keep them for a year without asking again.
+
+Python doesn't have to copy the bytes itself. Under a server that offers
+wsgi.file_wrapper (e.g. gunicorn) whole files go out with sendfile().
+Better still, set MEDIA_SENDFILE so the web server in front sends them:
+
+    'x-sendfile'        Apache mod_xsendfile, lighttpd: sends the file's
+                        absolute path in an X-Sendfile header
+    'x-accel-redirect'  nginx: sends MEDIA_ACCEL_PREFIX + the filename in
+                        an X-Accel-Redirect header; map that prefix to
+                        UPLOAD_FOLDER in an `internal` location block
+
+With files in S3 (MEDIA_STORAGE = 's3', see storage.py) this route only
+redirects to a short-lived presigned URL, so the bucket sends the bytes.
+"""
+
+import os
+import re
+
+from flask import abort, current_app, redirect, request
+from werkzeug.security import safe_join
+from werkzeug.utils import send_file
+
+import database as db
+import storage
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60  # One year, the longest caches honour
+
+# Blobs are '<sha256>.ext' and their resized copies '<sha256>_w320.webp'
+_CONTENT_ADDRESSED = re.compile(r'^[0-9a-f]{64}([._]|$)')
+
+
+def init_app(app):
+    app.config.setdefault('MEDIA_SENDFILE', None)
+    app.config.setdefault('MEDIA_ACCEL_PREFIX', '/protected-media/')
+    if app.config['MEDIA_SENDFILE'] not in (None, 'x-sendfile', 'x-accel-redirect'):
+        raise ValueError(f"Unknown MEDIA_SENDFILE: {app.config['MEDIA_SENDFILE']!r}")
+
+
+def send_media(filename):
+    """Build the response for one uploaded file
+
+    Only files the database records are sent, never other files that happen
+    to be in storage, such as uploads still arriving ('.upload-*.part').
+    Args:
+        filename: The file's name in storage
+    """
+    # Resized copies have no media row; their extension says enough
+    mime_type = db.get_media_mime_type(filename)
+    if mime_type is None and not db.is_media_variant(filename):
+        abort(404)
+
+    media_storage = db.settings().STORAGE
+    if not isinstance(media_storage, storage.LocalStorage):
+        # A missing file gets its 404 from the bucket
+        response = redirect(media_storage.presigned_url(filename))
+        # Browsers may reuse the redirect for a while, but not past the URL's expiry
+        response.cache_control.max_age = media_storage.url_expires // 2
+        return response
+
+    path = safe_join(os.path.abspath(media_storage.folder), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    name = os.path.basename(filename)
+    immutable = _CONTENT_ADDRESSED.match(name) is not None
+    mode = current_app.config['MEDIA_SENDFILE']
+    environ = request.environ
+    if mode is not None:
+        # The web server in front answers Range requests from the file itself
+        environ = {key: value for key, value in environ.items() if key != 'HTTP_RANGE'}
+
+    response = send_file(
+        path, environ,
+        mimetype=mime_type,
+        conditional=True,  # ETag/Last-Modified checks and Range requests
+        # The name already identifies the content, so no need to hash it
+        etag=name if immutable else True,
+        max_age=IMMUTABLE_MAX_AGE if immutable else None,
+        use_x_sendfile=mode is not None,
+        response_class=current_app.response_class,
+    )
+    response.accept_ranges = 'bytes'  # Tell video players they can seek
+    if immutable:
+        response.cache_control.immutable = True
+    if mode == 'x-accel-redirect':
+        del response.headers['X-Sendfile']
+        response.headers['X-Accel-Redirect'] = current_app.config['MEDIA_ACCEL_PREFIX'] + filename
+    return response
@@ -0,0 +1,242 @@
+"""
+Run the blog for real: several worker processes, each with a pool of threads.
+
+    python serve.py --bind 0.0.0.0:8000 --workers 4 --threads 8
+
+`python app.py` starts Flask's development server, which is meant for one
+person at a time and shows a debugger to anyone who triggers an error. This
+launcher instead opens the listening socket once and forks --workers
+processes that all accept connections from it, so every CPU core is used.
+Each worker answers requests with --threads threads.
+
+Signals sent to the main process:
+    SIGHUP           Graceful reload: start fresh workers (with the current
+                     code and settings), then let the old ones finish their
+                     requests and exit
+    SIGTERM, SIGINT  Graceful shutdown
+
+Settings come from config.py and the BLOG_* environment variables it lists.
+Any other WSGI server works too, e.g. gunicorn 'app:create_app()'.
+"""
+
+import argparse
+import logging
+import os
+import secrets
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger('serve')
+
+
+# Worker Process
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler that only logs errors, not every request"""
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server that handles connections on a fixed pool of threads"""
+
+    multithread = True
+
+    def __init__(self, app, fd, threads, handler=QuietRequestHandler):
+        super().__init__('127.0.0.1', 0, app, handler=handler, fd=fd)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)  # Let requests in progress finish
+
+
+def warm_up(app):
+    """Do the slow first-request work before accepting any connections"""
+    import database as db
+    import template_cache
+
+    # Compile every template (or load it from the bytecode cache) and open
+    # the pooled database connections
+    template_cache.precompile(app)
+    with app.app_context():  # The pool belongs to the app
+        db.warm_pool()
+    # One request through the whole stack fills the remaining lazy caches
+    app.test_client().get('/', headers={'User-Agent': 'serve.py warm-up'})
+
+
+def run_worker(sock, args):
+    """Serve requests from the shared socket until told to stop"""
+    # Until the server is running, SIGTERM simply ends the process
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The main process handles Ctrl+C
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Imported after the fork, so a reload picks up changed code
+    from app import create_app
+    import jobs
+
+    app = create_app({'JOB_WORKERS': 0})
+    warm_up(app)
+    server = PooledWSGIServer(app, sock.fileno(), args.threads)
+    sock.close()  # The server has its own copy
+
+    stop_jobs = jobs.start_workers(args.job_workers, app) if args.job_workers else None
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so not in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+
+    if stop_jobs is not None:
+        stop_jobs.set()
+
+
+# Main Process
+class Arbiter:
+    """Keeps the right number of workers running and handles signals"""
+
+    def __init__(self, sock, args):
+        self.sock = sock
+        self.args = args
+        self.workers = set()  # pids
+        self.retiring = {}  # pid -> time it was asked to stop
+        self._signals = []
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.sock, self.args)
+            except Exception:
+                logger.exception('Worker failed')
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers.add(pid)
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+
+        for _ in range(self.args.workers):
+            self.spawn()
+        logger.info('Listening on http://%s with %d workers x %d threads',
+                    self.args.bind, self.args.workers, self.args.threads)
+
+        while True:
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.shutdown()
+                    return
+            self.reap()
+            time.sleep(0.2)
+
+    def reap(self):
+        """Collect exited workers, replace crashed ones, kill stuck ones"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid not in self.workers:
+                continue
+            self.workers.discard(pid)
+            if self.retiring.pop(pid, None) is None:
+                logger.warning('Worker %d exited unexpectedly (status %d); replacing it',
+                               pid, status)
+                self.spawn()
+
+        deadline = time.monotonic() - self.args.graceful_timeout
+        for pid, asked in list(self.retiring.items()):
+            if asked < deadline:
+                logger.warning('Worker %d did not stop in time; killing it', pid)
+                self._kill(pid, signal.SIGKILL)
+                self.retiring[pid] = float('inf')
+
+    def reload(self):
+        """Start a new generation of workers, then retire the old one"""
+        logger.info('Reloading workers')
+        old = list(self.workers)
+        for _ in range(self.args.workers):
+            self.spawn()
+        for pid in old:
+            self.retire(pid)
+
+    def retire(self, pid):
+        self.retiring[pid] = time.monotonic()
+        self._kill(pid, signal.SIGTERM)
+
+    def shutdown(self):
+        logger.info('Shutting down')
+        for pid in list(self.workers):
+            self.retire(pid)
+        while self.workers:
+            self.reap()
+            time.sleep(0.1)
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def listen(bind, backlog=2048):
+    """Open the socket every worker accepts connections from"""
+    host, _, port = bind.rpartition(':')
+    sock = socket.create_server((host or '127.0.0.1', int(port)), backlog=backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the blog with several worker processes.')
+    parser.add_argument('--bind', default='127.0.0.1:8000', help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes (default: one per CPU core)')
+    parser.add_argument('--threads', type=int, default=8, help='Request threads per worker')
+    parser.add_argument('--job-workers', type=int, default=1,
+                        help='Background job threads per worker process')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='Seconds workers get to finish their requests when stopping')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(message)s')
+
+    # Every worker must sign cookies with the same key
+    if not os.environ.get('BLOG_SECRET_KEY'):
+        logger.warning('BLOG_SECRET_KEY is not set; sessions will end when the server restarts')
+        os.environ['BLOG_SECRET_KEY'] = secrets.token_hex()
+
+    Arbiter(listen(args.bind), args).run()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
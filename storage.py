@@ -0,0 +1,274 @@
+"""
+Where uploaded files are kept.
+
+Every file operation on media goes through a storage backend, so the files
+can live on this machine or in an S3-compatible bucket (AWS S3, MinIO,
+Cloudflare R2, ...) shared by any number of web servers:
+
+    MEDIA_STORAGE = 'local'   Files under UPLOAD_FOLDER (the default)
+    MEDIA_STORAGE = 's3'      Files in S3_BUCKET; needs `pip install boto3`
+
+Uploads always arrive in UPLOAD_FOLDER first (see uploads.py) and put()
+moves them into storage. For S3 that is a multipart upload with several
+parts sent at once, and deletes go out up to 1000 files per request.
+
+Pages link to media_url(filename). With S3_PUBLIC_URL set (a public bucket
+or a CDN in front of it) browsers fetch files straight from there.
+Otherwise the link is /media/<filename>, which redirects to a presigned URL
+that works for S3_URL_EXPIRES seconds. Cached pages keep the /media/ link,
+so they never hold a URL that has run out.
+
+Credentials come from the usual AWS settings (AWS_ACCESS_KEY_ID and
+AWS_SECRET_ACCESS_KEY, ~/.aws/credentials, or an IAM role). To try it
+without AWS, run MinIO locally and point S3_ENDPOINT_URL at it.
+"""
+
+import mimetypes
+import os
+import tempfile
+import threading
+
+from flask import url_for
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # boto3 is optional; only the S3 backend needs it
+    boto3 = None
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DELETE_BATCH_SIZE = 1000  # Most keys S3 deletes in one request
+
+
+class LocalStorage:
+    """Files kept in a folder on this machine"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, name):
+        """The file's location on disk"""
+        return os.path.join(self.folder, name)
+
+    def put(self, temp_path, name):
+        """Move a file from UPLOAD_FOLDER into storage under name"""
+        path = self.path(name)
+        while True:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.replace(temp_path, path)
+                return
+            except FileNotFoundError:
+                if not os.path.exists(temp_path):
+                    raise
+                # prune() removed the folder just after makedirs(); make it again
+
+    def open(self, name):
+        """Open a stored file for reading; raises FileNotFoundError if missing"""
+        return open(self.path(name), 'rb')
+
+    def stat(self, name):
+        """The file's size in bytes, or None if it doesn't exist"""
+        try:
+            return os.stat(self.path(name)).st_size
+        except FileNotFoundError:
+            return None
+
+    def delete(self, names):
+        """Delete several files, skipping missing ones
+        Returns:
+            The names actually deleted
+        """
+        deleted = []
+        for name in names:
+            # One system call instead of checking first
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                continue
+            deleted.append(name)
+        return deleted
+
+    def prune(self, folder):
+        """Remove the empty folders inside a top-level folder, and the folder
+        itself if it ends up empty; the top ('') always stays"""
+        if folder == '':
+            return
+        for directory, _, _ in os.walk(self.path(folder), topdown=False):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # Not empty, or removed already
+
+    def url(self, name):
+        """Where a browser can fetch the file"""
+        return url_for('media', filename=name)
+
+    def folders(self):
+        """The top-level folders, for listing files in parallel; '' is the top itself"""
+        with os.scandir(self.folder) as entries:
+            return [''] + [f'{entry.name}/' for entry in entries
+                           if entry.is_dir(follow_symlinks=False)
+                           and not entry.name.startswith('.')]
+
+    def scan(self, folder):
+        """Yield (name, last modified timestamp) for the files in a folder
+
+        The top folder ('') doesn't include its subfolders. os.scandir()
+        reads a folder a piece at a time, so even a huge one is never listed
+        in memory all at once.
+        """
+        yield from self._scan(os.path.join(self.folder, folder), folder, folder != '')
+
+    def _scan(self, directory, prefix, recursive):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') and not entry.name.startswith('.upload-'):
+                    continue  # e.g. .gitkeep; abandoned uploads do count
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        yield from self._scan(entry.path, f'{prefix}{entry.name}/', True)
+                elif entry.is_file(follow_symlinks=False):
+                    yield f'{prefix}{entry.name}', entry.stat().st_mtime
+
+
+class S3Storage:
+    """Files kept in an S3-compatible bucket"""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, public_url=None,
+                 url_expires=3600, part_size=8 * 1024 * 1024, concurrency=8):
+        if boto3 is None:
+            raise RuntimeError("MEDIA_STORAGE = 's3' needs boto3 (pip install boto3)")
+        if not bucket:
+            raise ValueError("MEDIA_STORAGE = 's3' needs S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.public_url = public_url.rstrip('/') + '/' if public_url else None
+        self.url_expires = url_expires
+        # Big files go up in part_size pieces, concurrency of them at once
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size, multipart_chunksize=part_size,
+            max_concurrency=concurrency)
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Clients are thread-safe but must not cross a fork (see serve.py)
+        with self._client_lock:
+            if self._client is None or self._client_pid != os.getpid():
+                self._client = boto3.client('s3', endpoint_url=self.endpoint_url,
+                                            region_name=self.region)
+                self._client_pid = os.getpid()
+            return self._client
+
+    def _key(self, name):
+        return self.prefix + name
+
+    def put(self, temp_path, name):
+        """Move a file from UPLOAD_FOLDER into storage under name"""
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.client.upload_file(
+            temp_path, self.bucket, self._key(name), Config=self.transfer_config,
+            # Files are named after their content, so they never change
+            ExtraArgs={'ContentType': content_type, 'CacheControl': IMMUTABLE_CACHE_CONTROL})
+        os.remove(temp_path)
+
+    def open(self, name):
+        """Download a stored file into a temporary file, ready for reading"""
+        f = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        try:
+            self.client.download_fileobj(self.bucket, self._key(name), f,
+                                         Config=self.transfer_config)
+        except ClientError as error:
+            f.close()
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(name) from error
+            raise
+        f.seek(0)
+        return f
+
+    def stat(self, name):
+        """The file's size in bytes, or None if it doesn't exist"""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(name))['ContentLength']
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def delete(self, names):
+        """Delete several files, up to 1000 per request
+        Returns:
+            The names deleted (S3 reports missing keys as deleted too)
+        """
+        deleted = []
+        names = list(names)
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': self._key(name)} for name in
+                            names[start:start + DELETE_BATCH_SIZE]],
+                'Quiet': False,
+            })
+            deleted += [item['Key'][len(self.prefix):] for item in response.get('Deleted', [])]
+            if response.get('Errors'):
+                error = response['Errors'][0]
+                raise OSError(f"Couldn't delete {error['Key']}: {error['Message']}")
+        return deleted
+
+    def prune(self, folder):
+        """Remove empty folders; S3 has none, only key prefixes"""
+
+    def presigned_url(self, name):
+        """A URL that lets anyone download the file for url_expires seconds"""
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self._key(name)},
+            ExpiresIn=self.url_expires)
+
+    def url(self, name):
+        """Where a browser can fetch the file"""
+        if self.public_url is not None:
+            return self.public_url + self._key(name)
+        return url_for('media', filename=name)  # Redirects to presigned_url()
+
+    def folders(self):
+        """The top-level folders, for listing files in parallel; '' is the top itself"""
+        folders = ['']
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter='/'):
+            folders += [item['Prefix'][len(self.prefix):] for item in page.get('CommonPrefixes', [])]
+        return folders
+
+    def scan(self, folder):
+        """Yield (name, last modified timestamp) for the files in a folder
+
+        The top folder ('') doesn't include its subfolders. Keys are listed
+        1000 at a time.
+        """
+        options = {'Delimiter': '/'} if folder == '' else {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + folder, **options):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):], item['LastModified'].timestamp()
+
+
+def from_config(config):
+    """Build the storage backend that a dict of settings (e.g. app.config) asks for"""
+    kind = config.get('MEDIA_STORAGE') or 'local'
+    if kind == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if kind == 's3':
+        return S3Storage(
+            config.get('S3_BUCKET'),
+            prefix=config.get('S3_PREFIX') or '',
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region=config.get('S3_REGION'),
+            public_url=config.get('S3_PUBLIC_URL'),
+            url_expires=config.get('S3_URL_EXPIRES') or 3600,
+            part_size=config.get('S3_PART_SIZE') or 8 * 1024 * 1024,
+            concurrency=config.get('S3_UPLOAD_CONCURRENCY') or 8)
+    raise ValueError(f'Unknown MEDIA_STORAGE: {kind!r}')
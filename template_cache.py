@@ -0,0 +1,79 @@
+"""
+Making templates cheaper to render.
+
+Fragment caching: wrap markup that only depends on one post in a cache tag,
+and it is rendered once per version of that post instead of once per page:
+
+    {% cache post_namespace(post.id), 'card', post.updated_at %}
+        ... markup built from post ...
+    {% endcache %}
+
+The first value is the namespace (see cache.py), so deleting or editing the
+post drops its fragments along with its pages. The remaining values make up
+the key; include updated_at and the fragment is rebuilt whenever the post
+or its media change. Fragments are kept in the page cache's backend, so
+they are off when CACHE_BACKEND is None.
+
+Bytecode caching: compiled templates are saved under
+TEMPLATE_BYTECODE_CACHE_DIR, so a restarted worker loads them instead of
+compiling every template again. Set it to None to turn this off.
+"""
+
+import os
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from cache import page_cache, post_namespace
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the {% cache namespace, key... %}...{% endcache %} tag"""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        namespace = parser.parse_expression()
+        key_parts = []
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_render', [namespace, nodes.List(key_parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, namespace, key_parts, caller):
+        backend = page_cache.backend
+        if backend is None:
+            return caller()
+
+        # Page keys start with '/', so fragments can share the namespace
+        key = 'fragment:' + ':'.join(str(part) for part in key_parts)
+        fragment = backend.get(namespace, key)
+        if fragment is None:
+            fragment = caller()
+            backend.set(namespace, key, str(fragment))
+        return Markup(fragment)
+
+
+def init_app(app):
+    app.config.setdefault('TEMPLATE_BYTECODE_CACHE_DIR',
+                          os.path.join(app.instance_path, 'template_cache'))
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.add_template_global(post_namespace)
+
+    directory = app.config['TEMPLATE_BYTECODE_CACHE_DIR']
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def precompile(app):
+    """Compile every template now rather than on the first request that uses it
+
+    With the bytecode cache on, this also saves them for the next restart.
+    """
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
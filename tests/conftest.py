@@ -0,0 +1,89 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, next to this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db  # noqa: E402
+import storage  # noqa: E402
+
+
+@pytest.fixture
+def blog(tmp_path, monkeypatch):
+    """An empty database and upload folder in tmp_path, used the way scripts use them"""
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    db.close_pool()
+    monkeypatch.setattr(db, 'DATABASE_FILE', str(tmp_path / 'blog.db'))
+    monkeypatch.setattr(db, 'UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setattr(db, 'STORAGE', storage.LocalStorage(str(uploads)))
+    db.init_db()
+    yield tmp_path
+    db.close_pool()
+
+
+def stored_file(content, extension='.png'):
+    """Stage content in UPLOAD_FOLDER as an upload would
+    Returns:
+        The (temp_path, sha256, size, extension, media_type) tuple stage_media() and add_media_many() take
+    """
+    from uploads import HashingFile
+    staged = HashingFile(db.UPLOAD_FOLDER)
+    staged.write(content)
+    return staged.detach(), staged.sha256, staged.size, extension, 'image'
+
+
+def ref_counts():
+    """{sha256: (ref_count, media rows pointing at it)} for every blob"""
+    with db.connection() as conn:
+        return {row['sha256']: (row['ref_count'], row['actual']) for row in conn.execute('''
+            SELECT sha256, ref_count,
+                   (SELECT COUNT(*) FROM media WHERE blob_sha256 = sha256) AS actual
+            FROM media_blobs
+        ''')}
+
+
+def make_app(folder):
+    """A second blog app with its own database and uploads in folder"""
+    from app import create_app
+    folder.mkdir()
+    return create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'DATABASE_FILE': str(folder / 'blog.db'),
+        'UPLOAD_FOLDER': str(folder / 'uploads'),
+        'JOB_WORKERS': 0,
+        'TEMPLATE_BYTECODE_CACHE_DIR': None,
+    })
+
+
+@pytest.fixture
+def app_config():
+    """Extra settings for the app fixture; override it in a test module"""
+    return {}
+
+
+@pytest.fixture
+def app(blog, app_config):
+    """The blog app on the blog fixture's database, with background jobs run by hand"""
+    from app import create_app
+    app = create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'DATABASE_FILE': db.DATABASE_FILE,
+        'UPLOAD_FOLDER': db.UPLOAD_FOLDER,
+        'JOB_WORKERS': 0,
+        'TEMPLATE_BYTECODE_CACHE_DIR': None,
+        'CACHE_DIR': str(blog / 'page_cache'),
+        **app_config,
+    })
+    yield app
+    with app.app_context():
+        db.close_pool()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,24 @@
+import database as db
+from conftest import make_app
+
+
+def test_two_apps_keep_their_own_database(tmp_path):
+    first = make_app(tmp_path / 'first')
+    second = make_app(tmp_path / 'second')
+    for app in (first, second):
+        with app.app_context():
+            db.init_db()
+
+    # Created after the second app, so the first must not have been repointed
+    response = first.test_client().post('/create', data={'title': 'Only here', 'content': 'Hi'})
+    assert response.status_code == 302
+
+    assert b'Only here' in first.test_client().get('/').data
+    assert b'Only here' not in second.test_client().get('/').data
+    with second.app_context():
+        assert db.get_all_posts() == []
+        assert db.settings().UPLOAD_FOLDER == str(tmp_path / 'second' / 'uploads')
+
+    for app in (first, second):
+        with app.app_context():
+            db.close_pool()
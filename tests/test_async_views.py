@@ -0,0 +1,32 @@
+import io
+import inspect
+
+import pytest
+
+pytest.importorskip('asgiref')  # Flask needs it to run async views
+
+import database as db
+
+
+@pytest.fixture
+def app_config():
+    return {'ASYNC_VIEWS': True}
+
+
+def test_async_views_create_and_show_a_post(app, client):
+    assert inspect.iscoroutinefunction(app.view_functions['create'])
+
+    response = client.post('/create', data={
+        'title': 'Written async', 'content': 'With a picture',
+        'media': (io.BytesIO(b'picture'), 'picture.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    with app.app_context():
+        post, = db.get_all_posts()
+    page = client.get(f"/post/{post['id']}")
+    assert page.status_code == 200
+    assert b'Written async' in page.data
+    assert post['media'][0]['filename'].encode() in page.data
+    assert b'Written async' in client.get('/').data
+    assert client.get('/post/999').status_code == 404
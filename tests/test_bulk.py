@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import pytest
+
+import bulk
+import database as db
+from conftest import ref_counts, stored_file
+
+
+def write_archive(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def test_export_import_round_trip(blog):
+    post_id = db.create_post('Shared', 'Two posts, one file')
+    other_id = db.create_post('Also shared', 'Same picture')
+    db.add_media_file(post_id, *stored_file(b'picture'))
+    db.add_media_file(other_id, *stored_file(b'picture'))
+
+    archive = blog / 'archive.jsonl'
+    media_dir = blog / 'archive_media'
+    assert bulk.export_posts(str(archive), media_dir=str(media_dir), workers=4) == 2
+    with open(archive) as f:
+        records = [json.loads(line) for line in f]
+    for post in db.get_all_posts():
+        db.delete_post(post['id'])
+
+    assert bulk.import_posts(str(archive), media_dir=str(media_dir)) == len(records)
+    imported = db.get_post(post_id)
+    assert imported['title'] == 'Shared'
+    assert len(imported['media']) == 1
+    assert db.STORAGE.stat(imported['media'][0]['filename']) == len(b'picture')
+    assert all(count == actual == 2 for count, actual in ref_counts().values())
+
+
+def test_delete_during_import_keeps_imported_blobs(blog, monkeypatch):
+    # A live delete in between two import batches used to drop the blobs the
+    # first batch had committed, because their counts were still 0
+    doomed = db.create_post('Deleted mid-import', 'Has its own file')
+    db.add_media_file(doomed, *stored_file(b'doomed'))
+
+    media_dir = blog / 'media'
+    media_dir.mkdir()
+    for name in ('first.png', 'second.png'):
+        (media_dir / name).write_bytes(name.encode())
+    archive = blog / 'archive.jsonl'
+    write_archive(archive, [
+        {'title': 'First', 'content': 'x', 'media': [{'filename': 'first.png', 'media_type': 'image'}]},
+        {'title': 'Second', 'content': 'y', 'media': [{'filename': 'second.png', 'media_type': 'image'}]},
+    ])
+
+    import_batch = bulk._import_batch
+    batches_done = []
+
+    def import_then_delete(*args):
+        import_batch(*args)
+        batches_done.append(True)
+        if len(batches_done) == 1:
+            db.delete_post(doomed)
+
+    monkeypatch.setattr(bulk, '_import_batch', import_then_delete)
+    assert bulk.import_posts(str(archive), media_dir=str(media_dir), batch_size=1) == 2
+
+    counts = ref_counts()
+    assert len(counts) == 2  # The deleted post's blob is gone, both imported ones stay
+    assert all(count == actual == 1 for count, actual in counts.values())
+    for post in db.get_all_posts():
+        for media in db.get_post(post['id'])['media']:
+            assert db.STORAGE.stat(media['filename']) is not None
+
+    # The deleted post's file is removed by a job once the import has finished
+    job = db.claim_job()
+    assert job['kind'] == 'remove_media_files'
+    db.remove_media_files(**job['payload'])
+    doomed_file = db.blob_filename(hashlib.sha256(b'doomed').hexdigest(), '.png')
+    assert db.STORAGE.stat(doomed_file) is None
+
+
+def test_failed_batch_removes_its_staged_files(blog):
+    taken = db.create_post('Already here', 'Has ID 1')
+    media_dir = blog / 'media'
+    media_dir.mkdir()
+    (media_dir / 'new.png').write_bytes(b'new picture')
+    archive = blog / 'archive.jsonl'
+    write_archive(archive, [
+        {'id': taken, 'title': 'Clash', 'content': 'x',
+         'media': [{'filename': 'new.png', 'media_type': 'image'}]},
+    ])
+
+    with pytest.raises(sqlite3.IntegrityError):
+        bulk.import_posts(str(archive), media_dir=str(media_dir))
+    stored = db.blob_filename(hashlib.sha256(b'new picture').hexdigest(), '.png')
+    assert db.STORAGE.stat(stored) is None
+    assert [name for name in os.listdir(db.UPLOAD_FOLDER) if name.startswith('.upload-')] == []
+    assert db.get_post(taken)['title'] == 'Already here'
@@ -0,0 +1,92 @@
+import os
+import threading
+
+import database as db
+from cache import FileSystemCache, page_cache
+from conftest import make_app
+
+
+def cache_counts(app):
+    with app.app_context():
+        stats = page_cache.stats()
+    return stats['hits'], stats['misses']
+
+
+def test_pages_are_cached_until_a_post_changes(app, client):
+    post_id = db.create_post('First', 'Hello')
+    client.get('/')
+    client.get('/')
+    assert cache_counts(app) == (1, 1)
+
+    client.post('/create', data={'title': 'Second', 'content': 'Hi'})
+    assert b'Second' in client.get('/').data
+
+    client.get(f'/post/{post_id}')
+    client.post(f'/edit/{post_id}', data={'title': 'First, edited', 'content': 'Hello'})
+    assert b'First, edited' in client.get(f'/post/{post_id}').data
+    assert b'First, edited' in client.get('/').data
+
+    client.get(f'/delete/{post_id}')
+    assert client.get(f'/post/{post_id}').status_code == 404
+    assert b'First, edited' not in client.get('/').data
+
+
+def test_each_app_has_its_own_cache(app, client, tmp_path):
+    other = make_app(tmp_path / 'other')
+    client.get('/')
+    assert cache_counts(other) == (0, 0)
+    with other.app_context():
+        db.close_pool()
+
+
+def test_unchanged_pages_answer_304(client):
+    post_id = db.create_post('First', 'Hello')
+    for path in ('/', f'/post/{post_id}'):
+        response = client.get(path)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert client.get(path, headers={'If-None-Match': etag}).status_code == 304
+        assert client.get(path, headers={
+            'If-Modified-Since': response.headers['Last-Modified']}).status_code == 304
+
+    # Any change to the post gives both pages a new ETag
+    home_etag = client.get('/').headers['ETag']
+    post_etag = client.get(f'/post/{post_id}').headers['ETag']
+    db.update_post(post_id, 'First, edited', 'Hello')
+    assert client.get('/', headers={'If-None-Match': home_etag}).status_code == 200
+    assert client.get(f'/post/{post_id}', headers={'If-None-Match': post_etag}).status_code == 200
+
+
+def test_missing_post_is_not_a_304(client):
+    assert client.get('/post/999', headers={'If-None-Match': '*'}).status_code == 404
+
+
+def wait_for_cache_threads():
+    for thread in threading.enumerate():
+        if thread.name.startswith('page-cache-'):
+            thread.join(timeout=5)
+
+
+def test_filesystem_cache_prunes_the_oldest_pages(tmp_path):
+    cache = FileSystemCache(str(tmp_path), max_entries=5)
+    for i in range(20):
+        cache.set('listing', f'/page/{i}', f'page {i}')
+        path = cache._path('listing', f'/page/{i}')
+        os.utime(path, (i, i))  # Written one after another
+        wait_for_cache_threads()
+
+    assert len(os.listdir(tmp_path / 'listing')) <= 5
+    assert cache.get('listing', '/page/19') == 'page 19'
+    assert cache.get('listing', '/page/0') is None
+
+
+def test_filesystem_cache_drops_a_namespace_straight_away(tmp_path):
+    cache = FileSystemCache(str(tmp_path))
+    cache.set('post-1', '/post/1', 'old page')
+    cache.delete_namespace('post-1')
+    assert cache.get('post-1', '/post/1') is None
+
+    cache.set('post-1', '/post/1', 'new page')
+    wait_for_cache_threads()
+    assert cache.get('post-1', '/post/1') == 'new page'
+    assert os.listdir(tmp_path) == ['post-1']  # The old files are gone too
@@ -0,0 +1,112 @@
+import hashlib
+import os
+
+import pytest
+
+import database as db
+import jobs
+from conftest import ref_counts, stored_file
+
+
+def test_records_ignore_columns_added_later(blog):
+    post_id = db.create_post('Hello', 'World')
+    with db.write() as conn:
+        conn.execute("ALTER TABLE posts ADD COLUMN subtitle TEXT DEFAULT ''")
+
+    post = db.get_post(post_id)
+    assert (post.title, post['content'], post.media) == ('Hello', 'World', [])
+    assert 'subtitle' not in post.keys()
+
+
+def test_records_refuse_columns_without_a_slot(blog):
+    db.create_post('Hello', 'World')
+    with db.connection() as conn, pytest.raises(ValueError, match='subtitle'):
+        db.fetch_records(conn, db.Post, "SELECT id, 'x' AS subtitle FROM posts")
+
+
+def test_pages_walk_every_post_once_in_both_directions(blog):
+    ids = [db.create_post(f'Post {i}', 'Content') for i in range(5)]
+
+    pages = []
+    posts, prev_cursor, next_cursor = db.get_posts_page(limit=2)
+    assert prev_cursor is None
+    pages.append([post.id for post in posts])
+    while next_cursor is not None:
+        posts, prev_cursor, next_cursor = db.get_posts_page(before=next_cursor, limit=2)
+        pages.append([post.id for post in posts])
+    assert pages == [ids[4:2:-1], ids[2:0:-1], ids[:1]]
+
+    # And back again from the last page
+    posts, prev_cursor, next_cursor = db.get_posts_page(after=prev_cursor, limit=2)
+    assert [post.id for post in posts] == ids[2:0:-1]
+    assert next_cursor is not None
+
+
+def test_bad_cursor_is_rejected(blog, client):
+    with pytest.raises(ValueError):
+        db.get_posts_page(before='not-a-cursor')
+    assert client.get('/?before=not-a-cursor').status_code == 400
+
+
+def test_search_highlights_matches_and_follows_edits(blog, client):
+    post_id = db.create_post('Baking bread', 'Flour, water and <b>patience</b>')
+    db.create_post('Gardening', 'Nothing about bread here')
+
+    results, has_more = db.search_posts('bread')
+    assert [result['id'] for result in results][0] == post_id  # Title matches rank first
+    assert not has_more
+    assert results[0]['title'] == f'Baking {db.HIGHLIGHT_START}bread{db.HIGHLIGHT_END}'
+
+    page = client.get('/search?q=patience').get_data(as_text=True)
+    assert '<mark>patience</mark>' in page
+    assert '&lt;b&gt;' in page  # The post's own HTML is escaped, not trusted
+
+    db.update_post(post_id, 'Baking cake', 'Sugar')
+    assert [result['id'] for result in db.search_posts('patience')[0]] == []
+    assert db.search_posts('"unbalanced')[0] == []  # Quotes are not query syntax
+
+
+def test_shared_files_are_stored_once_and_removed_with_their_last_user(blog):
+    first = db.create_post('First', 'Same picture')
+    second = db.create_post('Second', 'Same picture')
+    filename = db.add_media_file(first, *stored_file(b'picture'))
+    assert db.add_media_file(second, *stored_file(b'picture')) == filename
+    path = blog / 'uploads' / filename
+    sha256 = hashlib.sha256(b'picture').hexdigest()
+    assert ref_counts() == {sha256: (2, 2)}
+
+    db.delete_media(db.get_post(first).media[0].id)
+    jobs.run_pending()
+    assert ref_counts() == {sha256: (1, 1)}
+    assert path.exists()
+
+    db.delete_post(second)
+    assert ref_counts() == {}
+    # Uploaded again before the cleanup job ran: the new upload keeps the file
+    db.add_media_file(first, *stored_file(b'picture'))
+    jobs.run_pending()
+    assert ref_counts() == {sha256: (1, 1)}
+    assert path.read_bytes() == b'picture'
+
+    db.delete_post(first)
+    jobs.run_pending()
+    assert not path.exists()
+    assert [name for name in os.listdir(blog / 'uploads') if name.startswith('.upload-')] == []
+
+
+def test_every_query_uses_an_index():
+    settings = db.DATABASE_FILE, db.UPLOAD_FOLDER, db.STORAGE, db.TRACE_CALLBACK
+    assert db.check_query_plans() == []
+    assert (db.DATABASE_FILE, db.UPLOAD_FOLDER, db.STORAGE, db.TRACE_CALLBACK) == settings
+
+
+def test_query_plan_check_reports_scans(monkeypatch):
+    def unindexed():
+        with db.connection() as conn:
+            conn.execute("SELECT id FROM posts WHERE content = 'x'").fetchall()
+            conn.execute(f'SELECT {db.FIRST_ROWS} id FROM posts ORDER BY created_at').fetchall()
+    monkeypatch.setattr(db, 'get_blog_state', unindexed)
+
+    problems = db.check_query_plans()
+    assert [detail.split()[0] for _, detail in problems] == ['SCAN', 'SCAN']
+    assert 'USING COVERING INDEX' in problems[1][1]  # No LIMIT, so the whole index
@@ -0,0 +1,20 @@
+import database as db
+
+
+def test_server_timing_hides_sql_outside_debug(app, client):
+    db.create_post('Hello', 'World')
+    timing = client.get('/').headers['Server-Timing']
+    assert 'sql;dur=' in timing and 'total;dur=' in timing
+    assert 'SELECT' not in timing
+
+    app.debug = True
+    assert 'SELECT' in client.get('/').headers['Server-Timing']
+
+
+def test_stats_endpoints_need_debug_or_allowed_address(app, client):
+    assert client.get('/_metrics').status_code == 404
+    assert client.get('/_cache/stats').status_code == 404
+
+    app.config['STATS_ALLOWED_IPS'] = ('127.0.0.1',)
+    assert b'blog_requests_total' in client.get('/_metrics').data
+    assert client.get('/_cache/stats').get_json()['backend'] == 'MemoryCache'
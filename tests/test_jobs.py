@@ -0,0 +1,58 @@
+import pytest
+
+import database as db
+import jobs
+
+
+def job_rows(table):
+    with db.connection() as conn:
+        return conn.execute(f'SELECT * FROM {table}').fetchall()
+
+
+def make_due():
+    """Skip the retry back-off"""
+    with db.write() as conn:
+        conn.execute('UPDATE jobs SET run_at = 0')
+
+
+def test_failing_job_is_retried_then_dead_then_requeued(blog, monkeypatch):
+    calls = []
+
+    def flaky(**payload):
+        calls.append(payload)
+        if len(calls) <= db.JOB_MAX_ATTEMPTS:
+            raise OSError('storage unavailable')
+    monkeypatch.setitem(jobs.HANDLERS, 'flaky', flaky)
+
+    db.enqueue_job('flaky', {'name': 'a.png'})
+    for attempt in range(1, db.JOB_MAX_ATTEMPTS):
+        assert jobs.run_pending() == 1
+        job, = job_rows('jobs')
+        assert job['attempts'] == attempt and 'storage unavailable' in job['last_error']
+        assert jobs.run_pending() == 0  # Backing off
+        make_due()
+
+    assert jobs.run_pending() == 1
+    assert job_rows('jobs') == []
+    dead, = job_rows('dead_jobs')
+    assert dead['attempts'] == db.JOB_MAX_ATTEMPTS
+
+    assert db.retry_dead_jobs() == 1
+    assert jobs.run_pending() == 1
+    assert job_rows('jobs') == job_rows('dead_jobs') == []
+    assert calls == [{'name': 'a.png'}] * (db.JOB_MAX_ATTEMPTS + 1)
+
+
+def test_jobs_are_only_queued_if_their_transaction_commits(blog):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.enqueue_job('remove_media_files', {'filenames': []})
+            raise RuntimeError('changed my mind')
+    assert job_rows('jobs') == []
+
+
+def test_unknown_job_kind_fails_instead_of_vanishing(blog):
+    db.enqueue_job('no-such-kind', {})
+    assert jobs.run_pending() == 1
+    job, = job_rows('jobs')
+    assert 'No handler' in job['last_error']
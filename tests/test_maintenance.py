@@ -0,0 +1,87 @@
+import hashlib
+import os
+import time
+
+import database as db
+import maintenance
+from conftest import ref_counts, stored_file
+
+
+def add_legacy_file(post_id, filename, content):
+    """Record a file the way uploads were stored before content addressing"""
+    with open(os.path.join(db.UPLOAD_FOLDER, filename), 'wb') as f:
+        f.write(content)
+    db.add_media(post_id, filename, 'image')
+
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def test_shard_moves_flat_files_into_folders(blog):
+    post_id = db.create_post('Old post', 'From before sharding')
+    add_legacy_file(post_id, 'flat.png', b'old picture')
+
+    assert maintenance.shard_uploads(workers=2) == (1, 0)
+    media, = db.get_post_media(post_id)
+    assert media['filename'] == db.blob_filename(sha256(b'old picture'), '.png')
+    assert media['filename'].startswith(f"{sha256(b'old picture')[:2]}/{sha256(b'old picture')[2:4]}/")
+    assert db.STORAGE.stat(media['filename']) == len(b'old picture')
+    assert not os.path.exists(os.path.join(db.UPLOAD_FOLDER, 'flat.png'))
+
+
+def test_shard_merges_duplicate_content(blog):
+    first = db.create_post('First', 'Old copy')
+    second = db.create_post('Second', 'Another old copy')
+    third = db.create_post('Third', 'New upload')
+    add_legacy_file(first, 'a.png', b'same picture')
+    add_legacy_file(second, 'b.png', b'same picture')
+    uploaded = db.add_media_file(third, *stored_file(b'same picture'))
+
+    assert maintenance.shard_uploads(workers=2) == (2, 0)
+    assert {media['filename'] for post_id in (first, second, third)
+            for media in db.get_post_media(post_id)} == {uploaded}
+    assert ref_counts() == {sha256(b'same picture'): (3, 3)}
+
+
+def test_shard_rewrites_variant_rows(blog):
+    post_id = db.create_post('Old post', 'With a resized copy')
+    add_legacy_file(post_id, 'photo.png', b'photo')
+    with open(os.path.join(db.UPLOAD_FOLDER, 'photo_w320.webp'), 'wb') as f:
+        f.write(b'small photo')
+    db.add_media_variant('photo.png', 320, 'webp', 'photo_w320.webp')
+
+    maintenance.shard_uploads(workers=2)
+    new_filename = db.blob_filename(sha256(b'photo'), '.png')
+    variant, = db.get_media_variants(new_filename)
+    assert variant['filename'] == os.path.splitext(new_filename)[0] + '_w320.webp'
+    assert db.STORAGE.stat(variant['filename']) == len(b'small photo')
+    assert db.get_media_variants('photo.png') == []
+    assert not os.path.exists(os.path.join(db.UPLOAD_FOLDER, 'photo_w320.webp'))
+
+
+def test_gc_spares_new_files_and_prunes_empty_folders(blog, capsys):
+    orphan = os.path.join(db.UPLOAD_FOLDER, 'ab', 'cd', 'orphan.png')
+    os.makedirs(os.path.dirname(orphan))
+    with open(orphan, 'wb') as f:
+        f.write(b'nobody uses this')
+
+    collector = maintenance.GarbageCollector(workers=2, delete=True, min_age=3600)
+    assert collector.find_orphans() == (1, 0)
+    assert os.path.exists(orphan)
+
+    an_hour_ago = time.time() - 3601
+    os.utime(orphan, (an_hour_ago, an_hour_ago))
+    assert collector.find_orphans() == (1, 1)
+    assert not os.path.exists(os.path.join(db.UPLOAD_FOLDER, 'ab'))
+    assert 'deleted ab/cd/orphan.png' in capsys.readouterr().out
+
+
+def test_gc_reports_missing_files_without_deleting_rows(blog, capsys):
+    post_id = db.create_post('Lost', 'Its file is gone')
+    db.add_media(post_id, 'ab/cd/gone.png', 'image')
+
+    collector = maintenance.GarbageCollector(workers=2, delete=True)
+    assert collector.find_missing() == 1
+    assert f'missing ab/cd/gone.png (post {post_id})' in capsys.readouterr().out
+    assert [media['filename'] for media in db.get_post_media(post_id)] == ['ab/cd/gone.png']
@@ -0,0 +1,36 @@
+import io
+
+import database as db
+
+
+def upload_post(client, content=b'not really a png'):
+    response = client.post('/create', data={
+        'title': 'With a file', 'content': 'See below',
+        'media': (io.BytesIO(content), 'picture.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+    post = db.get_all_posts()[0]
+    return db.get_post(post['id']).media[0]
+
+
+def test_serves_recorded_media_with_long_caching(client):
+    media = upload_post(client)
+    response = client.get(f'/media/{media.filename}')
+    assert response.status_code == 200
+    assert response.data == b'not really a png'
+    assert response.mimetype == 'image/png'
+    assert response.cache_control.immutable
+
+    again = client.get(f'/media/{media.filename}',
+                       headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_refuses_files_the_database_does_not_record(blog, client):
+    uploads = blog / 'uploads'
+    (uploads / '.upload-abc.part').write_bytes(b'half an upload')
+    (uploads / 'stray.png').write_bytes(b'left behind')
+
+    assert client.get('/media/.upload-abc.part').status_code == 404
+    assert client.get('/media/stray.png').status_code == 404
+    assert client.get('/media/missing.png').status_code == 404
@@ -0,0 +1,31 @@
+import sqlite3
+
+import pytest
+
+import database as db
+
+
+@pytest.fixture(params=['readonly', 'snapshot'])
+def read_app(request, app):
+    app.extensions['database'].READ_MODE = request.param
+    return app
+
+
+def test_read_connections_refuse_writes(read_app):
+    db.create_post('Hello', 'World')
+    with read_app.test_request_context('/'):
+        with db.connection() as conn:
+            assert conn.execute('PRAGMA query_only').fetchone()[0] == 1
+            with pytest.raises(sqlite3.OperationalError):
+                conn.execute('CREATE TEMP TABLE scratch (x)')
+        db.close_db()
+
+
+def test_pages_read_from_the_read_connections(read_app, client):
+    db.create_post('Before', 'Seen by readers')
+    assert b'Before' in client.get('/').data
+
+    # A browser that just wrote sees its change, even before a new snapshot
+    response = client.post('/create', data={'title': 'Mine', 'content': 'Just saved'})
+    assert response.status_code == 302
+    assert b'Mine' in client.get('/').data
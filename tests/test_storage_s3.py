@@ -0,0 +1,99 @@
+import os
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+pytest.importorskip('boto3')  # S3Storage needs it; these tests skip without it
+from botocore.stub import ANY, Stubber
+
+import database as db
+import storage
+
+NAME = 'ab/cd/abcd.png'
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    """An S3Storage whose client answers from a Stubber instead of AWS"""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'no-config'))
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'no-credentials'))
+    s3 = storage.S3Storage('bucket', prefix='media/', region='us-east-1', url_expires=600,
+                           part_size=5 * 1024 * 1024, concurrency=4)
+    with Stubber(s3.client) as stubber:
+        s3.stubber = stubber
+        yield s3
+        stubber.assert_no_pending_responses()
+
+
+def test_put_uploads_then_removes_the_temporary_file(s3, tmp_path):
+    temp_path = tmp_path / '.upload-1.part'
+    temp_path.write_bytes(b'picture')
+    s3.stubber.add_response('put_object', {}, {
+        'Bucket': 'bucket', 'Key': 'media/' + NAME, 'Body': ANY,
+        'ContentType': 'image/png', 'CacheControl': storage.IMMUTABLE_CACHE_CONTROL,
+        'ChecksumAlgorithm': ANY,
+    })
+    s3.put(str(temp_path), NAME)
+    assert not temp_path.exists()
+
+
+def test_transfer_config_uses_the_part_size_and_concurrency(s3):
+    assert s3.transfer_config.multipart_threshold == 5 * 1024 * 1024
+    assert s3.transfer_config.multipart_chunksize == 5 * 1024 * 1024
+    assert s3.transfer_config.max_concurrency == 4
+
+
+def test_stat_reports_size_or_none(s3):
+    s3.stubber.add_response('head_object', {'ContentLength': 7},
+                            {'Bucket': 'bucket', 'Key': 'media/' + NAME})
+    s3.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+    assert s3.stat(NAME) == 7
+    assert s3.stat(NAME) is None
+
+
+def test_delete_sends_at_most_1000_keys_per_request(s3):
+    names = [f'file{i}.png' for i in range(2500)]
+    for start in (0, 1000, 2000):
+        batch = names[start:start + 1000]
+        s3.stubber.add_response(
+            'delete_objects', {'Deleted': [{'Key': 'media/' + name} for name in batch]},
+            {'Bucket': 'bucket', 'Delete': {
+                'Objects': [{'Key': 'media/' + name} for name in batch], 'Quiet': False}})
+    assert s3.delete(names) == names
+
+
+def test_delete_raises_on_errors(s3):
+    s3.stubber.add_response('delete_objects', {
+        'Deleted': [],
+        'Errors': [{'Key': 'media/' + NAME, 'Code': 'AccessDenied', 'Message': 'Access Denied'}],
+    })
+    with pytest.raises(OSError, match='Access Denied'):
+        s3.delete([NAME])
+
+
+def test_presigned_url_expires(s3):
+    url = urlsplit(s3.presigned_url(NAME))
+    assert (url.netloc, url.path) == ('bucket.s3.amazonaws.com', '/media/' + NAME)
+    query = parse_qs(url.query)
+    if 'X-Amz-Expires' in query:
+        assert query['X-Amz-Expires'] == ['600']
+    else:
+        assert abs(int(query['Expires'][0]) - (time.time() + 600)) < 60
+
+
+def test_media_route_redirects_to_a_presigned_url(s3, app, client):
+    app.extensions['database'].STORAGE = s3
+    with app.app_context():
+        post_id = db.create_post('In S3', 'Picture below')
+        db.add_media(post_id, NAME, 'image')
+
+    response = client.get('/media/' + NAME)
+    assert response.status_code == 302
+    assert response.location.startswith('https://bucket.s3.amazonaws.com/media/' + NAME + '?')
+    assert response.cache_control.max_age == 300  # Half of url_expires
+
+    assert client.get('/media/ab/cd/unknown.png').status_code == 404
+    assert os.listdir(app.config['UPLOAD_FOLDER']) == []
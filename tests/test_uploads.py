@@ -0,0 +1,124 @@
+import io
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import database as db
+from conftest import stored_file
+
+
+class MemoryStorage:
+    """Stands in for S3Storage: keeps files in a dict and notes whether the
+    database was locked for writing during each call that sent or deleted
+    files"""
+
+    def __init__(self, database_file):
+        self.database_file = database_file
+        self.files = {}
+        self.called_while_locked = []
+
+    def _probe(self):
+        probe = sqlite3.connect(self.database_file, timeout=0)
+        try:
+            probe.execute('BEGIN IMMEDIATE')
+            self.called_while_locked.append(False)
+        except sqlite3.OperationalError:
+            self.called_while_locked.append(True)
+        finally:
+            probe.close()
+
+    def put(self, temp_path, name):
+        self._probe()
+        with open(temp_path, 'rb') as f:
+            self.files[name] = f.read()
+        os.remove(temp_path)
+
+    def stat(self, name):
+        return len(self.files[name]) if name in self.files else None
+
+    def delete(self, names):
+        self._probe()
+        return [name for name in names if self.files.pop(name, None) is not None]
+
+    def url(self, name):
+        return f'https://bucket.example/{name}'
+
+
+@pytest.fixture
+def remote(app):
+    app.extensions['database'].STORAGE = MemoryStorage(app.config['DATABASE_FILE'])
+    return app.extensions['database'].STORAGE
+
+
+def create_with_file(client, content):
+    return client.post('/create', data={
+        'title': 'With a file', 'content': 'See below',
+        'media': (io.BytesIO(content), 'picture.png'),
+    }, content_type='multipart/form-data')
+
+
+def test_files_are_sent_and_deleted_outside_the_write_lock(remote, app, client):
+    assert create_with_file(client, b'picture').status_code == 302
+    assert list(remote.files.values()) == [b'picture']
+
+    with app.app_context():
+        post, = db.get_all_posts()
+        db.delete_post(post['id'])
+        while (job := db.claim_job())['kind'] != 'remove_media_files':
+            db.finish_job(job['id'])  # Resized copies of the image
+        db.remove_media_files(**job['payload'])
+    assert remote.files == {}
+    assert remote.called_while_locked == [False, False]
+
+
+def test_claimed_files_are_not_deleted(blog, remote, app):
+    with app.app_context():
+        upload = stored_file(b'picture')
+        name = db.blob_filename(upload[1], upload[3])
+        db.stage_media([upload])
+        db.remove_media_files([name])  # e.g. the last post using it was just deleted
+        assert name in remote.files
+
+        post_id = db.create_post('Late', 'Recorded after the delete ran')
+        assert db.add_media_many(post_id, [upload]) == [name]
+        assert remote.files[name] == b'picture'
+
+
+def test_failed_transaction_removes_staged_files(blog, remote, client, monkeypatch):
+    def fail(conn, post_id):
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(db, 'touch_post', fail)
+
+    with pytest.raises(RuntimeError):
+        create_with_file(client, b'picture')
+    assert remote.files == {}
+    assert db.get_all_posts() == []
+    assert [name for name in os.listdir(blog / 'uploads') if name.startswith('.upload-')] == []
+
+
+def test_staging_inside_a_transaction_is_refused(blog, remote, app):
+    with app.app_context(), db.transaction(), pytest.raises(RuntimeError):
+        db.stage_media([('unused', 'ab' * 32, 1, '.png', 'image')])
+
+
+def test_staging_waits_for_a_delete_in_progress(blog, remote, app):
+    upload = stored_file(b'picture')
+    name = db.blob_filename(upload[1], upload[3])
+    with app.app_context(), db.write() as conn:
+        db._claim_for_delete(conn, [name])
+
+    def stage():
+        with app.app_context():
+            db.stage_media([upload])
+    staging = threading.Thread(target=stage)
+    staging.start()
+    time.sleep(0.2)
+    assert name not in remote.files
+
+    with app.app_context():
+        db._delete_claimed([name])
+    staging.join(timeout=5)
+    assert remote.files[name] == b'picture'
@@ -0,0 +1,91 @@
+"""
+Background generation of resized images.
+
+After an image is uploaded, a background job (see jobs.py) saves smaller
+WebP and JPEG copies of it next to the original in storage (see
+storage.py) and records them in the media_variants table. Templates then
+offer them through srcset, so browsers download the smallest copy that
+looks sharp.
+
+This needs Pillow (pip install Pillow). Without it nothing is generated and
+the pages keep showing the original files.
+"""
+
+import os
+import tempfile
+
+import database as db
+from cache import page_cache, post_namespace, LISTING
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:  # Pillow is optional
+    Image = None
+
+# Configuration
+VARIANT_WIDTHS = (320, 640, 1280)
+VARIANT_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}  # Name -> Pillow format
+VARIANT_QUALITY = 80
+SKIPPED_EXTENSIONS = {'.gif'}  # Resizing would lose the animation
+
+
+def generate_variants_async(filename):
+    """Queue resized copies of an uploaded image without waiting for them
+    Args:
+        filename: The original's name in storage
+    """
+    if Image is None:
+        return
+    db.enqueue_job('generate_variants', {'filename': filename})
+
+
+def generate_variants(filename):
+    """Save and record resized copies of an image, skipping existing ones
+    Args:
+        filename: The original's name in storage
+    """
+    base, extension = os.path.splitext(filename)
+    if Image is None or extension.lower() in SKIPPED_EXTENSIONS:
+        return
+
+    settings = db.settings()
+    done = {(variant['format'], variant['width'])
+            for variant in db.get_media_variants(filename)}
+    changed_posts = set()
+
+    try:
+        with settings.STORAGE.open(filename) as f, Image.open(f) as original:
+            # Respect the camera's rotation, and JPEG has no alpha channel
+            image = ImageOps.exif_transpose(original).convert('RGB')
+    except (FileNotFoundError, UnidentifiedImageError):
+        return  # Deleted already, or not an image Pillow can read; retrying won't help
+
+    # Never scale up: a small image gets one full-size copy per format instead
+    for width in sorted({min(width, image.width) for width in VARIANT_WIDTHS}):
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+
+        for name, pillow_format in VARIANT_FORMATS.items():
+            if (name, width) in done:
+                continue
+            variant_filename = f'{base}_w{width}.{name}'
+            fd, temp_path = tempfile.mkstemp(dir=settings.UPLOAD_FOLDER, prefix='.upload-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    resized.save(f, pillow_format, quality=VARIANT_QUALITY)
+                settings.STORAGE.put(temp_path, variant_filename)
+            finally:
+                # put() moved it away on success; after a failure it's left over
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+            post_ids = db.add_media_variant(filename, width, name, variant_filename)
+            if not post_ids:
+                # The original was deleted while we were working
+                settings.STORAGE.delete([variant_filename])
+                return
+            changed_posts.update(post_ids)
+
+    # Pages rendered before the copies existed don't mention them
+    if changed_posts:
+        page_cache.invalidate(LISTING, *map(post_namespace, changed_posts))
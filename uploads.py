@@ -0,0 +1,94 @@
+"""
+Streaming file uploads.
+
+Werkzeug normally buffers every uploaded file (in memory, then in a
+temporary file) and the view copies it into place afterwards. With
+StreamingRequest the chunks go straight into a temporary file inside the
+upload folder, and their size and SHA-256 hash are worked out on the way.
+Storing the upload is then a single rename, and memory use stays the same
+whatever the file size.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from flask import current_app
+from flask.wrappers import Request
+
+from instrumentation import timed
+
+
+class HashingFile:
+    """A temporary file that hashes and counts everything written to it
+
+    The file is deleted on close() unless detach() handed it to the caller.
+    """
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.detached = False
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    @property
+    def sha256(self):
+        """Hex SHA-256 of everything written so far"""
+        return self._hash.hexdigest()
+
+    def detach(self):
+        """Close the finished upload and make the caller responsible for it
+        Returns:
+            The temporary file's path
+        """
+        self._file.close()
+        self.detached = True
+        return self.path
+
+    def close(self):
+        self._file.close()
+        if not self.detached and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        # read(), seek(), tell() and friends come from the real file
+        return getattr(self._file, name)
+
+
+class StreamingRequest(Request):
+    """Request that streams uploaded files into the app's UPLOAD_FOLDER"""
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashingFile(current_app.config['UPLOAD_FOLDER'])
+
+    def _load_form_data(self):
+        # Reading the body is when uploads arrive and hit the disk
+        with timed('upload'):
+            super()._load_form_data()
+
+
+def stage_upload(file, directory):
+    """Get an uploaded file onto disk in directory, ready to be moved into place
+    Args:
+        file: A FileStorage from request.files
+        directory: Where to put the temporary file; it must be on the same
+            file system as the final location so the move is a rename
+    Returns:
+        (temp_path, size, sha256). The caller must move or delete temp_path.
+    """
+    stream = file.stream
+    if isinstance(stream, HashingFile):
+        return stream.detach(), stream.size, stream.sha256
+
+    # Not streamed (e.g. built by hand in a script), so copy it while hashing
+    staged = HashingFile(directory)
+    for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+        staged.write(chunk)
+    return staged.detach(), staged.size, staged.sha256